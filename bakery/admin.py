@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity
+from .models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity, ThumbnailJob, StoredImage, RecipeGrocery
 
 admin.site.register(Grocery)
 admin.site.register(Ingredient)
@@ -9,3 +9,6 @@ admin.site.register(Component)
 admin.site.register(Recipe)
 admin.site.register(Order)
 admin.site.register(OrderQuantity)
+admin.site.register(RecipeGrocery)
+admin.site.register(ThumbnailJob)
+admin.site.register(StoredImage)
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class BakeryConfig(AppConfig):
     name = 'bakery'
+
+    def ready(self):
+        from bakery import dependents, fulltext, page_cache
+        dependents.connect()
+        page_cache.connect()
+        fulltext.connect()
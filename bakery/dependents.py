@@ -0,0 +1,106 @@
+'''Moves updated_at, the validator of the detail pages (see
+views.ConditionalDetailMixin), on the pages that show an object's name or
+decide from its links whether their own object can be deleted.
+
+Cost changes are handled by propagate_costs(). This module handles the rest:
+- renaming a Grocery, Component or Recipe moves the pages listing it
+- adding or removing an Ingredient moves its Grocery
+- adding or removing a Component of a Recipe moves the Recipe, the Component
+  and the Component's Groceries
+- adding or removing an OrderQuantity moves its Order and Recipe
+
+The changes are made with queryset updates in the transaction making the
+change, from post_save, post_delete, m2m_changed and bulk_saved.
+'''
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.utils import timezone
+
+from bakery.models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity
+from bakery.signals import bulk_saved
+
+#model: (model, lookup) for each detail page listing objects of model by name
+LISTINGS = {
+    Grocery: ((Component, 'ingredient__for_grocery__in'), (Recipe, 'recipegrocery__grocery__in')),
+    Component: ((Grocery, 'ingredient__for_component__in'), (Recipe, 'components__in')),
+    Recipe: ((Grocery, 'ingredient__for_component__recipe__in'), (Order, 'recipes__in')),
+}
+
+def touch(model, **filters):
+    '''Move updated_at on the objects of model matching filters'''
+    model.objects.filter(**filters).update(updated_at=timezone.now())
+
+def _renamed(sender, instance, created, **kwargs):
+    if not created and instance.was_renamed():
+        for model, lookup in LISTINGS[sender]:
+            touch(model, **{lookup: [instance.pk]})
+
+def _ingredients_changed(ingredients):
+    grocery_pks = {ingredient.for_grocery_id for ingredient in ingredients}
+    if grocery_pks:
+        #the Components and Recipes using a Grocery, and whether it can be deleted
+        touch(Grocery, pk__in=grocery_pks)
+
+def _components_changed(recipe_pks, component_pks):
+    if recipe_pks and component_pks:
+        touch(Recipe, pk__in=recipe_pks)
+        #whether a Component can be deleted, and the Recipes using a Grocery
+        touch(Component, pk__in=component_pks)
+        touch(Grocery, ingredient__for_component__in=component_pks)
+
+def _order_quantities_changed(order_quantities):
+    order_pks = {item.for_order_id for item in order_quantities}
+    if order_pks:
+        touch(Order, pk__in=order_pks)
+        #whether a Recipe can be deleted
+        touch(Recipe, pk__in={item.for_recipe_id for item in order_quantities})
+
+def _ingredient_saved(sender, instance, created, **kwargs):
+    if created:
+        _ingredients_changed([instance])
+
+def _ingredient_deleted(sender, instance, **kwargs):
+    _ingredients_changed([instance])
+
+def _order_quantity_saved(sender, instance, created, **kwargs):
+    if created:
+        _order_quantities_changed([instance])
+
+def _order_quantity_deleted(sender, instance, **kwargs):
+    _order_quantities_changed([instance])
+
+def _recipe_components_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        #the links are gone by post_clear
+        pk_set = set((instance.recipe_set if reverse else instance.components).values_list('pk', flat=True))
+    elif action not in ('post_add', 'post_remove'):
+        return
+    pk_set = pk_set or set()
+    if reverse:
+        _components_changed(pk_set, {instance.pk})
+    else:
+        _components_changed({instance.pk}, pk_set)
+
+def _recipe_deleted(sender, instance, **kwargs):
+    #deleting a Recipe removes its Component links without m2m_changed
+    _components_changed({instance.pk}, set(instance.components.values_list('pk', flat=True)))
+
+def _bulk_saved(sender, objects, **kwargs):
+    #created and updated rows are not told apart, since created rows may not
+    #have primary keys; moving a Grocery whose Ingredient only changed amount
+    #costs one unneeded page render
+    if sender is Ingredient:
+        _ingredients_changed(objects)
+    elif sender is OrderQuantity:
+        _order_quantities_changed(objects)
+
+def connect():
+    '''Keep the detail page validators current; called from BakeryConfig.ready()'''
+    for model in LISTINGS:
+        post_save.connect(_renamed, sender=model, dispatch_uid=f'dependents_renamed_{model.__name__}')
+    post_save.connect(_ingredient_saved, sender=Ingredient, dispatch_uid='dependents_ingredient_saved')
+    post_delete.connect(_ingredient_deleted, sender=Ingredient, dispatch_uid='dependents_ingredient_deleted')
+    post_save.connect(_order_quantity_saved, sender=OrderQuantity, dispatch_uid='dependents_order_quantity_saved')
+    post_delete.connect(_order_quantity_deleted, sender=OrderQuantity, dispatch_uid='dependents_order_quantity_deleted')
+    m2m_changed.connect(_recipe_components_changed, sender=Recipe.components.through, dispatch_uid='dependents_components')
+    pre_delete.connect(_recipe_deleted, sender=Recipe, dispatch_uid='dependents_recipe_deleted')
+    bulk_saved.connect(_bulk_saved, dispatch_uid='dependents_bulk')
@@ -3,23 +3,18 @@ from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
+from django.urls import reverse
+from django.utils.http import urlencode
 
-import re
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict
 
-from bakery.models import Grocery, Component, Recipe, Order
-
-UNIT_TYPES = (
-    ('ct', 'Count'),
-    ('p', 'Pinch'),
-    ('tsp', 'Teaspoon'),
-    ('tbsp', 'Tablespoon'),
-    ('floz', 'Fluid Ounce'),
-    ('C', 'Cup'),
-    ('pt', 'Pint'),
-    ('qt', 'Quart'),
-)
+from bakery.models import Grocery, Component, Recipe, Order, GroceryResolver, format_name, normalize_name
+from bakery.units import UNIT_TYPES, to_decimal
+from bakery.quantities import parse_quantity, parse_quantities
+from bakery.search import SEARCHES
+from bakery.fulltext import DOCUMENTS
 
 TYPES = (
     ('B', 'Baked'),
@@ -28,6 +23,75 @@ TYPES = (
     ('O', 'Other'),
 )
 
+class SearchChoiceField(forms.Field):
+    '''A choice of one or, if multiple is True, several objects of a
+    bakery.search kind, picked with a typeahead search instead of a select
+    element listing the whole table. Values are primary keys until the
+    form's clean() calls resolve_search_fields(). filters maps fields to the
+    values every choice must have.
+    '''
+    default_error_messages = {
+        'invalid_choice': _('Select a valid choice. That choice is not one of the available choices.'),
+    }
+
+    def __init__(self, kind, multiple=False, filters=None, **kwargs):
+        self.kind = kind
+        self.model = SEARCHES[kind][0]
+        self.multiple = multiple
+        self.filters = filters or {}
+        kwargs.setdefault('widget', forms.SelectMultiple if multiple else forms.Select)
+        super(SearchChoiceField, self).__init__(**kwargs)
+
+    def to_python(self, value):
+        values = value if self.multiple and value not in self.empty_values else [value]
+        try:
+            #edit views pass model instances as data
+            pks = [int(getattr(item, 'pk', item)) for item in values if item not in self.empty_values]
+        except (TypeError, ValueError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        if self.multiple:
+            return pks
+        return pks[0] if pks else None
+
+    def get_search_url(self):
+        url = reverse('bakery:search', args=(self.kind,))
+        return url + '?' + urlencode(self.filters) if self.filters else url
+
+    def accepts(self, item):
+        return all(getattr(item, field) == value for field, value in self.filters.items())
+
+def resolve_search_fields(form):
+    '''Replace the primary keys cleaned by each SearchChoiceField of a form
+    with the objects, loading the objects of each model with one pk__in
+    query, and add an error for any that do not exist or are not accepted
+    '''
+    fields = [(name, field) for name, field in form.fields.items()
+        if isinstance(field, SearchChoiceField) and form.cleaned_data.get(name) is not None]
+    pks = defaultdict(set)
+    for name, field in fields:
+        pks[field.model].update(form.cleaned_data[name] if field.multiple else [form.cleaned_data[name]])
+    objects = {model: model.objects.in_bulk(list(model_pks)) for model, model_pks in pks.items()}
+    for name, field in fields:
+        value = form.cleaned_data[name]
+        chosen = [objects[field.model].get(pk) for pk in (value if field.multiple else [value])]
+        if not all(item is not None and field.accepts(item) for item in chosen):
+            form.add_error(name, ValidationError(field.error_messages['invalid_choice'], code='invalid_choice'))
+        else:
+            form.cleaned_data[name] = chosen if field.multiple else chosen[0]
+
+def clean_unique_name(form, model, message):
+    '''Return the form's name formatted as it is saved, or raise a
+    ValidationError with message if another object of model has the same
+    normalized name. Renaming an object to a different case of its own name
+    is allowed.
+    '''
+    name = form.cleaned_data['name']
+    normalized = normalize_name(name)
+    if not form.editing or normalize_name(form.oldname) != normalized:
+        if model.objects.filter(normalized_name=normalized).exists():
+            raise forms.ValidationError(message, params={'name': name})
+    return format_name(name)
+
 class GroceryForm(forms.Form):
     name = forms.CharField(label='Ingredient name', max_length=120)
     cost = forms.DecimalField(label='Purchase price', max_digits=5, decimal_places=2, 
@@ -53,19 +117,7 @@ class GroceryForm(forms.Form):
             self.oldname = grocery_name
     
     def clean_name(self):
-        name = self.cleaned_data['name']
-        try:
-            if not self.editing or self.oldname.upper() != name.upper():
-                Grocery.objects.get(name__iexact=name)
-                raise forms.ValidationError(
-                    _("An ingredient named \"%(name)s\" already exists."),
-                    params={'name': name},
-                    )
-            else:
-                raise Grocery.DoesNotExist
-        except Grocery.DoesNotExist:
-            name = ' '.join(word[0].upper() + word[1:] for word in name.split())
-        return name
+        return clean_unique_name(self, Grocery, _("An ingredient named \"%(name)s\" already exists."))
     
     def clean_default_units(self):
         if self.cleaned_data['default_units'] == 'ct' and self.cleaned_data['units'] != 'ct':
@@ -79,84 +131,10 @@ def parse_str_to_decimal(str):
     Returns (False, "error message") if the given string is in an invalid format.
     Returns (True, Decimal) otherwise.    
     '''
-    message = '\"%(str)s\" is not formatted properly. Use a whole number, mixed number, fraction, or decimal (e.g. 2 1/4 or 2.25)'
-    str = str.strip()
-    number = Decimal(0)
-    #match not "/. 0123456789"
-    pattern = re.compile(r"[^\/\. \d]")
-    if pattern.search(str) is not None:
-        message = '\"%(str)s\" contains invalid characters. Use only the character \"/\" or \".\" and numbers.'
-        return(False, message)
-    #match "0123456789"
-    pattern = re.compile(r"[\d]")
-    if pattern.search(str) is None:
-        message = '\"%(str)s\" contains no numbers.'
-        return(False, message)
-    #match "."
-    pattern = re.compile(r"[\.]")
-    if pattern.search(str) is not None:
-        #check for excess "."
-        if str.count('.') > 1:
-            message = '\"%(str)s\" contains too many decimals. Only one is allowed.'
-            return(False, message)
-        #match " "
-        pattern = re.compile(r"[ ]")
-        if pattern.search(str) is not None:
-            message = '\"%(str)s\" contains invalid characters. Do not combine spaces with a decimal.'
-            return(False, message)
-        #match "/"
-        pattern = re.compile(r"[\/]")
-        if pattern.search(str) is not None:
-            message = '\"%(str)s\" contains invalid characters. Do not combine a slash with a decimal.'
-            return(False, message)
-        #check validity as decimal
-        try:
-            number = Decimal(str)
-        except Exception:
-            return(False, message)
-    else:
-        #match "/"
-        pattern = re.compile(r"[\/]")
-        if pattern.search(str) is not None:
-            #check for excess "/"
-            if str.count('/') > 1:
-                message = '\"%(str)s\" contains too many slashes. Only one is allowed.'
-                return(False, message)
-            #match " "
-            pattern = re.compile(r"[ ]")
-            if pattern.search(str) is not None:
-                #check for valid mixed number
-                #multiple spaces between the whole number and fraction are permitted
-                numbers = str.split(' ')
-                for char in numbers[1:-1]:
-                    if char != '':
-                        return(False, message)
-                try:
-                    whole_num = Decimal(numbers[0])
-                except Exception:
-                    return(False, message)
-                fraction = numbers[-1]
-            else:
-                whole_num = number #Decimal(0)
-                fraction = str
-            #check for valid fraction
-            numbers = fraction.split('/')
-            try:
-                numerator = Decimal(numbers[0])
-                denominator = Decimal(numbers[1])
-            except Exception:
-                return(False, message)
-            if denominator == 0:
-                message = '\"%(str)s\" cannot divide by zero.'
-                return(False, message)
-            number = whole_num + (numerator / denominator)
-        else:
-            #check valid whole number
-            try:
-                number = Decimal(str)
-            except Exception:
-                return(False, message)
-    return (True, number)
+    valid, number = parse_quantity(str)
+    if valid:
+        number = to_decimal(number)
+    return (valid, number)
 
 def validate_str_as_decimal(str):
     valid, message = parse_str_to_decimal(str)
@@ -169,7 +147,7 @@ def validate_str_as_decimal(str):
 class ComponentForm(forms.Form):
     name = forms.CharField(label='Component name', max_length=120)
     component_type = forms.ChoiceField(label='Component type', choices=TYPES)
-    groceries = forms.ModelMultipleChoiceField(label='Ingredients', queryset=Grocery.objects.all(), to_field_name="name")
+    groceries = SearchChoiceField('groceries', multiple=True, label='Ingredients')
     notes = forms.CharField(label='Notes', required=False, widget=forms.Textarea)
     units = forms.ChoiceField(label='Units', choices=UNIT_TYPES, required=False)
     editing = False
@@ -186,57 +164,62 @@ class ComponentForm(forms.Form):
             component_name = kwargs.pop('edit')
         except KeyError:
             is_editing = False
+        #shared with the view and template so each Grocery hash is looked up once
+        self.resolver = kwargs.pop('resolver', None) or GroceryResolver()
         super(ComponentForm, self).__init__(*args, **kwargs)
         if do_more:
             #add fields for each ingredient amount and unit
             for name in sorted(amounts):
                 amount_hash_id = amounts[name][0][0]
                 units_hash_id = amounts[name][1][0]
-                self.fields[amount_hash_id] = forms.CharField(label=amount_hash_id, max_length=10, validators=[validate_str_as_decimal])
+                #amounts are parsed together in clean()
+                self.fields[amount_hash_id] = forms.CharField(label=amount_hash_id, max_length=10)
                 self.fields[units_hash_id] = forms.ChoiceField(label=units_hash_id, choices=UNIT_TYPES)
         if is_editing:
             self.editing = True
             self.oldname = component_name
     
     def clean(self):
-        #validation for units in added fields
         cleaned_data = super().clean()
-        for field in cleaned_data:
-            if field.startswith('custom_units_'):
-                msg = ""
-                str = field.replace('custom_units_', '')
-                grocery = Grocery.objects.get(hash=str)
-                if cleaned_data[field] == 'ct' and grocery.units != 'ct':
-                    msg = "Cannot select 'Count' for an ingredient whose default units are not 'Count'"
-                    break
-                elif cleaned_data[field] != 'ct' and grocery.units == 'ct':
-                    msg = "The default units for this ingredient are 'Count'"
-                    break
+        resolve_search_fields(self)
+        #parse all ingredient amounts at once; the parsed values are kept in
+        #self.amounts for use by the view
+        amount_fields = [field for field in cleaned_data if field.startswith('custom_amount_')]
+        results = parse_quantities(cleaned_data[field] for field in amount_fields)
+        self.amounts = {}
+        for field in amount_fields:
+            valid, number = results[cleaned_data[field]]
+            if valid:
+                self.amounts[field] = to_decimal(number)
+            else:
+                self.add_error(field, forms.ValidationError(_(number), params={'str': cleaned_data[field]}))
+        #validation for units in added fields
+        msg = ""
+        units_fields = [field for field in cleaned_data if field.startswith('custom_units_')]
+        self.resolver.load(field.replace('custom_units_', '') for field in units_fields)
+        for field in units_fields:
+            msg = ""
+            str = field.replace('custom_units_', '')
+            grocery = self.resolver.get(str)
+            if cleaned_data[field] == 'ct' and grocery.units != 'ct':
+                msg = "Cannot select 'Count' for an ingredient whose default units are not 'Count'"
+                break
+            elif cleaned_data[field] != 'ct' and grocery.units == 'ct':
+                msg = "The default units for this ingredient are 'Count'"
+                break
         if msg:
             self.add_error(field, forms.ValidationError(_(msg)))
         return cleaned_data
     
     def clean_name(self):
-        name = self.cleaned_data['name']
-        try:
-            if not self.editing or self.oldname.upper() != name.upper():
-                Component.objects.get(name__iexact=name)
-                raise forms.ValidationError(
-                    _("A component named \"%(name)s\" already exists."),
-                    params={'name': name},
-                    )
-            else:
-                raise Component.DoesNotExist
-        except Component.DoesNotExist:
-            name = ' '.join(word[0].upper() + word[1:] for word in name.split())
-        return name
+        return clean_unique_name(self, Component, _("A component named \"%(name)s\" already exists."))
 
 class RecipeForm(forms.Form):
     name = forms.CharField(label='Recipe name', max_length=140)
-    component_baked = forms.ModelMultipleChoiceField(label='Baked components', queryset=Component.objects.filter(component_type='B'), to_field_name="name", required=False)
-    component_icing = forms.ModelMultipleChoiceField(label='Icing components', queryset=Component.objects.filter(component_type='I'), to_field_name="name", required=False)
-    component_decoration = forms.ModelMultipleChoiceField(label='Decoration components', queryset=Component.objects.filter(component_type='D'), to_field_name="name", required=False)
-    component_other = forms.ModelMultipleChoiceField(label='Other components', queryset=Component.objects.filter(component_type='O'), to_field_name="name", required=False)
+    component_baked = SearchChoiceField('components', multiple=True, filters={'component_type': 'B'}, label='Baked components', required=False)
+    component_icing = SearchChoiceField('components', multiple=True, filters={'component_type': 'I'}, label='Icing components', required=False)
+    component_decoration = SearchChoiceField('components', multiple=True, filters={'component_type': 'D'}, label='Decoration components', required=False)
+    component_other = SearchChoiceField('components', multiple=True, filters={'component_type': 'O'}, label='Other components', required=False)
     time_estimate = forms.CharField(label='Estimated time to complete (hours)', max_length=10, validators=[validate_str_as_decimal])
     image = forms.ImageField(label='Image (optional)', required=False)
     notes = forms.CharField(label='Notes', required=False, widget=forms.Textarea)
@@ -256,6 +239,8 @@ class RecipeForm(forms.Form):
 
     def clean(self):
         cleaned_data = super(RecipeForm, self).clean()
+        #load the Components of all four fields with one query
+        resolve_search_fields(self)
         component_baked = cleaned_data.get('component_baked')
         component_icing = cleaned_data.get('component_icing')
         component_decoration = cleaned_data.get('component_decoration')
@@ -267,26 +252,14 @@ class RecipeForm(forms.Form):
             self.add_error('component_baked', "At least one component must be selected.")
     
     def clean_name(self):
-        name = self.cleaned_data['name']
-        try:
-            if not self.editing or self.oldname.upper() != name.upper():
-                Recipe.objects.get(name__iexact=name)
-                raise forms.ValidationError(
-                    _("A recipe named \"%(name)s\" already exists."),
-                    params={'name': name},
-                    )
-            else:
-                raise Recipe.DoesNotExist
-        except Recipe.DoesNotExist:
-            name = ' '.join(word[0].upper() + word[1:] for word in name.split())
-        return name
+        return clean_unique_name(self, Recipe, _("A recipe named \"%(name)s\" already exists."))
 
     def clean_time_estimate(self):
         return parse_str_to_decimal(self.cleaned_data['time_estimate'])[1]
 
 class OrderForm(forms.Form):
     customer = forms.CharField(label='Customer name', max_length=120)
-    recipes = forms.ModelChoiceField(queryset=Recipe.objects.all(), empty_label="Select a recipe")
+    recipes = SearchChoiceField('recipes')
     delivery_date = forms.DateField()
     requires_delivery = forms.BooleanField(required=False, widget=forms.CheckboxInput)
     deposit = forms.IntegerField(required=False)
@@ -305,4 +278,36 @@ class OrderForm(forms.Form):
             #add fields for additional recipes
             for item in recipes:
                 if recipes[item] != '':
-                    self.fields[item] = forms.ModelChoiceField(queryset=Recipe.objects.all(), required=False, empty_label="Select a recipe")
+                    self.fields[item] = SearchChoiceField('recipes', required=False)
+
+    def clean(self):
+        cleaned_data = super(OrderForm, self).clean()
+        #load the Recipes of every row with one query
+        resolve_search_fields(self)
+        return cleaned_data
+
+class ShoppingListForm(forms.Form):
+    start = forms.DateField(label='First delivery date', required=False)
+    end = forms.DateField(label='Last delivery date', required=False)
+    format = forms.ChoiceField(choices=(('html', 'Page'), ('csv', 'CSV'), ('json', 'JSON')), required=False)
+
+    def clean(self):
+        cleaned_data = super(ShoppingListForm, self).clean()
+        #default to the coming week
+        if not cleaned_data.get('start'):
+            cleaned_data['start'] = timezone.localdate()
+        if not cleaned_data.get('end'):
+            cleaned_data['end'] = cleaned_data['start'] + timedelta(days=6)
+        if cleaned_data['end'] < cleaned_data['start']:
+            self.add_error('end', "The last delivery date must not be before the first.")
+        cleaned_data['format'] = cleaned_data.get('format') or 'html'
+        return cleaned_data
+
+class FullTextSearchForm(forms.Form):
+    q = forms.CharField(label='Search', max_length=200, required=False)
+    kind = forms.ChoiceField(choices=[('', 'Everything')] + [(kind, document[4] + 's') for kind, document in DOCUMENTS.items()],
+        required=False)
+    page = forms.IntegerField(min_value=1, required=False)
+
+    def clean_page(self):
+        return self.cleaned_data['page'] or 1
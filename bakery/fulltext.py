@@ -0,0 +1,262 @@
+'''Full-text search of the names and notes of Groceries, Components and
+Recipes, and the customer names and notes of Orders.
+
+On SQLite built with FTS5, the text is kept in the FTS5 table
+bakery_fulltext. The table is created, and filled if the models' tables
+exist, after migrate. It is updated from
+post_save, post_delete and bulk_saved in the transaction making the change,
+so a rolled back change never reaches the index. A document's rowid encodes
+its kind and primary key, so replacing or deleting one is a rowid lookup
+rather than a scan. Matches are ranked with bm25, weighting names above
+notes, and returned with the matched words highlighted. On other databases,
+or on SQLite without FTS5, search() falls back to LIKE queries on the
+models' tables. The rebuild_search_index command refills the index.
+'''
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.db.utils import OperationalError
+from django.urls import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from itertools import islice
+import re
+
+from bakery.models import Grocery, Component, Recipe, Order, normalize_name
+from bakery.signals import bulk_saved
+
+TABLE = 'bakery_fulltext'
+#kind: (model, title field, notes field or None, detail url name, label)
+DOCUMENTS = {
+    'groceries': (Grocery, 'name', None, 'bakery:grocery-detail', 'Ingredient'),
+    'components': (Component, 'name', 'notes', 'bakery:component-detail', 'Component'),
+    'recipes': (Recipe, 'name', 'notes', 'bakery:recipe-detail', 'Recipe'),
+    'orders': (Order, 'customer', 'notes', 'bakery:order-detail', 'Order'),
+}
+KINDS = tuple(DOCUMENTS)
+#bm25 weights of the title and notes columns
+TITLE_WEIGHT = 10.0
+NOTES_WEIGHT = 1.0
+#words of notes shown around the matches
+SNIPPET_WORDS = 12
+#characters of notes shown around the first match by the LIKE fallback
+SNIPPET_CHARACTERS = 80
+BATCH_SIZE = 500
+#placed around matched words by FTS5 and replaced with <mark> once the text
+#is escaped
+START, END = '\x02', '\x03'
+
+#database name: whether it has the index
+_indexed = {}
+
+def get_limit():
+    '''Return the most results returned for one page'''
+    return getattr(settings, 'BAKERY_FULLTEXT_LIMIT', 20)
+
+def _database():
+    return connection.settings_dict['NAME']
+
+def is_indexed():
+    '''Return whether the database has the FTS5 table'''
+    if _database() not in _indexed:
+        _indexed[_database()] = connection.vendor == 'sqlite' and TABLE in connection.introspection.table_names()
+    return _indexed[_database()]
+
+def create_index():
+    '''Create the FTS5 table if the database supports it and it does not
+    exist yet. Return True if it was created.
+    '''
+    if connection.vendor != 'sqlite' or is_indexed():
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE VIRTUAL TABLE {TABLE} USING fts5(title, notes, "
+                "tokenize='unicode61 remove_diacritics 2')")
+    except OperationalError:
+        #SQLite was built without FTS5, so search() uses LIKE queries
+        return False
+    _indexed[_database()] = True
+    return True
+
+def _rowid(kind, pk):
+    return pk * len(KINDS) + KINDS.index(kind)
+
+def _fields(kind):
+    model, title, notes, url_name, label = DOCUMENTS[kind]
+    return ['pk', title] + ([notes] if notes else [])
+
+def _document(kind, values):
+    '''Return the rowid, title and notes for the values of _fields(kind)'''
+    pk, title, *notes = values
+    return (_rowid(kind, pk), title, notes[0] if notes else '')
+
+def _store(documents):
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT OR REPLACE INTO {TABLE} (rowid, title, notes) VALUES (%s, %s, %s)', documents)
+
+def _remove(rowids):
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(rowid,) for rowid in rowids])
+
+def index(kind, pks):
+    '''Replace the documents of the objects of kind with the given primary
+    keys, removing those of objects that no longer exist
+    '''
+    if not is_indexed():
+        return
+    pks = set(pks)
+    model = DOCUMENTS[kind][0]
+    rows = list(model.objects.filter(pk__in=pks).values_list(*_fields(kind)))
+    _store([_document(kind, values) for values in rows])
+    _remove([_rowid(kind, pk) for pk in pks - {values[0] for values in rows}])
+
+def rebuild():
+    '''Replace the contents of the index with the documents of every object
+    and return the number indexed
+    '''
+    count = 0
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE}')
+        for kind in KINDS:
+            rows = DOCUMENTS[kind][0].objects.order_by().values_list(*_fields(kind)).iterator(chunk_size=BATCH_SIZE)
+            batch = list(islice(rows, BATCH_SIZE))
+            while batch:
+                _store([_document(kind, values) for values in batch])
+                count += len(batch)
+                batch = list(islice(rows, BATCH_SIZE))
+        with connection.cursor() as cursor:
+            #merge the index segments written by the inserts
+            cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return count
+
+def _words(query):
+    return re.findall(r'\w+', query)
+
+def _mark(text):
+    '''Escape text and replace the START and END placeholders with <mark>'''
+    return mark_safe(escape(text).replace(START, '<mark>').replace(END, '</mark>'))
+
+def _result(kind, pk, title, snippet):
+    model, title_field, notes_field, url_name, label = DOCUMENTS[kind]
+    return {
+        'kind': kind,
+        'label': label,
+        'id': pk,
+        'title': _mark(title),
+        'snippet': _mark(snippet),
+        'url': reverse(url_name, args=(pk,)),
+    }
+
+def _search_index(words, kinds, offset, limit):
+    #each word is quoted so that it is not read as FTS5 syntax, and matches
+    #as a prefix
+    expression = ' '.join(f'"{word}"*' for word in words)
+    sql = (f'SELECT rowid, highlight({TABLE}, 0, %s, %s), snippet({TABLE}, 1, %s, %s, %s, %s) '
+        f'FROM {TABLE} WHERE {TABLE} MATCH %s')
+    params = [START, END, START, END, '…', SNIPPET_WORDS, expression]
+    if len(kinds) < len(KINDS):
+        sql += f' AND rowid %% {len(KINDS)} IN ({", ".join(str(KINDS.index(kind)) for kind in kinds)})'
+    sql += f' ORDER BY bm25({TABLE}, {TITLE_WEIGHT}, {NOTES_WEIGHT}) LIMIT %s OFFSET %s'
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit, offset])
+        rows = cursor.fetchall()
+    return [_result(KINDS[rowid % len(KINDS)], rowid // len(KINDS), title, snippet) for rowid, title, snippet in rows]
+
+def _highlight(text, words):
+    pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+    return pattern.sub(lambda match: START + match.group() + END, text)
+
+def _excerpt(notes, words):
+    '''Return the part of notes around the first of the words found in it'''
+    found = [position for position in (notes.lower().find(word.lower()) for word in words) if position >= 0]
+    if not found:
+        return ''
+    start = max(min(found) - SNIPPET_CHARACTERS // 2, 0)
+    end = start + SNIPPET_CHARACTERS
+    return ('…' if start else '') + notes[start:end] + ('…' if end < len(notes) else '')
+
+def _search_tables(words, kinds, offset, limit):
+    matches = []
+    for kind in kinds:
+        model, title, notes, url_name, label = DOCUMENTS[kind]
+        queryset = model.objects.all()
+        in_title = Q()
+        for word in words:
+            in_title &= Q(**{f'{title}__icontains': word})
+            found = Q(**{f'{title}__icontains': word})
+            if notes:
+                found |= Q(**{f'{notes}__icontains': word})
+            queryset = queryset.filter(found)
+        #objects whose names contain every word come first
+        queryset = queryset.annotate(title_rank=Case(When(in_title, then=Value(0)), default=Value(1), output_field=IntegerField()))
+        for values in queryset.order_by('title_rank', title).values_list('title_rank', *_fields(kind))[:offset + limit]:
+            title_rank, pk, title_text, *notes_text = values
+            matches.append((title_rank, title_text.lower(), kind, pk, title_text, notes_text[0] if notes_text else ''))
+    matches.sort()
+    return [_result(kind, pk, _highlight(title_text, words), _highlight(_excerpt(notes_text, words), words))
+        for title_rank, key, kind, pk, title_text, notes_text in matches[offset:offset + limit]]
+
+def search(query, kinds=None, page=1, limit=None):
+    '''Return (results, has_next) for one page of the documents of the given
+    kinds (default all) matching every word of query, best match first. Each
+    result is a dictionary of the kind and its label, the primary key as
+    'id', the detail page url, and the title and a snippet of the notes as
+    safe HTML with the matched words in <mark> elements.
+    '''
+    words = _words(query)
+    if not words:
+        return [], False
+    kinds = [kind for kind in KINDS if kind in kinds] if kinds else list(KINDS)
+    limit = min(limit or get_limit(), get_limit())
+    offset = (page - 1) * limit
+    if is_indexed():
+        results = _search_index(words, kinds, offset, limit + 1)
+    else:
+        results = _search_tables(words, kinds, offset, limit + 1)
+    return results[:limit], len(results) > limit
+
+def _kind(model):
+    for kind, document in DOCUMENTS.items():
+        if document[0] is model:
+            return kind
+
+def _saved(sender, instance, **kwargs):
+    if is_indexed():
+        kind = _kind(sender)
+        _store([_document(kind, [getattr(instance, field) for field in _fields(kind)])])
+
+def _deleted(sender, instance, **kwargs):
+    if is_indexed():
+        _remove([_rowid(_kind(sender), instance.pk)])
+
+def _bulk_saved(sender, objects, **kwargs):
+    kind = _kind(sender)
+    if kind is None or not is_indexed():
+        return
+    #the bulk writes of this app change costs and images, not names or
+    #notes, so only rows created by bulk_create() need indexing; SQLite does
+    #not return their primary keys, so they are found by name
+    names = [normalize_name(item.name) for item in objects if item.pk is None and hasattr(item, 'normalized_name')]
+    if names:
+        index(kind, sender.objects.filter(normalized_name__in=names).values_list('pk', flat=True))
+
+def _migrated(sender, **kwargs):
+    if sender.name != 'bakery' or not create_index():
+        return
+    #migrate may run without creating the models' tables, e.g. while the app
+    #has no migrations; the tables are then empty once they exist, and the
+    #rebuild_search_index command fills the index of a restored database
+    tables = connection.introspection.table_names()
+    if all(document[0]._meta.db_table in tables for document in DOCUMENTS.values()):
+        rebuild()
+
+def connect():
+    '''Keep the index current; called from BakeryConfig.ready()'''
+    for model in (Grocery, Component, Recipe, Order):
+        post_save.connect(_saved, sender=model, dispatch_uid=f'fulltext_save_{model.__name__}')
+        post_delete.connect(_deleted, sender=model, dispatch_uid=f'fulltext_delete_{model.__name__}')
+    bulk_saved.connect(_bulk_saved, dispatch_uid='fulltext_bulk')
+    post_migrate.connect(_migrated, dispatch_uid='fulltext_migrate')
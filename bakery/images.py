@@ -0,0 +1,169 @@
+'''Content-addressed storage for Recipe images.
+
+An upload is stored once under the SHA-256 digest of its contents, so the
+same photo uploaded for several Recipes shares one set of files. Each
+StoredImage counts the Recipes using it, and release() removes its files
+only when that count reaches zero. Resized copies in WebP and in the
+original format are made by generate_derivatives(), normally from a
+ThumbnailJob (see bakery.thumbnails), for use in srcset attributes.
+'''
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from PIL import Image
+import hashlib
+import os
+
+from bakery.models import Recipe, StoredImage
+from bakery.signals import bulk_saved
+
+#extension of the stored original for each accepted upload format
+EXTENSIONS = {
+    'JPEG': 'jpg',
+    'MPO': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+    'WEBP': 'webp',
+}
+
+def open_image(source, size):
+    '''Open the image at the path source for reduction to fit within size.
+    JPEG images are decoded directly at a reduced scale, and images larger than
+    BAKERY_THUMBNAIL_MAX_PIXELS are rejected with ValueError before being
+    decoded. The caller must close the returned image.
+    '''
+    max_pixels = getattr(settings, 'BAKERY_THUMBNAIL_MAX_PIXELS', 40000000)
+    img = Image.open(source)
+    if img.width * img.height > max_pixels:
+        img.close()
+        raise ValueError(f'{source} is {img.width}x{img.height}, larger than {max_pixels} pixels')
+    #only has an effect for JPEG; decodes at the smallest scale >= size
+    img.draft(img.mode, size)
+    return img
+
+def store(upload):
+    '''Store an uploaded file, or reuse the existing copy of identical content,
+    and add a reference to it. Raises ValueError if the file is not an image.
+    Returns the StoredImage.
+    '''
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    stored = StoredImage.objects.filter(digest=digest).first()
+    if stored is None:
+        upload.seek(0)
+        try:
+            with Image.open(upload) as img:
+                width, height = img.size
+                extension = EXTENSIONS[img.format]
+        except Exception:
+            raise ValueError(f'"{upload.name}" is not a supported image file')
+        stored = StoredImage(digest=digest, extension=extension, width=width, height=height)
+        name = stored.get_original_name()
+        if not default_storage.exists(name):
+            upload.seek(0)
+            default_storage.save(name, upload)
+        try:
+            with transaction.atomic():
+                stored.save()
+        except IntegrityError:
+            #stored by a concurrent request
+            stored = StoredImage.objects.get(digest=digest)
+    StoredImage.objects.filter(pk=stored.pk).update(reference_count=F('reference_count') + 1)
+    stored.refresh_from_db()
+    return stored
+
+def release(stored):
+    '''Remove a reference to a StoredImage. When no references remain, the
+    record is deleted and its files are removed once the transaction commits.
+    '''
+    with transaction.atomic():
+        StoredImage.objects.filter(pk=stored.pk, reference_count__gt=0).update(
+            reference_count=F('reference_count') - 1)
+        stored = StoredImage.objects.select_for_update().get(pk=stored.pk)
+        if stored.reference_count == 0:
+            names = _file_names(stored)
+            stored.delete()
+            transaction.on_commit(lambda: _delete_files(names))
+
+def discard(stored):
+    '''Remove the files of a StoredImage whose record was rolled back with
+    the transaction that stored it, unless the same content is stored by
+    another record
+    '''
+    if not StoredImage.objects.filter(digest=stored.digest).exists():
+        _delete_files(_file_names(stored))
+
+def _file_names(stored):
+    names = [stored.get_original_name()]
+    for size in StoredImage.SIZES:
+        names += [stored.get_derivative_name(size), stored.get_derivative_name(size, 'webp')]
+    return names
+
+def _delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+def release_image(stored, name):
+    '''Release the image a Recipe no longer uses, given the Recipe's former
+    stored_image and image name. Images uploaded before the content-addressed
+    store existed have no StoredImage and are deleted directly along with
+    their thumbnail.
+    '''
+    if stored is not None:
+        release(stored)
+    else:
+        default_storage.delete(name)
+        default_storage.delete('thumbnails/' + name.rsplit('/', 1)[-1])
+
+def get_derivative_paths(stored):
+    '''Return (size, path) for every resized copy of a StoredImage'''
+    paths = []
+    for size in StoredImage.SIZES:
+        for extension in (stored.extension, 'webp'):
+            paths.append((size, default_storage.path(stored.get_derivative_name(size, extension))))
+    return paths
+
+def write_derivatives(source, outputs, force=False):
+    '''Write resized copies of the image at the path source to each (size,
+    path) in outputs, decoding the source once. Outputs newer than the source
+    are skipped unless force is True. Only uses the filesystem, so it can run
+    in a separate process. Returns the number of files written.
+    '''
+    if not force:
+        modified = os.path.getmtime(source)
+        outputs = [(size, path) for size, path in outputs
+            if not os.path.exists(path) or os.path.getmtime(path) < modified]
+    if not outputs:
+        return 0
+    largest = max(size for size, path in outputs)
+    with open_image(source, (largest, largest)) as img:
+        img.load()
+        for size, path in sorted(outputs, reverse=True):
+            copy = img.copy()
+            copy.thumbnail((size, size), reducing_gap=2.0)
+            if path.endswith('.webp') and copy.mode not in ('RGB', 'RGBA'):
+                copy = copy.convert('RGBA' if 'A' in copy.mode or 'transparency' in copy.info else 'RGB')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            copy.save(path)
+    return len(outputs)
+
+def generate_derivatives(stored):
+    '''Create any missing or out of date resized copies of a StoredImage in
+    WebP and in its original format, and mark it as ready
+    '''
+    write_derivatives(default_storage.path(stored.get_original_name()), get_derivative_paths(stored))
+    if not stored.derivatives_ready:
+        StoredImage.objects.filter(pk=stored.pk).update(derivatives_ready=True)
+        stored.derivatives_ready = True
+        #Recipe pages show the resized copies once they are ready
+        Recipe.objects.filter(stored_image=stored).update(updated_at=timezone.now())
+        bulk_saved.send(sender=StoredImage, objects=[stored])
+
+def get_thumbnail_url(stored):
+    '''Return the URL of the thumbnail-sized copy of a StoredImage'''
+    return default_storage.url(stored.get_derivative_name(StoredImage.THUMBNAIL_SIZE))
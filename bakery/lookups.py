@@ -0,0 +1,69 @@
+'''Versioned JSON lookup tables used by the scripts of the order forms, so
+that each client downloads the Recipe names once instead of with every page
+and form row.
+
+A table's version is the page_cache generation of its model, so it changes
+whenever a row is saved or deleted. Pages link to the table with its version
+in the query string; a response to the current version is cacheable for a
+year, and any other request must be revalidated with its strong ETag. The
+JSON is kept in the cache for each version, so requests only query the
+database after a change.
+'''
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+import json
+
+from bakery import page_cache
+from bakery.models import Recipe
+
+#seconds a response for the current version may be reused without revalidation
+MAX_AGE = 365 * 24 * 60 * 60
+
+def _recipe_names():
+    '''List the primary key and name of each Recipe in order of name'''
+    return {'recipes': list(Recipe.objects.values_list('pk', 'name'))}
+
+#name: (model, function returning the table, url name)
+TABLES = {
+    'recipes': (Recipe, _recipe_names, 'bakery:lookup-recipes'),
+}
+
+def get_version(name):
+    return page_cache.table_version(TABLES[name][0])
+
+def get_url(name):
+    '''Return the URL of the current version of a table'''
+    return f'{reverse(TABLES[name][2])}?v={get_version(name)}'
+
+def get_content(name, version):
+    '''Return the JSON for a table, from the cache if this version was
+    already serialized
+    '''
+    cache = page_cache.get_cache()
+    key = f'bakery:lookup:{name}:{version}'
+    content = cache.get(key)
+    if content is None:
+        table = TABLES[name][1]()
+        table['version'] = version
+        content = json.dumps(table, separators=(',', ':'))
+        cache.set(key, content, page_cache.get_timeout())
+    return content
+
+def response(request, name):
+    '''Return the table as JSON, or a 304 response if the client's copy is
+    current
+    '''
+    version = get_version(name)
+    etag = quote_etag(f'{name}-{version}')
+    result = get_conditional_response(request, etag=etag)
+    if result is None:
+        result = HttpResponse(get_content(name, version), content_type='application/json')
+    result['ETag'] = etag
+    if request.GET.get('v') == str(version):
+        patch_cache_control(result, private=True, max_age=MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(result, private=True, no_cache=True)
+    return result
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from bakery import page_cache
+
+class Command(BaseCommand):
+    help = ('Show the page and fragment cache hit and miss counts. The counts are kept in the cache, '
+        'so a per-process backend such as locmem only shows those of this process.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='set the counts to zero after showing them')
+
+    def handle(self, *args, **options):
+        counts = page_cache.stats()
+        for kind in ('page', 'fragment'):
+            hits = counts[f'{kind}_hits']
+            total = hits + counts[f'{kind}_misses']
+            ratio = hits / total if total else 0
+            self.stdout.write(f'{kind.capitalize()}s: {hits} hits, {total - hits} misses ({ratio:.1%} hit rate)')
+        if options['reset']:
+            page_cache.reset_stats()
@@ -0,0 +1,129 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+import re
+from decimal import Decimal, InvalidOperation
+from time import perf_counter
+
+from bakery.models import Grocery, propagate_costs, format_name, normalize_name
+from bakery.signals import bulk_saved
+from bakery.units import UNIT_TYPES
+from bakery.forms import parse_str_to_decimal
+
+#e.g. "Flour, AP 2.48 18C" or "Butter, Unsalted 3.98 1 1/2C"
+PRICE_LINE = re.compile(
+    r"^(?P<name>.+?)\s+(?P<cost>\d+(?:\.\d+)?)\s+(?P<amount>[\d\.\/][\d\.\/ ]*?)\s*(?P<units>"
+    + '|'.join(units for units, label in UNIT_TYPES) + r")$"
+)
+
+def parse_price_line(line):
+    '''Split a line of a price sheet into (name, cost, cost_amount, units).
+    Raises ValueError with a description of the problem if the line is invalid.
+    '''
+    match = PRICE_LINE.match(line.strip())
+    if match is None:
+        raise ValueError('expected "Name cost amount+units"')
+    name = format_name(match.group('name'))
+    try:
+        cost = Decimal(match.group('cost')).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'"{match.group("cost")}" is not a valid cost')
+    success, amount = parse_str_to_decimal(match.group('amount'))
+    if not success:
+        raise ValueError(amount % {'str': match.group('amount')})
+    amount = amount.quantize(Decimal('0.001'))
+    if amount <= 0:
+        raise ValueError('amount must be greater than zero')
+    return name, cost, amount, match.group('units')
+
+class Command(BaseCommand):
+    help = ('Import grocery prices from a price sheet with one "Name cost amount+units" '
+            'entry per line, e.g. "Flour, AP 2.48 18C"')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='price sheet to import')
+        parser.add_argument('--dry-run', action='store_true',
+            help='report the changes that would be made without saving them')
+
+    def handle(self, *args, **options):
+        timings = []
+
+        #parse: stream the file, keeping the last entry for each name
+        start = perf_counter()
+        entries = {}
+        skipped = 0
+        try:
+            with open(options['path'], encoding='utf-8') as sheet:
+                for number, line in enumerate(sheet, 1):
+                    if not line.strip() or line.lstrip().startswith('#'):
+                        continue
+                    try:
+                        name, cost, amount, units = parse_price_line(line)
+                    except ValueError as error:
+                        skipped += 1
+                        if options['verbosity'] > 0:
+                            self.stderr.write(f'line {number} skipped: {error}: {line.strip()}')
+                        continue
+                    entries[normalize_name(name)] = (name, cost, amount, units)
+        except OSError as error:
+            raise CommandError(f'Unable to read "{options["path"]}": {error}')
+        timings.append(('parse', perf_counter() - start))
+
+        #load: find existing Groceries with a single query
+        start = perf_counter()
+        existing = {}
+        for grocery in Grocery.objects.filter(normalized_name__in=list(entries)):
+            existing[grocery.normalized_name] = grocery
+        timings.append(('load', perf_counter() - start))
+
+        #compute: unit cost and hash for every new or changed Grocery in one pass
+        start = perf_counter()
+        created = []
+        changed = []
+        for key, (name, cost, amount, units) in entries.items():
+            grocery = existing.get(key)
+            if grocery is None:
+                grocery = Grocery(name=name, cost=cost, cost_amount=amount, units=units, default_units=units)
+                created.append(grocery)
+            elif (grocery.cost, grocery.cost_amount, grocery.units) != (cost, amount, units):
+                old = f'{grocery.cost} {grocery.cost_amount.normalize():f}{grocery.units}'
+                grocery.cost = cost
+                grocery.cost_amount = amount
+                grocery.units = units
+                if units == 'ct' or grocery.default_units == 'ct':
+                    grocery.default_units = units
+                changed.append((grocery, old))
+            else:
+                continue
+            grocery._calculate_values()
+        timings.append(('compute', perf_counter() - start))
+
+        for grocery in created:
+            self.stdout.write(f'+ {grocery.name}: {grocery.cost} {grocery.cost_amount.normalize():f}{grocery.units}')
+        for grocery, old in changed:
+            self.stdout.write(f'~ {grocery.name}: {old} -> {grocery.cost} {grocery.cost_amount.normalize():f}{grocery.units}')
+
+        if not options['dry_run']:
+            #write: one bulk insert and one bulk update, then a single propagation
+            #for every Component, Recipe and Order affected by any price change
+            with transaction.atomic():
+                start = perf_counter()
+                Grocery.objects.bulk_create(created)
+                now = timezone.now()
+                for grocery, old in changed:
+                    grocery.updated_at = now
+                Grocery.objects.bulk_update([grocery for grocery, old in changed],
+                    ['cost', 'cost_amount', 'units', 'default_units', 'unit_cost', 'updated_at'])
+                bulk_saved.send(sender=Grocery, objects=created + [grocery for grocery, old in changed])
+                timings.append(('write', perf_counter() - start))
+                start = perf_counter()
+                propagate_costs(groceries=[grocery for grocery, old in changed])
+                timings.append(('propagate', perf_counter() - start))
+
+        summary = f'{len(entries)} entries: {len(created)} new, {len(changed)} changed, {skipped} skipped'
+        if options['dry_run']:
+            summary += ' (dry run, nothing saved)'
+        self.stdout.write(summary)
+        for phase, seconds in timings:
+            self.stdout.write(f'  {phase:<10} {seconds * 1000:10.1f} ms')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from time import perf_counter
+
+from bakery.models import ThumbnailJob
+from bakery import thumbnails
+
+class Command(BaseCommand):
+    help = 'Create the thumbnail for every unfinished ThumbnailJob in this process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', action='store_true',
+            help='only report the number of unfinished jobs')
+
+    def handle(self, *args, **options):
+        if options['status']:
+            self.stdout.write(f'{thumbnails.queue_depth()} unfinished thumbnail jobs')
+            return
+        thumbnails.reset_stale_jobs()
+        start = perf_counter()
+        processed = 0
+        for job_pk in ThumbnailJob.objects.filter(status=ThumbnailJob.PENDING).values_list('pk', flat=True):
+            if thumbnails.process(job_pk):
+                processed += 1
+        elapsed = perf_counter() - start
+        failed = ThumbnailJob.objects.filter(status=ThumbnailJob.FAILED).count()
+        self.stdout.write(f'Processed {processed} thumbnail jobs in {elapsed:.2f}s; '
+            f'{failed} failed jobs in total, {thumbnails.queue_depth()} unfinished')
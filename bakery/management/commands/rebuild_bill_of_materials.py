@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from time import perf_counter
+
+from bakery.models import RecipeGrocery, refresh_bill_of_materials
+
+class Command(BaseCommand):
+    help = 'Recalculate the total amount and cost of each Grocery used by every Recipe'
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        written = refresh_bill_of_materials()
+        elapsed = perf_counter() - start
+        self.stdout.write(f'Rebuilt bill of materials: {RecipeGrocery.objects.count()} rows, '
+            f'{written} written in {elapsed * 1000:.1f} ms')
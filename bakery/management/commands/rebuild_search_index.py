@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from time import perf_counter
+
+from bakery import fulltext
+
+class Command(BaseCommand):
+    help = ('Create the full-text search index if it does not exist and fill it with the names and notes '
+            'of every Grocery, Component, Recipe and Order, e.g. after restoring a database.')
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        fulltext.create_index()
+        if not fulltext.is_indexed():
+            raise CommandError('The full-text index requires SQLite with FTS5; '
+                'search uses LIKE queries on this database instead')
+        count = fulltext.rebuild()
+        self.stdout.write(f'Indexed {count} documents in {perf_counter() - start:.2f}s')
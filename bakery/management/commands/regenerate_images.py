@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+import django
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+import os
+
+from bakery.models import Recipe, StoredImage
+from bakery import images, thumbnails
+from bakery.signals import bulk_saved
+
+#Recipes whose image_thumb changed are saved in batches of this size
+UPDATE_BATCH = 500
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError(value)
+    return value
+
+class Command(BaseCommand):
+    help = ('Create the resized copies of every uploaded Recipe image again, e.g. after the '
+            'thumbnail sizes or formats change. Copies newer than their original are skipped, '
+            'so an interrupted run can be repeated.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=positive_int, default=os.cpu_count() or 1,
+            help='number of processes resizing images (default: number of CPUs)')
+        parser.add_argument('--force', action='store_true',
+            help='write every copy even if it is newer than its original')
+        parser.add_argument('--chunk-size', type=positive_int, default=100,
+            help='number of Recipes read from the database at a time (default 100)')
+
+    def get_tasks(self, chunk_size):
+        '''Yield (key, source, outputs, thumb_url, recipe pks) for each image,
+        reading Recipes in chunks. Recipes sharing a StoredImage are grouped.
+        '''
+        recipes = (Recipe.objects.filter(user_uploaded_image=True)
+            .select_related('stored_image').only('pk', 'image', 'stored_image').order_by('stored_image', 'pk'))
+        task = None
+        for recipe in recipes.iterator(chunk_size=chunk_size):
+            stored = recipe.stored_image
+            if stored is not None and task is not None and task[0] == stored.pk:
+                task[4].append(recipe.pk)
+                continue
+            if task is not None:
+                yield task
+            if stored is not None:
+                task = (stored.pk, default_storage.path(stored.get_original_name()),
+                    images.get_derivative_paths(stored), images.get_thumbnail_url(stored), [recipe.pk])
+            else:
+                #uploaded before the content-addressed store; only has a thumbnail
+                name = thumbnails.thumbnail_name(recipe.image.name)
+                task = (None, default_storage.path(recipe.image.name),
+                    [(max(thumbnails.THUMBNAIL_SIZE), default_storage.path(name))],
+                    settings.MEDIA_URL + name, [recipe.pk])
+        if task is not None:
+            yield task
+
+    def handle(self, *args, **options):
+        verbose = options['verbosity'] > 1
+        workers = options['workers']
+        start = perf_counter()
+        processed = written = failed = 0
+        ready = []
+        thumbs = {}
+
+        def collect(done):
+            nonlocal processed, written, failed
+            for future in done:
+                stored_pk, source, outputs, thumb_url, recipe_pks = pending.pop(future)
+                processed += 1
+                try:
+                    count = future.result()
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f'{source} skipped: {error}')
+                    continue
+                written += count
+                if verbose and count:
+                    self.stdout.write(f'{source}: {count} files written')
+                if stored_pk is not None:
+                    ready.append(stored_pk)
+                for pk in recipe_pks:
+                    thumbs[pk] = thumb_url
+
+        #keep a bounded number of images queued so memory use does not grow
+        #with the number of Recipes
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            for task in self.get_tasks(options['chunk_size']):
+                if len(pending) >= workers * 4:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(images.write_derivatives, task[1], task[2], options['force'])
+                pending[future] = task
+            collect(wait(pending)[0])
+
+        for index in range(0, len(ready), UPDATE_BATCH):
+            batch = ready[index:index + UPDATE_BATCH]
+            StoredImage.objects.filter(pk__in=batch, derivatives_ready=False).update(derivatives_ready=True)
+            #Recipe pages show the resized copies once they are ready
+            Recipe.objects.filter(stored_image__in=batch).update(updated_at=timezone.now())
+            bulk_saved.send(sender=StoredImage, objects=[StoredImage(pk=pk) for pk in batch])
+        recipe_pks = list(thumbs)
+        changed = 0
+        now = timezone.now()
+        for index in range(0, len(recipe_pks), UPDATE_BATCH):
+            batch = []
+            for recipe in Recipe.objects.filter(pk__in=recipe_pks[index:index + UPDATE_BATCH]).only('pk', 'image_thumb'):
+                if recipe.image_thumb != thumbs[recipe.pk]:
+                    recipe.image_thumb = thumbs[recipe.pk]
+                    recipe.updated_at = now
+                    batch.append(recipe)
+            Recipe.objects.bulk_update(batch, ['image_thumb', 'updated_at'])
+            if batch:
+                bulk_saved.send(sender=Recipe, objects=batch)
+            changed += len(batch)
+
+        elapsed = perf_counter() - start
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write(f'Processed {processed} images with {workers} workers in {elapsed:.2f}s '
+            f'({rate:.1f} images/s): {written} files written, {failed} failed, '
+            f'{changed} thumbnails updated')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from datetime import date
+from time import perf_counter
+
+from bakery.models import Order, reprice_orders
+
+class Command(BaseCommand):
+    help = 'Recalculate the quoted price and deposit of every Order delivered on or after a date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, default=None,
+            help='first delivery date to reprice as YYYY-MM-DD (default: today)')
+
+    def handle(self, *args, **options):
+        from_date = options['from_date'] or date.today()
+        start = perf_counter()
+        orders = Order.objects.filter(delivery_date__gte=from_date)
+        changed = reprice_orders(orders)
+        elapsed = perf_counter() - start
+        if options['verbosity'] > 1:
+            for order in changed:
+                self.stdout.write(f'{order.pk}: ${order.quoted_price} (deposit ${order.deposit})')
+        self.stdout.write(f'Repriced orders from {from_date.isoformat()}: '
+            f'{len(changed)} changed in {elapsed * 1000:.1f} ms')
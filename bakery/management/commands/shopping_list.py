@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from datetime import date, timedelta
+from time import perf_counter
+
+from bakery import shopping
+
+class Command(BaseCommand):
+    help = 'Write the groceries needed for every Order delivered in a range of dates as CSV or JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, default=None,
+            help='first delivery date as YYYY-MM-DD (default: today)')
+        parser.add_argument('--to', dest='to_date', type=date.fromisoformat, default=None,
+            help='last delivery date as YYYY-MM-DD (default: 6 days after --from)')
+        parser.add_argument('--format', choices=('csv', 'json'), default='csv',
+            help='output format (default: csv)')
+
+    def handle(self, *args, **options):
+        start = options['from_date'] or timezone.localdate()
+        end = options['to_date'] or start + timedelta(days=6)
+        if end < start:
+            raise CommandError('--to must not be before --from')
+        begin = perf_counter()
+        rows = shopping.shopping_list(start, end)
+        if options['format'] == 'json':
+            chunks = shopping.json_chunks(rows, start, end)
+        else:
+            chunks = shopping.csv_lines(rows)
+        for chunk in chunks:
+            self.stdout.write(chunk, ending='')
+        if options['verbosity'] > 1:
+            self.stderr.write(f'Shopping list written in {(perf_counter() - begin) * 1000:.1f} ms')
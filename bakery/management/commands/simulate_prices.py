@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from time import perf_counter
+
+from bakery.models import Grocery
+from bakery import simulator
+
+def grocery_change(value):
+    '''Parse "Name=1.2" (multiply the unit cost) or "Name=$0.45" (set it)'''
+    name, separator, change = value.rpartition('=')
+    if not separator or not name.strip():
+        raise ValueError(value)
+    if change.startswith('$'):
+        return name.strip(), 'unit_cost', float(change[1:])
+    return name.strip(), 'multiplier', float(change)
+
+class Command(BaseCommand):
+    help = ('Show how Recipe prices and upcoming Order quotes would change with different '
+            'Grocery unit costs, without saving anything')
+
+    def add_arguments(self, parser):
+        parser.add_argument('changes', nargs='+', type=grocery_change, metavar='NAME=CHANGE',
+            help='a Grocery and either a factor for its unit cost, e.g. "Butter=1.2", '
+                 'or a new unit cost, e.g. "Eggs=$0.25"')
+
+    def handle(self, *args, **options):
+        if not simulator.numpy_available():
+            raise CommandError('simulate_prices requires NumPy')
+        unit_costs = {}
+        multipliers = {}
+        for name, kind, value in options['changes']:
+            (unit_costs if kind == 'unit_cost' else multipliers)[name] = value
+        start = perf_counter()
+        prices = simulator.PriceSimulator()
+        loaded = perf_counter()
+        try:
+            baseline = prices.simulate()
+            simulation = prices.simulate(unit_costs, multipliers)
+        except Grocery.DoesNotExist as error:
+            raise CommandError(error)
+        finished = perf_counter()
+        for pk, name, old_cost, cost, old_price, price in simulation.recipe_changes(baseline):
+            self.stdout.write(f'Recipe {name}: cost ${old_cost:.2f} -> ${cost:.2f}, price ${old_price} -> ${price}')
+        for pk, customer, old_price, price, old_deposit, deposit in simulation.order_changes(baseline):
+            self.stdout.write(f'Order {pk} for {customer}: quote ${old_price} -> ${price}, '
+                f'deposit ${old_deposit} -> ${deposit}')
+        self.stdout.write(f'Simulated {len(prices.recipe_pks)} recipes and {len(prices.order_pks)} orders: '
+            f'loaded in {(loaded - start) * 1000:.1f} ms, priced in {(finished - loaded) * 1000:.1f} ms')
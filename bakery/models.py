@@ -1,46 +1,159 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, When, Value, F, Sum, ExpressionWrapper
+from django.db.models.functions import Coalesce
 from django.forms import ModelForm
 from django.utils import timezone
 from django.conf import settings
+from django.core.files.storage import default_storage
 
 from decimal import Decimal
 from math import ceil
 import hashlib
 from datetime import date
+from fractions import Fraction
+from collections import defaultdict
 
-UNIT_TYPES = (
-    ('ct', 'Count'),
-    ('p', 'Pinch'),
-    ('tsp', 'Teaspoon'),
-    ('tbsp', 'Tablespoon'),
-    ('floz', 'Fluid Ounce'),
-    ('C', 'Cup'),
-    ('pt', 'Pint'),
-    ('qt', 'Quart'),
-)
+from bakery import units
+from bakery.signals import bulk_saved
+from bakery.units import UNIT_TYPES
 
 ONE = Decimal(1)
+#Ingredient.amount and the Recipe times are stored with 3 decimal places
+AMOUNT_PLACES = Decimal('0.001')
+ZERO_COST = Value(Decimal(0), output_field=models.DecimalField(max_digits=5, decimal_places=2))
+#kept for code that expects Decimal ratios; prefer the functions in bakery.units
 CONVERSIONS = {
-    "p":    {"p": ONE, "tsp": ONE/Decimal(8), "tbsp": ONE/Decimal(24), "floz": ONE/Decimal(48), "C": ONE/Decimal(384), "pt": ONE/Decimal(768), "qt": ONE/Decimal(1536)},
-    "tsp":  {"p": Decimal(8), "tsp": ONE, "tbsp": ONE/Decimal(3), "floz": ONE/Decimal(6), "C": ONE/Decimal(48), "pt": ONE/Decimal(96), "qt": ONE/Decimal(192)},
-    "tbsp": {"p": Decimal(24), "tsp": Decimal(3), "tbsp": ONE, "floz": ONE/Decimal(2), "C": ONE/Decimal(16), "pt": ONE/Decimal(32), "qt": ONE/Decimal(64)},
-    "floz": {"p": Decimal(48), "tsp": Decimal(6), "tbsp": Decimal(2), "floz": ONE, "C": ONE/Decimal(8), "pt": ONE/Decimal(16), "qt": ONE/Decimal(32)},
-    "C": {"p": Decimal(384), "tsp": Decimal(48), "tbsp": Decimal(16), "floz": Decimal(8), "C": ONE, "pt": ONE/Decimal(2), "qt": ONE/Decimal(4)},
-    "pt": {"p": Decimal(768), "tsp": Decimal(96), "tbsp": Decimal(32), "floz": Decimal(16), "C": Decimal(2), "pt": ONE, "qt": ONE/Decimal(2)},
-    "qt": {"p": Decimal(1536), "tsp": Decimal(192), "tbsp": Decimal(64), "floz": Decimal(32), "C": Decimal(4), "pt": Decimal(2), "qt": ONE},
+    from_units: {to_units: units.to_decimal(units.factor(from_units, to_units)) for to_units in units.PINCHES}
+    for from_units in units.PINCHES
 }
 
-class Grocery(models.Model):
+def pinches_expression(prefix='', count=1):
+    '''Return an expression for the number of pinches in one of an
+    Ingredient's units, or count if its units are Count. prefix is the lookup
+    path from the queried model to Ingredient.
+    '''
+    return Case(
+        *[When(**{prefix + 'units': unit, 'then': Value(pinches)}) for unit, pinches in units.PINCHES.items()],
+        default=Value(count),
+        output_field=models.IntegerField(),
+    )
+
+def ingredient_cost_expression(prefix=''):
+    '''Return an expression equal to Ingredient.get_cost() so that costs can be
+    calculated and summed by the database. prefix is the lookup path from the
+    queried model to Ingredient, e.g. 'ingredient__' when querying Components.
+    '''
+    #a Count uses the pinches in a cup so that it cancels out below
+    pinches = pinches_expression(prefix, count=units.PINCHES['C'])
+    #a divisor with a decimal point prevents integer division on SQLite, which
+    #stores whole-number decimals as integers
+    pinches_per_cup = Value(Decimal(units.PINCHES['C']).quantize(Decimal('0.1')), output_field=models.DecimalField())
+    return ExpressionWrapper(
+        F(prefix + 'amount') * F(prefix + 'for_grocery__unit_cost') * pinches / pinches_per_cup,
+        output_field=models.DecimalField(max_digits=5, decimal_places=2),
+    )
+
+def grocery_hash(name):
+    '''Return the value of Grocery.hash for a Grocery with the given name'''
+    #hash will be used as a CSS class, so ensure it begins with a letter
+    return 'a' + hashlib.md5(name.encode('utf-8')).hexdigest()
+
+def format_name(name):
+    '''Return name as it is saved: whitespace collapsed and the first letter of
+    each word capitalized
+    '''
+    return ' '.join(word[0].upper() + word[1:] for word in name.split())
+
+#casefold() turns one character into as many as three, e.g. 'ΐ', so a
+#normalized_name column is CASEFOLD_GROWTH times as long as the name column
+CASEFOLD_GROWTH = 3
+
+def normalize_name(name):
+    '''Return the value of normalized_name for a Grocery, Component or Recipe
+    with the given name. Names that differ only in case or whitespace have the
+    same normalized name, so its unique index catches them.
+    '''
+    return ' '.join(name.casefold().split())
+
+class FieldTracking:
+    '''Remembers the values of tracked_fields an object was loaded or last
+    saved with, so that post_save and bulk_saved receivers can tell which of
+    them changed, e.g. whether save() renamed it. Models call
+    remember_fields() at the end of save().
+    '''
+    tracked_fields = ('name',)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_fields()
+        return instance
+
+    def remember_fields(self):
+        #deferred fields are left out
+        self._saved_fields = {field: self.__dict__[field] for field in self.tracked_fields if field in self.__dict__}
+
+    def has_changed(self, field):
+        '''Return whether field may differ from the value it was loaded or
+        last saved with
+        '''
+        saved = getattr(self, '_saved_fields', None)
+        if saved is None:
+            #never loaded or saved, e.g. created by bulk_create()
+            return True
+        if field not in saved:
+            #a deferred field changes only if it is assigned
+            return field in self.__dict__
+        return saved[field] != getattr(self, field)
+
+    def was_renamed(self):
+        return self.has_changed('name')
+
+class GroceryResolver:
+    '''Maps Grocery.hash values, such as those in the names of the dynamic
+    custom_amount_<hash> and custom_units_<hash> component form fields, to
+    Groceries. Hashes passed to load() are fetched with a single hash__in
+    query and cached, so a resolver shared by the view, form and template of
+    one request resolves each hash once.
+    '''
+    def __init__(self, hashes=()):
+        self.groceries = {}
+        self.missing = set()
+        self.load(hashes)
+
+    def add(self, groceries):
+        '''Cache Groceries that have already been fetched'''
+        for grocery in groceries:
+            self.groceries[grocery.hash] = grocery
+
+    def load(self, hashes):
+        hashes = set(hashes) - self.groceries.keys() - self.missing
+        if hashes:
+            self.add(Grocery.objects.filter(hash__in=hashes))
+            self.missing.update(hashes - self.groceries.keys())
+
+    def get(self, hash):
+        self.load([hash])
+        try:
+            return self.groceries[hash]
+        except KeyError:
+            raise Grocery.DoesNotExist(f'No Grocery has the hash "{hash}"')
+
+class Grocery(FieldTracking, models.Model):
     '''An item used in a Component. The unit cost is calculated in terms of
     dollars per cup unless the base unit is Count.
     '''
     name = models.CharField(max_length=120, unique=True)
+    #see normalize_name(); used for uniqueness checks and lookups by name
+    normalized_name = models.CharField(max_length=120 * CASEFOLD_GROWTH, unique=True, editable=False)
     cost = models.DecimalField(max_digits=5, decimal_places=2)
     cost_amount = models.DecimalField(max_digits=7, decimal_places=3)
     units = models.CharField(max_length=4, choices=UNIT_TYPES)
     default_units = models.CharField(max_length=4, choices=UNIT_TYPES)
     unit_cost = models.DecimalField(max_digits=10, decimal_places=6, default=0)
-    hash = models.CharField(max_length=33, default='a')
+    hash = models.CharField(max_length=33, unique=True)
+    #moves whenever this Grocery's detail page may change; see propagate_costs()
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["name"]
@@ -49,23 +162,34 @@ class Grocery(models.Model):
     def __str__(self):
         return self.name
 
-    def calculate_values(self):
+    def save(self, *args, **kwargs):
+        #hash and normalized_name are unique and derived from the name, so keep
+        #them current on every save
+        self.hash = grocery_hash(self.name)
+        self.normalized_name = normalize_name(self.name)
+        super(Grocery, self).save(*args, **kwargs)
+        self.remember_fields()
+
+    def _calculate_values(self):
         if self.cost_amount == 0:
             raise ValueError('Grocery.calculate_unit_cost() called with cost_amount assigned as zero')
-        elif self.units == 'ct':
+        elif self.units == units.COUNT:
             self.unit_cost = self.cost / self.cost_amount
         else:
-            self.unit_cost = (self.cost / self.cost_amount) / CONVERSIONS[self.units]["C"]
-        #hash will be used as a CSS class, so ensure it begins with a letter
-        self.hash = 'a' + hashlib.md5(self.name.encode('utf-8')).hexdigest()
+            #cost per unit multiplied by the number of units in a cup
+            self.unit_cost = units.to_decimal(
+                Fraction(self.cost) / Fraction(self.cost_amount) * units.factor('C', self.units))
+        self.hash = grocery_hash(self.name)
+        self.normalized_name = normalize_name(self.name)
+
+    def calculate_values(self):
+        self._calculate_values()
         self.save()
     
     def update(self):
         self.calculate_values()
         #update any Components using this Grocery
-        components = Component.objects.filter(groceries=self)
-        for component in components:
-            component.update()
+        propagate_costs(groceries=[self])
     
     def can_be_deleted(self):
         return False if Component.objects.filter(groceries=self) else True
@@ -83,15 +207,17 @@ class Ingredient(models.Model):
         return f"Ingredient: {self.for_grocery.name} {self.amount} {self.units} Component: {self.for_component.name}"
 
     def get_cost(self):
-        if self.units == 'ct':
+        if self.units == units.COUNT:
             return self.amount * self.for_grocery.unit_cost
-        return self.amount * (self.for_grocery.unit_cost / CONVERSIONS["C"][self.units])
+        return units.to_decimal(units.convert(self.amount, self.units, 'C') * Fraction(self.for_grocery.unit_cost))
 
-class Component(models.Model):
+class Component(FieldTracking, models.Model):
     '''An item used in a Recipe.
     '''
     groceries = models.ManyToManyField(Grocery, through='Ingredient')
     name = models.CharField(max_length=120, unique=True)
+    #see normalize_name()
+    normalized_name = models.CharField(max_length=120 * CASEFOLD_GROWTH, unique=True, editable=False)
     TYPES = (
         ('B', 'Baked'),
         ('I', 'Icing'),
@@ -101,6 +227,11 @@ class Component(models.Model):
     component_type = models.CharField(max_length=1, choices=TYPES) #.get_component_type_display()
     cost = models.DecimalField(max_digits=5, decimal_places=2, default=0)
     notes = models.TextField(default='', blank=True)
+    #moves whenever this Component's detail page may change; see propagate_costs()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    #list pages are ordered by these; see bakery.page_cache
+    tracked_fields = ('component_type', 'name')
 
     class Meta:
         ordering = ["component_type", "name"]
@@ -108,19 +239,22 @@ class Component(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_name(self.name)
+        super(Component, self).save(*args, **kwargs)
+        self.remember_fields()
+
     def calculate_cost(self):
-        total = Decimal(0)
-        for item in self.groceries.all():
-            total += item.ingredient_set.get(for_component=self).get_cost()
+        total = self.ingredient_set.aggregate(total=Coalesce(Sum(ingredient_cost_expression()), ZERO_COST))['total']
         self.cost = total
         self.save()
         
     def update(self):
         self.calculate_cost()
+        #Grocery pages list the Components using them
+        Grocery.objects.filter(ingredient__for_component=self).update(updated_at=timezone.now())
         #update any Recipes using this Component
-        recipes = Recipe.objects.filter(components=self)
-        for recipe in recipes:
-            recipe.update()
+        propagate_costs(recipes=Recipe.objects.filter(components=self))
 
     def can_be_deleted(self):
         return False if Recipe.objects.filter(components=self) else True
@@ -128,10 +262,12 @@ class Component(models.Model):
     def get_cost(self):
         return self.cost
 
-class Recipe(models.Model):
+class Recipe(FieldTracking, models.Model):
     '''An item used in an Order.
     '''
     name = models.CharField(max_length=140, unique=True)
+    #see normalize_name()
+    normalized_name = models.CharField(max_length=140 * CASEFOLD_GROWTH, unique=True, editable=False)
     components = models.ManyToManyField(Component)
     time_estimate = models.DecimalField(max_digits=5, decimal_places=3)
     time_actual = models.DecimalField(max_digits=5, decimal_places=3, default=0)
@@ -139,8 +275,11 @@ class Recipe(models.Model):
     price = models.PositiveSmallIntegerField(default=0)
     image = models.ImageField(upload_to='originals/', default='originals/default.jpg')
     image_thumb = models.CharField(max_length=300, default=settings.MEDIA_URL+'thumbnails/default.jpg')
+    stored_image = models.ForeignKey('StoredImage', null=True, blank=True, on_delete=models.PROTECT)
     user_uploaded_image = models.BooleanField(default=False)
     notes = models.TextField(default='', blank=True)
+    #moves whenever this Recipe's detail page may change; see propagate_costs()
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["name"]
@@ -148,6 +287,11 @@ class Recipe(models.Model):
     def __str__(self):
         return self.name 
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_name(self.name)
+        super(Recipe, self).save(*args, **kwargs)
+        self.remember_fields()
+
     def _calculate_cost(self):
         total = 0
         for item in self.components.all():
@@ -167,16 +311,36 @@ class Recipe(models.Model):
         self._calculate_cost()
         self._calculate_price()
         self.save()
+        refresh_bill_of_materials([self])
         
     def update(self):
         self.calculate_values()
-        #update any upcoming Orders using this Recipe
-        orders = Order.objects.filter(delivery_date__gte=date.today(), recipes=self)
-        for order in orders:
-            order.calculate_prices()
+        now = timezone.now()
+        #Grocery pages list the Recipes using them, and past Orders, which are
+        #not repriced, show their cost
+        Grocery.objects.filter(recipegrocery__recipe=self).update(updated_at=now)
+        Order.objects.filter(recipes=self, delivery_date__lt=date.today()).update(updated_at=now)
+        #update any upcoming Orders using this Recipe, moving their updated_at
+        propagate_costs(orders=Order.objects.filter(delivery_date__gte=date.today(), recipes=self))
             
     def can_be_deleted(self):
         return False if Order.objects.filter(recipes=self) else True
+
+    def get_srcset(self):
+        '''Return a srcset attribute value for the image in its original format,
+        or an empty string if resized copies are not available
+        '''
+        if self.stored_image and self.stored_image.derivatives_ready:
+            return self.stored_image.get_srcset()
+        return ''
+
+    def get_webp_srcset(self):
+        '''Return a srcset attribute value for the WebP copies of the image,
+        or an empty string if they are not available
+        '''
+        if self.stored_image and self.stored_image.derivatives_ready:
+            return self.stored_image.get_srcset('webp')
+        return ''
     
     def get_price(self):
         return self.price
@@ -184,7 +348,7 @@ class Recipe(models.Model):
     def get_cost(self):
         return self.cost
 
-class Order(models.Model):
+class Order(FieldTracking, models.Model):
     '''The top-level organizational model. An Order contains one or more Recipes,
     a Recipe contains one or more Components, and a Component contains one or more
     Groceries.
@@ -200,6 +364,10 @@ class Order(models.Model):
     price_paid = models.PositiveSmallIntegerField(default=0)
     postmortem_complete = models.BooleanField(default=False)
     notes = models.TextField(default='', blank=True)
+    #moves whenever this Order's detail page may change; see propagate_costs()
+    updated_at = models.DateTimeField(auto_now=True)
+    #list pages are ordered and filtered by this; see bakery.page_cache
+    tracked_fields = ('delivery_date',)
 
     class Meta:
         ordering = ["-delivery_date"]
@@ -207,11 +375,23 @@ class Order(models.Model):
     def __str__(self): 
         return f"Order for {self.customer}"
 
+    def save(self, *args, **kwargs):
+        super(Order, self).save(*args, **kwargs)
+        self.remember_fields()
+
     def calculate_prices(self):
+        self._calculate_prices(self.orderquantity_set.select_related('for_recipe'))
+        self.save()
+
+    def _calculate_prices(self, order_quantities):
+        '''Set quoted_price and deposit from the given OrderQuantity objects
+        without saving. Each OrderQuantity must belong to this Order.
+        '''
         total = 0
         deposit = 0
-        for item in self.recipes.all():
-            multiplier = item.orderquantity_set.get(for_order=self).get_quantity()
+        for order_quantity in order_quantities:
+            item = order_quantity.for_recipe
+            multiplier = order_quantity.get_quantity()
             total += item.get_price() * multiplier
             deposit += item.get_cost() * multiplier
         total = int(total)
@@ -228,7 +408,6 @@ class Order(models.Model):
         if self.requires_delivery:
             total += 15
         self.quoted_price = total
-        self.save()
 
 class OrderQuantity(models.Model):
     '''Allows for multiple quantities of the same Recipe to exist in the same Order.
@@ -245,3 +424,353 @@ class OrderQuantity(models.Model):
     
     def get_quantity(self):
         return self.quantity
+
+class RecipeGrocery(models.Model):
+    '''The total amount of a Grocery used to make one of a Recipe, summed over
+    all of its Components, and the cost of that amount. Volumes are stored in
+    pinches and counts as a Count. Rows are kept current by
+    refresh_bill_of_materials() and can be rebuilt with the
+    rebuild_bill_of_materials command.
+    '''
+    recipe = models.ForeignKey('Recipe', on_delete=models.CASCADE)
+    grocery = models.ForeignKey('Grocery', on_delete=models.CASCADE)
+    units = models.CharField(max_length=4, choices=UNIT_TYPES)
+    amount = models.DecimalField(max_digits=12, decimal_places=3)
+    cost = models.DecimalField(max_digits=5, decimal_places=2)
+
+    class Meta:
+        unique_together = ('recipe', 'grocery')
+        verbose_name_plural = "recipe groceries"
+
+    def __str__(self):
+        return f"{self.recipe_id}: {self.amount} {self.units} of Grocery {self.grocery_id}"
+
+    def get_amount(self, to_units):
+        '''Return the amount converted to to_units as a Decimal with 3 decimal places'''
+        return units.to_decimal(units.convert(self.amount, self.units, to_units)).quantize(AMOUNT_PLACES)
+
+    def get_default_amount(self):
+        '''Return the amount in the Grocery's default units'''
+        return self.get_amount(self.grocery.default_units)
+
+class StoredImage(models.Model):
+    '''An uploaded image stored once under the SHA-256 digest of its contents
+    together with resized copies in WebP and the original format. The number
+    of Recipes using the image is counted so that its files are only removed
+    when the last one stops using it; see bakery.images.
+    '''
+    #resized copies fit within a square of each size; 500 is the thumbnail
+    SIZES = (250, 500, 1000)
+    THUMBNAIL_SIZE = 500
+    digest = models.CharField(max_length=64, unique=True)
+    extension = models.CharField(max_length=5)
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+    reference_count = models.PositiveIntegerField(default=0)
+    derivatives_ready = models.BooleanField(default=False)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.get_original_name()
+
+    def get_directory(self):
+        return f'images/{self.digest[:2]}/{self.digest}/'
+
+    def get_original_name(self):
+        return f'{self.get_directory()}original.{self.extension}'
+
+    def get_derivative_name(self, size, extension=None):
+        '''Return the name of the copy resized to fit within size x size pixels'''
+        return f'{self.get_directory()}{size}.{extension or self.extension}'
+
+    def get_derivative_width(self, size):
+        '''Return the width of the copy resized to fit within size x size pixels'''
+        if max(self.width, self.height) <= size:
+            return self.width
+        return max(1, round(self.width * size / max(self.width, self.height)))
+
+    def get_srcset(self, extension=None):
+        candidates = {}
+        for size in self.SIZES:
+            candidates.setdefault(self.get_derivative_width(size), self.get_derivative_name(size, extension))
+        return ', '.join(f'{default_storage.url(name)} {width}w' for width, name in sorted(candidates.items()))
+
+class ThumbnailJob(models.Model):
+    '''A request to create the thumbnail for a Recipe image. Jobs are stored so
+    that thumbnails still pending when the server stops are made after it
+    restarts; see bakery.thumbnails.
+    '''
+    PENDING = 'P'
+    RUNNING = 'R'
+    DONE = 'D'
+    FAILED = 'F'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    recipe = models.ForeignKey('Recipe', on_delete=models.CASCADE)
+    source = models.CharField(max_length=300)
+    status = models.CharField(max_length=1, choices=STATUSES, default=PENDING, db_index=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    started_date = models.DateTimeField(null=True, blank=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(default='', blank=True)
+
+    class Meta:
+        ordering = ["created_date"]
+
+    def __str__(self):
+        return f"Thumbnail for {self.source} ({self.get_status_display()})"
+
+    def get_latency(self):
+        '''Return the seconds from creation until the job finished, or None'''
+        if self.finished_date is None:
+            return None
+        return (self.finished_date - self.created_date).total_seconds()
+
+
+def _pk_set(objects):
+    '''Return the set of primary keys for a QuerySet or an iterable of model
+    instances
+    '''
+    if isinstance(objects, models.QuerySet):
+        return set(objects.values_list('pk', flat=True))
+    return {item.pk for item in objects}
+
+def recalculate_component_costs(components=None, touch=False):
+    '''Recalculate Component.cost for the given Components, or for every Component
+    if none are given, using one aggregate query and one bulk update regardless
+    of the number of Ingredients. components may be a QuerySet, model instances
+    or primary keys. If touch is true, updated_at is moved for every Component
+    in the same bulk update, not only for those whose cost changed. Returns the
+    Components whose cost changed.
+    '''
+    queryset = Component.objects.all()
+    if components is not None:
+        if not isinstance(components, models.QuerySet):
+            components = [getattr(item, 'pk', item) for item in components]
+        queryset = queryset.filter(pk__in=components)
+    queryset = queryset.only('pk', 'cost').order_by().annotate(
+        new_cost=Coalesce(Sum(ingredient_cost_expression('ingredient__')), ZERO_COST))
+    changed = []
+    written = []
+    now = timezone.now()
+    for component in queryset:
+        if component.cost != component.new_cost:
+            component.cost = component.new_cost
+            changed.append(component)
+        elif not touch:
+            continue
+        component.updated_at = now
+        written.append(component)
+    Component.objects.bulk_update(written, ['cost', 'updated_at'])
+    if changed:
+        bulk_saved.send(sender=Component, objects=changed)
+    return changed
+
+def save_ingredients(component, entries):
+    '''Make the Ingredients of a Component match entries, a dictionary mapping
+    each Grocery to an (amount, units) tuple. Only the differences from the
+    existing Ingredients are written, with at most one bulk create, one bulk
+    update and one delete. Returns True if an Ingredient was added or removed
+    or its amount or units changed, i.e. if the Component's cost may differ.
+    '''
+    entries = {grocery.pk: (grocery, Decimal(amount).quantize(AMOUNT_PLACES), units)
+        for grocery, (amount, units) in entries.items()}
+    existing = {}
+    removed = []
+    with transaction.atomic():
+        for ingredient in Ingredient.objects.filter(for_component=component).only('pk', 'for_grocery', 'units', 'amount'):
+            #a Grocery listed twice keeps its first Ingredient
+            if ingredient.for_grocery_id in entries and ingredient.for_grocery_id not in existing:
+                existing[ingredient.for_grocery_id] = ingredient
+            else:
+                removed.append(ingredient.pk)
+        created = []
+        changed = []
+        for grocery_pk, (grocery, amount, units) in entries.items():
+            ingredient = existing.get(grocery_pk)
+            if ingredient is None:
+                created.append(Ingredient(for_grocery=grocery, for_component=component, units=units, amount=amount))
+            elif (ingredient.amount, ingredient.units) != (amount, units):
+                ingredient.amount = amount
+                ingredient.units = units
+                changed.append(ingredient)
+        if removed:
+            Ingredient.objects.filter(pk__in=removed).delete()
+        Ingredient.objects.bulk_create(created)
+        Ingredient.objects.bulk_update(changed, ['amount', 'units'])
+    if created or changed:
+        bulk_saved.send(sender=Ingredient, objects=created + changed)
+    return bool(removed or created or changed)
+
+def save_components(recipe, components):
+    '''Make the Components of a saved Recipe match components with one bulk
+    add and one bulk remove of only the differences. Returns True if a
+    Component was added or removed.
+    '''
+    components = {component.pk: component for component in components}
+    existing = set(recipe.components.values_list('pk', flat=True))
+    added = [component for pk, component in components.items() if pk not in existing]
+    removed = existing - components.keys()
+    if added:
+        recipe.components.add(*added)
+    if removed:
+        recipe.components.remove(*removed)
+    return bool(added or removed)
+
+def refresh_bill_of_materials(recipes=None):
+    '''Recalculate the RecipeGrocery rows of the given Recipes, or of every
+    Recipe if none are given. recipes may be a QuerySet, model instances or
+    primary keys. The totals are summed by one aggregate query and only rows
+    that differ are created, updated or deleted. Returns the number of rows
+    written.
+    '''
+    ingredients = Ingredient.objects.all()
+    existing = RecipeGrocery.objects.all()
+    if recipes is not None:
+        if not isinstance(recipes, models.QuerySet):
+            recipes = [getattr(item, 'pk', item) for item in recipes]
+        ingredients = ingredients.filter(for_component__recipe__in=recipes)
+        existing = existing.filter(recipe__in=recipes)
+    totals = ingredients.order_by().values('for_grocery', 'for_grocery__units', recipe=F('for_component__recipe')).annotate(
+        total_amount=Sum(ExpressionWrapper(F('amount') * pinches_expression(), output_field=models.DecimalField())), total_cost=Sum(ingredient_cost_expression()))
+    rows = {}
+    for total in totals:
+        rows[(total['recipe'], total['for_grocery'])] = RecipeGrocery(
+            recipe_id=total['recipe'],
+            grocery_id=total['for_grocery'],
+            units=units.COUNT if total['for_grocery__units'] == units.COUNT else 'p',
+            #SQLite does not round aggregated decimals
+            amount=Decimal(total['total_amount']).quantize(AMOUNT_PLACES),
+            cost=Decimal(total['total_cost']).quantize(Decimal('0.01')),
+        )
+    changed = []
+    removed = []
+    with transaction.atomic():
+        for row in existing.iterator():
+            new = rows.pop((row.recipe_id, row.grocery_id), None)
+            if new is None:
+                removed.append(row.pk)
+            elif (row.units, row.amount, row.cost) != (new.units, new.amount, new.cost):
+                row.units, row.amount, row.cost = new.units, new.amount, new.cost
+                changed.append(row)
+        for index in range(0, len(removed), 500):
+            RecipeGrocery.objects.filter(pk__in=removed[index:index + 500]).delete()
+        RecipeGrocery.objects.bulk_update(changed, ['units', 'amount', 'cost'], batch_size=500)
+        RecipeGrocery.objects.bulk_create(rows.values(), batch_size=500)
+    return len(removed) + len(changed) + len(rows)
+
+def reprice_orders(orders, touch=False):
+    '''Recalculate quoted_price and deposit for the given Orders with the same
+    rules as Order.calculate_prices(). orders may be a QuerySet, model instances
+    or primary keys. The Orders and all of their OrderQuantity rows with Recipe
+    price and cost are each loaded with one query, and the Orders whose prices
+    changed are saved with one bulk update and returned. If touch is true,
+    updated_at is moved for every Order in the same bulk update.
+    '''
+    if not isinstance(orders, models.QuerySet):
+        orders = Order.objects.filter(pk__in=[getattr(item, 'pk', item) for item in orders])
+    orders = orders.only('pk', 'requires_delivery', 'deposit_paid', 'deposit', 'quoted_price')
+    order_quantities = defaultdict(list)
+    rows = OrderQuantity.objects.filter(for_order__in=orders.values('pk')).select_related('for_recipe').only(
+        'for_order', 'quantity', 'for_recipe__price', 'for_recipe__cost')
+    for order_quantity in rows:
+        order_quantities[order_quantity.for_order_id].append(order_quantity)
+    changed = []
+    written = []
+    now = timezone.now()
+    for order in orders:
+        previous = (order.quoted_price, order.deposit)
+        order._calculate_prices(order_quantities[order.pk])
+        if (order.quoted_price, order.deposit) != previous:
+            changed.append(order)
+        elif not touch:
+            continue
+        order.updated_at = now
+        written.append(order)
+    Order.objects.bulk_update(written, ['quoted_price', 'deposit', 'updated_at'])
+    if changed:
+        bulk_saved.send(sender=Order, objects=changed)
+    return changed
+
+def propagate_costs(groceries=(), components=(), recipes=(), orders=()):
+    '''Recalculate every cost and price that depends on the given objects.
+
+    groceries are treated as already up to date; the given components, recipes
+    and orders are recalculated along with everything that depends on them.
+    The affected part of the Grocery -> Ingredient -> Component -> Recipe ->
+    OrderQuantity -> Order graph is collected first so that each node is
+    visited exactly once, in dependency order, and each model is written with
+    a single bulk update. As with Recipe.update(), only upcoming Orders are
+    repriced unless an Order is given explicitly. The RecipeGrocery rows of
+    every Recipe using a given Grocery or Component are refreshed last.
+
+    updated_at is moved for every Component, Recipe and Order visited, not
+    only those whose cost changed, because their detail pages also show the
+    Ingredients, bill of materials and Recipes they are made from. It is
+    written with the costs, so each row is written once; rows that are not
+    recalculated, such as past Orders using a changed Recipe, which are not
+    repriced but show the Recipe's current cost, are moved with one more
+    update.
+    '''
+    #Components using a changed Grocery
+    component_ids = _pk_set(components)
+    grocery_ids = _pk_set(groceries)
+    recipe_ids = _pk_set(recipes)
+    #Recipes whose RecipeGrocery rows may change even if no cost does
+    materials_recipe_ids = set(recipe_ids)
+    if grocery_ids:
+        materials_recipe_ids.update(RecipeGrocery.objects.filter(
+            grocery__in=grocery_ids).values_list('recipe', flat=True))
+    if component_ids:
+        materials_recipe_ids.update(Recipe.components.through.objects.filter(
+            component__in=component_ids).values_list('recipe', flat=True))
+    if grocery_ids:
+        component_ids.update(Ingredient.objects.filter(
+            for_grocery__in=grocery_ids).values_list('for_component', flat=True))
+    now = timezone.now()
+    if component_ids:
+        #only Components whose cost actually changed affect their Recipes
+        component_ids = {component.pk for component in recalculate_component_costs(component_ids, touch=True)}
+
+    #Recipes using a changed Component
+    if component_ids:
+        recipe_ids.update(Recipe.components.through.objects.filter(
+            component__in=component_ids).values_list('recipe', flat=True))
+    written_recipe_ids = set()
+    if recipe_ids:
+        changed = []
+        visited = list(Recipe.objects.filter(pk__in=recipe_ids).prefetch_related('components'))
+        for recipe in visited:
+            previous = (recipe.cost, recipe.price)
+            recipe._calculate_cost()
+            recipe._calculate_price()
+            recipe.updated_at = now
+            if (recipe.cost, recipe.price) != previous:
+                changed.append(recipe)
+        Recipe.objects.bulk_update(visited, ['cost', 'price', 'updated_at'])
+        written_recipe_ids = {recipe.pk for recipe in visited}
+        if changed:
+            bulk_saved.send(sender=Recipe, objects=changed)
+        #only Recipes whose cost or price changed affect their Orders
+        recipe_ids = {recipe.pk for recipe in changed}
+
+    #Orders using a changed Recipe; upcoming ones are repriced
+    order_ids = _pk_set(orders)
+    past_order_ids = set()
+    if recipe_ids:
+        for pk, delivery_date in Order.objects.filter(recipes__in=recipe_ids).values_list('pk', 'delivery_date'):
+            (order_ids if delivery_date >= date.today() else past_order_ids).add(pk)
+    past_order_ids -= order_ids
+    if past_order_ids:
+        Order.objects.filter(pk__in=past_order_ids).update(updated_at=now)
+    if order_ids:
+        reprice_orders(order_ids, touch=True)
+    if materials_recipe_ids:
+        untouched = materials_recipe_ids - written_recipe_ids
+        if untouched:
+            Recipe.objects.filter(pk__in=untouched).update(updated_at=now)
+        refresh_bill_of_materials(materials_recipe_ids)
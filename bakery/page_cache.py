@@ -0,0 +1,199 @@
+'''Caching of rendered list pages and per-object card fragments with Django's
+cache framework, using the cache named by BAKERY_CACHE (default 'default').
+
+Entries are checked against generation counters for each Grocery,
+Component, Recipe and Order:
+- an object generation, bumped when that object is saved or deleted
+- a list generation, bumped when a row is created or deleted or moves in
+  the order of the list pages, i.e. one of the fields they are ordered by
+  changes, so that the rows on every page may shift
+- a model generation, bumped on any change, which versions the lookup
+  tables and guards pages rendered while a change commits
+A list page is keyed by the list generation of its model and stored with
+the primary keys of the rows it shows and their object generations, and is
+served only while those are unchanged, so editing one Grocery drops only
+the page showing it. A card fragment is keyed by its object's generation.
+Old entries are never read again and expire after BAKERY_PAGE_CACHE_TIMEOUT
+seconds (default 600). Rows changed by bulk writes are reported with the
+bulk_saved signal, so when editing a Grocery reprices Recipes and Orders
+only the pages showing those are dropped. Generations are bumped once the
+transaction making the change commits.
+
+Hits and misses are counted in the cache; see stats().
+'''
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+
+from hashlib import md5
+import time
+
+from bakery.models import Grocery, Component, Recipe, Order, StoredImage
+from bakery.signals import bulk_saved
+
+#the models whose rows appear on cached pages and fragments
+CACHED_MODELS = (Grocery, Component, Recipe, Order)
+COUNTERS = ('page_hits', 'page_misses', 'fragment_hits', 'fragment_misses')
+#response header saying whether a page was served from the cache
+HEADER = 'X-Bakery-Cache'
+
+def get_cache():
+    return caches[getattr(settings, 'BAKERY_CACHE', 'default')]
+
+def get_timeout():
+    return getattr(settings, 'BAKERY_PAGE_CACHE_TIMEOUT', 600)
+
+def _generation_key(model, pk=None):
+    '''Return the key of the generation of model, of its object pk, or with
+    pk 'list', of its list pages
+    '''
+    key = f'bakery:generation:{model._meta.model_name}'
+    return key if pk is None else f'{key}:{pk}'
+
+def _listed_fields(model):
+    '''Return the fields a model's list pages are ordered by'''
+    return [field.lstrip('-') for field in model._meta.ordering]
+
+def _generations(keys):
+    '''Return the current value of each generation key in order'''
+    cache = get_cache()
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            #start from the clock rather than 1 so that a counter evicted
+            #from the cache cannot return to a value used before
+            cache.add(key, time.time_ns(), timeout=None)
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+def table_version(model):
+    '''Return the current generation of model, which changes whenever one of
+    its rows is saved or deleted
+    '''
+    return _generations([_generation_key(model)])[0]
+
+def bump(model, pks=(), listed=True):
+    '''Invalidate the pages and fragments showing the objects of model with
+    the given primary keys, immediately. If listed is true, every list page
+    of model is invalidated too, as rows were added, removed or reordered.
+    '''
+    cache = get_cache()
+    keys = [_generation_key(model)] + [_generation_key(model, pk) for pk in pks]
+    if listed:
+        keys.append(_generation_key(model, 'list'))
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            #not cached yet, so nothing depends on it
+            pass
+
+def _count(counter):
+    cache = get_cache()
+    key = f'bakery:stats:{counter}'
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, timeout=None)
+
+def stats():
+    '''Return a dictionary of the hit and miss counts named in COUNTERS'''
+    values = get_cache().get_many([f'bakery:stats:{counter}' for counter in COUNTERS])
+    return {counter: values.get(f'bakery:stats:{counter}', 0) for counter in COUNTERS}
+
+def reset_stats():
+    get_cache().delete_many([f'bakery:stats:{counter}' for counter in COUNTERS])
+
+def page_key(name, path, model, vary=()):
+    '''Return the cache key for the page at path rendered by the view called
+    name from the current list generation of model and any other values in
+    vary
+    '''
+    generation, = _generations([_generation_key(model, 'list')])
+    parts = [path, str(generation)] + [str(value) for value in vary]
+    return f'bakery:page:{name}:' + md5('\n'.join(parts).encode()).hexdigest()
+
+def fragment_key(name, instance):
+    '''Return the cache key for the fragment called name showing instance'''
+    model = type(instance)
+    generation, = _generations([_generation_key(model, instance.pk)])
+    return f'bakery:fragment:{name}:{model._meta.model_name}:{instance.pk}:{generation}'
+
+def get_fragment(key):
+    content = get_cache().get(key)
+    _count('fragment_misses' if content is None else 'fragment_hits')
+    return content
+
+def set_fragment(key, content):
+    get_cache().set(key, content, get_timeout())
+
+class CachedPageMixin:
+    '''Serve a ListView's rendered page from the cache until one of the rows
+    it shows changes or a row of its model is added, removed or reordered.
+    The page must show only the objects in its object_list. Place after
+    LoginRequiredMixin so that only authorized requests are served.
+    '''
+    def get_cache_vary(self):
+        '''Return other values the rendered page depends on'''
+        return ()
+
+    def get(self, request, *args, **kwargs):
+        #the key is computed before the page is queried, so a page rendered
+        #while a row is added commits is stored under the old list generation
+        key = page_key(type(self).__name__, request.get_full_path(), self.model, self.get_cache_vary())
+        cache = get_cache()
+        entry = cache.get(key)
+        if entry is not None and _generations(entry['keys']) == entry['generations']:
+            _count('page_hits')
+            response = HttpResponse(entry['content'])
+            response[HEADER] = 'hit'
+            return response
+        _count('page_misses')
+        version = table_version(self.model)
+        response = super().get(request, *args, **kwargs)
+        response.render()
+        keys = [_generation_key(self.model, item.pk) for item in response.context_data['object_list']]
+        #a row that changed while the page was queried may show its old
+        #values, so the page is only stored if none did
+        if response.status_code == 200 and table_version(self.model) == version:
+            cache.set(key, {'keys': keys, 'generations': _generations(keys), 'content': response.content}, get_timeout())
+        response[HEADER] = 'miss'
+        return response
+
+def _bump_on_commit(model, pks, listed):
+    pks = [pk for pk in pks if pk is not None]
+    transaction.on_commit(lambda: bump(model, pks, listed))
+
+def _moved(model, instance):
+    '''Return whether saving instance may have moved it in model's lists'''
+    return instance.pk is None or any(instance.has_changed(field) for field in _listed_fields(model))
+
+def _saved(sender, instance, created, **kwargs):
+    _bump_on_commit(sender, [instance.pk], created or _moved(sender, instance))
+
+def _deleted(sender, instance, **kwargs):
+    _bump_on_commit(sender, [instance.pk], True)
+
+def _bump_image_recipes(stored_pks):
+    #whether resized copies are ready does not move a Recipe in its lists
+    bump(Recipe, list(Recipe.objects.filter(stored_image__in=stored_pks).values_list('pk', flat=True)), listed=False)
+
+def _bulk_saved(sender, objects, **kwargs):
+    if sender in CACHED_MODELS:
+        _bump_on_commit(sender, [item.pk for item in objects], any(_moved(sender, item) for item in objects))
+    elif sender is StoredImage:
+        #Recipe cards show whether resized copies of their image are ready
+        stored_pks = [item.pk for item in objects]
+        transaction.on_commit(lambda: _bump_image_recipes(stored_pks))
+
+def connect():
+    '''Invalidate cached pages and fragments as rows change; called from
+    BakeryConfig.ready()
+    '''
+    for model in CACHED_MODELS:
+        post_save.connect(_saved, sender=model, dispatch_uid=f'page_cache_save_{model.__name__}')
+        post_delete.connect(_deleted, sender=model, dispatch_uid=f'page_cache_delete_{model.__name__}')
+    bulk_saved.connect(_bulk_saved, dispatch_uid='page_cache_bulk')
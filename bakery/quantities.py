@@ -0,0 +1,78 @@
+'''Parsing of quantities entered as whole numbers, mixed numbers, fractions or
+decimals, e.g. "2", "2 1/4", "9/4" or "2.25".
+
+Valid input is recognised with a single precompiled pattern. The slower
+checks that choose an error message only run when that pattern does not
+match. Error messages contain a "%(str)s" placeholder for the input.
+'''
+from decimal import Decimal
+from fractions import Fraction
+import re
+
+QUANTITY = re.compile(
+    r"(?P<decimal>\d+\.\d*|\.\d+)"
+    r"|(?:(?P<whole>\d+) +)?(?P<numerator>\d+)/(?P<denominator>\d+)"
+    r"|(?P<integer>\d+)"
+)
+#match not "/. 0123456789"
+INVALID_CHARACTERS = re.compile(r"[^\/\. \d]")
+DIGIT = re.compile(r"\d")
+
+MESSAGE_FORMAT = '\"%(str)s\" is not formatted properly. Use a whole number, mixed number, fraction, or decimal (e.g. 2 1/4 or 2.25)'
+MESSAGE_INVALID_CHARACTERS = '\"%(str)s\" contains invalid characters. Use only the character \"/\" or \".\" and numbers.'
+MESSAGE_NO_NUMBERS = '\"%(str)s\" contains no numbers.'
+MESSAGE_DECIMALS = '\"%(str)s\" contains too many decimals. Only one is allowed.'
+MESSAGE_DECIMAL_SPACE = '\"%(str)s\" contains invalid characters. Do not combine spaces with a decimal.'
+MESSAGE_DECIMAL_SLASH = '\"%(str)s\" contains invalid characters. Do not combine a slash with a decimal.'
+MESSAGE_SLASHES = '\"%(str)s\" contains too many slashes. Only one is allowed.'
+MESSAGE_ZERO = '\"%(str)s\" cannot divide by zero.'
+
+def _error_message(str):
+    '''Return the message describing why the stripped string str is not a
+    valid quantity
+    '''
+    if INVALID_CHARACTERS.search(str) is not None:
+        return MESSAGE_INVALID_CHARACTERS
+    if DIGIT.search(str) is None:
+        return MESSAGE_NO_NUMBERS
+    if '.' in str:
+        if str.count('.') > 1:
+            return MESSAGE_DECIMALS
+        if ' ' in str:
+            return MESSAGE_DECIMAL_SPACE
+        if '/' in str:
+            return MESSAGE_DECIMAL_SLASH
+    elif str.count('/') > 1:
+        return MESSAGE_SLASHES
+    return MESSAGE_FORMAT
+
+def parse_quantity(str):
+    '''Converts a string containing a whole number, mixed number, fraction, or decimal to a Fraction.
+    Returns (False, "error message") if the given string is in an invalid format.
+    Returns (True, Fraction) otherwise.
+    '''
+    str = str.strip()
+    match = QUANTITY.fullmatch(str)
+    if match is None:
+        return (False, _error_message(str))
+    decimal, whole, numerator, denominator, integer = match.group(
+        'decimal', 'whole', 'numerator', 'denominator', 'integer')
+    if integer is not None:
+        return (True, Fraction(int(integer)))
+    if decimal is not None:
+        return (True, Fraction(Decimal(decimal)))
+    denominator = int(denominator)
+    if denominator == 0:
+        return (False, MESSAGE_ZERO)
+    return (True, int(whole or 0) + Fraction(int(numerator), denominator))
+
+def parse_quantities(strings):
+    '''Parse every string in an iterable with parse_quantity(), parsing
+    repeated strings once. Returns a dictionary mapping each string to its
+    (success, Fraction or error message) result.
+    '''
+    results = {}
+    for str in strings:
+        if str not in results:
+            results[str] = parse_quantity(str)
+    return results
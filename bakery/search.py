@@ -0,0 +1,49 @@
+'''Paginated name search for the typeahead inputs of the component, recipe
+and order forms, so that form pages never list a whole table.
+
+Prefix matches use a range on the uniquely indexed normalized_name column:
+the query is normalized the same way (see bakery.models.normalize_name()), so
+every normalized name from it up to its successor matches regardless of
+case. Substring matches use icontains, which scans the table but stops after
+one page of matches.
+'''
+from django.conf import settings
+
+from bakery.models import Grocery, Component, Recipe, normalize_name
+
+#kind: (model, extra fields returned with each match, fields that may be filtered on)
+SEARCHES = {
+    'groceries': (Grocery, ('default_units', 'hash'), ()),
+    'components': (Component, (), ('component_type',)),
+    'recipes': (Recipe, (), ()),
+}
+PREFIX = 'prefix'
+CONTAINS = 'contains'
+
+def get_limit():
+    '''Return the most matches returned for one page'''
+    return getattr(settings, 'BAKERY_SEARCH_LIMIT', 20)
+
+def search(kind, query, match=PREFIX, page=1, limit=None, filters=None):
+    '''Return (matches, has_next) for one page of the objects of kind whose
+    names start with or contain query, in order of name. Each match is a
+    dictionary of the primary key as 'id', the name and the kind's extra
+    fields. filters maps fields of the kind to required values.
+    '''
+    model, extra_fields, filter_fields = SEARCHES[kind]
+    limit = min(limit or get_limit(), get_limit())
+    queryset = model.objects.filter(**{field: value for field, value in (filters or {}).items() if field in filter_fields})
+    query = query.strip()
+    if query and match == CONTAINS:
+        queryset = queryset.filter(name__icontains=query)
+    elif query:
+        prefix = normalize_name(query)
+        #the smallest string greater than every string starting with prefix
+        successor = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        queryset = queryset.filter(normalized_name__gte=prefix, normalized_name__lt=successor)
+    offset = (page - 1) * limit
+    rows = list(queryset.order_by('normalized_name').values('pk', 'name', *extra_fields)[offset:offset + limit + 1])
+    matches = rows[:limit]
+    for row in matches:
+        row['id'] = row.pop('pk')
+    return matches, len(rows) > limit
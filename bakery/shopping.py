@@ -0,0 +1,90 @@
+'''The groceries needed for every Order delivered in a range of dates.
+
+The totals come from one aggregate query over the RecipeGrocery bill of
+materials joined to OrderQuantity, so the work done by the database does not
+grow with the number of Components or Ingredients involved. Rows are read
+with iterator() and formatted one at a time, so CSV and JSON output can be
+streamed without holding the whole list in memory.
+'''
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Sum, ExpressionWrapper, DecimalField
+
+from decimal import Decimal
+from fractions import Fraction
+from math import ceil
+import csv
+import json
+
+from bakery import units
+from bakery.models import RecipeGrocery, AMOUNT_PLACES
+
+FIELDS = ('grocery', 'amount', 'units', 'packages', 'package_amount', 'estimated_cost', 'package_cost')
+
+def shopping_list(start, end):
+    '''Yield a dictionary with the keys in FIELDS for each Grocery used by the
+    Orders delivered from start to end inclusive, in order of name. amount is
+    the total needed in the units the Grocery is bought in, packages the
+    number of packages of package_amount to buy, estimated_cost the cost of
+    the amount used and package_cost the cost of the packages. If the amount
+    cannot be converted to the units the Grocery is bought in, it is given in
+    the Ingredients' units and packages, package_amount and package_cost are
+    None.
+    '''
+    quantity = F('recipe__orderquantity__quantity')
+    totals = (RecipeGrocery.objects
+        .filter(recipe__orderquantity__for_order__delivery_date__range=(start, end))
+        .values('grocery__name', 'grocery__units', 'grocery__cost', 'grocery__cost_amount', 'units')
+        .annotate(
+            total_amount=Sum(ExpressionWrapper(F('amount') * quantity, output_field=DecimalField())),
+            total_cost=Sum(ExpressionWrapper(F('cost') * quantity, output_field=DecimalField())),
+        )
+        .order_by('grocery__name'))
+    for total in totals.iterator():
+        purchase_units = total['grocery__units']
+        #SQLite does not round aggregated decimals
+        amount = Fraction(Decimal(total['total_amount']).quantize(AMOUNT_PLACES))
+        try:
+            amount = amount * units.factor(total['units'], purchase_units)
+        except ValueError:
+            #an Ingredient measured in units that cannot be bought, so the
+            #amount cannot be counted in packages
+            purchase_units = total['units']
+            packages = package_amount = package_cost = None
+        else:
+            packages = ceil(amount / Fraction(total['grocery__cost_amount']))
+            package_amount = total['grocery__cost_amount']
+            package_cost = packages * total['grocery__cost']
+        yield {
+            'grocery': total['grocery__name'],
+            'amount': units.to_decimal(amount).quantize(AMOUNT_PLACES),
+            'units': purchase_units,
+            'packages': packages,
+            'package_amount': package_amount,
+            'estimated_cost': Decimal(total['total_cost']).quantize(Decimal('0.01')),
+            'package_cost': package_cost,
+        }
+
+class _Echo:
+    '''A file-like object for csv.writer that returns each line instead of
+    writing it
+    '''
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    '''Yield a CSV header line and then one line for each shopping_list() row'''
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([row[field] for field in FIELDS])
+
+def json_chunks(rows, start, end):
+    '''Yield pieces of a JSON document listing shopping_list() rows for the
+    Orders delivered from start to end
+    '''
+    yield '{"start": "%s", "end": "%s", "groceries": [' % (start.isoformat(), end.isoformat())
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row, cls=DjangoJSONEncoder)
+        separator = ', '
+    yield ']}\n'
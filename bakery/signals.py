@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+#sent with the model class as sender and the affected instances as objects
+#after rows are written by bulk_create(), bulk_update() or QuerySet.update(),
+#which do not send post_save; created instances may not have a primary key
+bulk_saved = Signal(providing_args=['objects'])
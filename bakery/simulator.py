@@ -0,0 +1,176 @@
+'''What-if pricing: the Recipe costs and prices and Order quotes that would
+result from hypothetical Grocery unit costs, without writing to the database.
+
+PriceSimulator loads the Grocery -> Ingredient -> Component -> Recipe ->
+OrderQuantity -> Order graph once with a fixed number of queries and keeps
+each link as a pair of index arrays, i.e. a sparse matrix in coordinate form.
+Each step of a simulation is then a single weighted np.bincount() over those
+arrays (a sparse matrix-vector product), so thousands of Recipes and Orders
+are priced at once. Money is rounded to cents, and the rounding rules of
+Recipe._calculate_price() and Order._calculate_prices() are applied with
+integer arithmetic so that results match the saved values exactly.
+
+NumPy is an optional dependency; see numpy_available().
+'''
+from django.utils import timezone
+
+from bakery import units
+from bakery.models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity, pinches_expression, normalize_name
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#dollars per hour added to a Recipe's cost, see Recipe._calculate_price()
+HOURLY_RATE = 10
+NEW_RECIPE_HOURLY_RATE = 13
+DELIVERY_FEE = 15
+
+def numpy_available():
+    return np is not None
+
+def _index(keys):
+    '''Return a dictionary mapping each key to its position'''
+    return {key: position for position, key in enumerate(keys)}
+
+def _round_up_to_five(values):
+    return -(-values // 5) * 5
+
+class Simulation:
+    '''The result of PriceSimulator.simulate(). Arrays are aligned with the
+    simulator's recipe_pks and order_pks; money is in cents except for
+    Recipe prices and Order quotes and deposits, which are whole dollars.
+    '''
+    def __init__(self, simulator, recipe_cost, recipe_price, order_price, order_deposit):
+        self.simulator = simulator
+        self.recipe_cost = recipe_cost
+        self.recipe_price = recipe_price
+        self.order_price = order_price
+        self.order_deposit = order_deposit
+
+    def recipe_changes(self, baseline):
+        '''Return (Recipe pk, name, baseline cost, cost, baseline price, price)
+        for every Recipe whose cost or price differs from baseline. Costs are
+        in dollars.
+        '''
+        changed = np.flatnonzero((self.recipe_cost != baseline.recipe_cost) | (self.recipe_price != baseline.recipe_price))
+        return [(self.simulator.recipe_pks[i], self.simulator.recipe_names[i],
+            baseline.recipe_cost[i] / 100, self.recipe_cost[i] / 100,
+            int(baseline.recipe_price[i]), int(self.recipe_price[i])) for i in changed]
+
+    def order_changes(self, baseline):
+        '''Return (Order pk, customer, baseline quote, quote, baseline deposit,
+        deposit) for every Order whose quote or deposit differs from baseline
+        '''
+        changed = np.flatnonzero((self.order_price != baseline.order_price) | (self.order_deposit != baseline.order_deposit))
+        return [(self.simulator.order_pks[i], self.simulator.order_customers[i],
+            int(baseline.order_price[i]), int(self.order_price[i]),
+            int(baseline.order_deposit[i]), int(self.order_deposit[i])) for i in changed]
+
+class PriceSimulator:
+    '''Load every Grocery, Ingredient, Component and Recipe, and the given
+    Orders or, by default, the upcoming Orders repriced by propagate_costs(),
+    for repeated simulations. Raises ImportError if NumPy is not installed.
+    '''
+    def __init__(self, orders=None):
+        if np is None:
+            raise ImportError('The price simulator requires NumPy')
+        if orders is None:
+            orders = Order.objects.filter(delivery_date__gte=timezone.localdate())
+
+        groceries = list(Grocery.objects.order_by('pk').values_list('pk', 'normalized_name', 'unit_cost'))
+        self.grocery_pks = [pk for pk, name, unit_cost in groceries]
+        self.grocery_names = {name: pk for pk, name, unit_cost in groceries}
+        self.unit_costs = np.array([float(unit_cost) for pk, name, unit_cost in groceries], dtype=float)
+        grocery_index = _index(self.grocery_pks)
+
+        #components x groceries: each Ingredient's amount in the Grocery's cost
+        #units, i.e. cups or a Count
+        ingredients = Ingredient.objects.annotate(pinches=pinches_expression(count=units.PINCHES['C'])).values_list(
+            'for_component', 'for_grocery', 'amount', 'pinches')
+        component_pks = list(Component.objects.order_by('pk').values_list('pk', flat=True))
+        component_index = _index(component_pks)
+        self.component_count = len(component_pks)
+        rows, columns, amounts = [], [], []
+        for component, grocery, amount, pinches in ingredients:
+            rows.append(component_index[component])
+            columns.append(grocery_index[grocery])
+            amounts.append(float(amount) * pinches / units.PINCHES['C'])
+        self.ingredient_components = np.array(rows, dtype=np.intp)
+        self.ingredient_groceries = np.array(columns, dtype=np.intp)
+        self.ingredient_amounts = np.array(amounts, dtype=float)
+
+        #recipes x components
+        recipes = list(Recipe.objects.order_by('pk').values_list('pk', 'name', 'time_estimate', 'time_actual'))
+        self.recipe_pks = [pk for pk, name, estimate, actual in recipes]
+        self.recipe_names = [name for pk, name, estimate, actual in recipes]
+        recipe_index = _index(self.recipe_pks)
+        #hours are stored with 3 decimal places, so time costs are exact in
+        #thousandths of a dollar
+        self.recipe_time_cost = np.array([int(estimate * 1000) * (HOURLY_RATE if actual else NEW_RECIPE_HOURLY_RATE)
+            for pk, name, estimate, actual in recipes], dtype=np.int64)
+        links = list(Recipe.components.through.objects.values_list('recipe', 'component'))
+        self.link_recipes = np.array([recipe_index[recipe] for recipe, component in links], dtype=np.intp)
+        self.link_components = np.array([component_index[component] for recipe, component in links], dtype=np.intp)
+
+        #orders x recipes
+        orders = list(orders.order_by('pk').values_list('pk', 'customer', 'deposit', 'deposit_paid', 'requires_delivery'))
+        self.order_pks = [order[0] for order in orders]
+        self.order_customers = [order[1] for order in orders]
+        self.order_deposits = np.array([order[2] for order in orders], dtype=np.int64)
+        self.order_deposit_paid = np.array([order[3] for order in orders], dtype=bool)
+        self.order_delivery = np.array([order[4] for order in orders], dtype=bool)
+        order_index = _index(self.order_pks)
+        quantities = list(OrderQuantity.objects.filter(for_order__in=self.order_pks).values_list('for_order', 'for_recipe', 'quantity'))
+        self.quantity_orders = np.array([order_index[order] for order, recipe, quantity in quantities], dtype=np.intp)
+        self.quantity_recipes = np.array([recipe_index[recipe] for order, recipe, quantity in quantities], dtype=np.intp)
+        self.quantities = np.array([quantity for order, recipe, quantity in quantities], dtype=np.int64)
+
+    def get_unit_costs(self, unit_costs=None, multipliers=None):
+        '''Return a copy of the current unit costs with the given changes.
+        unit_costs and multipliers map Groceries, primary keys or names to a
+        new unit cost or a factor applied to the current one.
+        '''
+        costs = self.unit_costs.copy()
+        position = _index(self.grocery_pks)
+        def locate(grocery):
+            if isinstance(grocery, str):
+                try:
+                    grocery = self.grocery_names[normalize_name(grocery)]
+                except KeyError:
+                    raise Grocery.DoesNotExist(f'No Grocery is named "{grocery}"')
+            return position[getattr(grocery, 'pk', grocery)]
+        for grocery, unit_cost in (unit_costs or {}).items():
+            costs[locate(grocery)] = float(unit_cost)
+        for grocery, multiplier in (multipliers or {}).items():
+            costs[locate(grocery)] *= float(multiplier)
+        return costs
+
+    def simulate(self, unit_costs=None, multipliers=None):
+        '''Return the Simulation for the current unit costs with the changes
+        described in get_unit_costs()
+        '''
+        costs = self.get_unit_costs(unit_costs, multipliers)
+        #Component costs are rounded to cents as they are when saved
+        component_cost = np.bincount(self.ingredient_components,
+            weights=self.ingredient_amounts * costs[self.ingredient_groceries], minlength=self.component_count)
+        component_cost = np.rint(component_cost * 100).astype(np.int64)
+        recipe_cost = np.bincount(self.link_recipes, weights=component_cost[self.link_components],
+            minlength=len(self.recipe_pks)).astype(np.int64)
+        #ceil(cost + hours * rate), in thousandths of a dollar
+        recipe_price = -(-(recipe_cost * 10 + self.recipe_time_cost) // 1000)
+
+        order_count = len(self.order_pks)
+        total = np.bincount(self.quantity_orders, weights=recipe_price[self.quantity_recipes] * self.quantities,
+            minlength=order_count).astype(np.int64)
+        total = _round_up_to_five(total)
+        #the deposit covers the ingredient cost and at least 30% of the total;
+        #0.3 * total is a float in Order._calculate_prices() too
+        deposit_cents = np.bincount(self.quantity_orders, weights=recipe_cost[self.quantity_recipes] * self.quantities,
+            minlength=order_count).astype(np.int64)
+        deposit = np.maximum(-(-deposit_cents // 100), np.ceil(0.3 * total).astype(np.int64))
+        deposit = _round_up_to_five(deposit)
+        deposit = np.where(self.order_deposit_paid, self.order_deposits, deposit)
+        total = total + np.where(self.order_delivery, DELIVERY_FEE, 0)
+        return Simulation(self, recipe_cost, recipe_price, total, deposit)
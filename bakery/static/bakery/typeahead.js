@@ -0,0 +1,61 @@
+//Typeahead search for the select elements of bakery/search_select.html.
+//Matches for the text typed are fetched from the input's data-url and
+//offered in its datalist; choosing one adds it to the select as a selected
+//option and sends the select a change event. Prefix matches are tried
+//first and substring matches if there are none.
+document.querySelectorAll("input.typeahead").forEach(function(input) {
+    var select = document.getElementById(input.dataset.select);
+    var datalist = document.getElementById(input.getAttribute("list"));
+    var matches = {};
+    var timer = null;
+
+    function choose(match) {
+        var option = select.querySelector('option[value="' + match.id + '"]');
+        if(!option) {
+            option = new Option(match.name, match.id);
+            for(var field in match) {
+                if(field != "id" && field != "name") {
+                    option.setAttribute("data-" + field, match[field]);
+                }
+            }
+            select.appendChild(option);
+        }
+        option.selected = true;
+        input.value = "";
+        select.dispatchEvent(new Event("change"));
+    }
+
+    function search(query, match) {
+        var url = input.dataset.url + (input.dataset.url.indexOf("?") < 0 ? "?" : "&") +
+            "q=" + encodeURIComponent(query) + "&match=" + match;
+        fetch(url, {credentials: "same-origin"}).then(function(response) {
+            return response.json();
+        }).then(function(data) {
+            if(input.value.trim() != query) {
+                return;
+            }
+            if(!data.results.length && match == "prefix") {
+                search(query, "contains");
+                return;
+            }
+            matches = {};
+            datalist.innerHTML = "";
+            data.results.forEach(function(result) {
+                matches[result.name] = result;
+                datalist.appendChild(new Option(result.name));
+            });
+        });
+    }
+
+    input.addEventListener("input", function() {
+        var query = input.value.trim();
+        if(query in matches) {
+            choose(matches[query]);
+            return;
+        }
+        clearTimeout(timer);
+        if(query) {
+            timer = setTimeout(function() { search(query, "prefix"); }, 150);
+        }
+    });
+});
@@ -1,26 +1,25 @@
 from django import template
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
-from bakery.models import Grocery, Ingredient, Recipe
+from django.utils.html import format_html, format_html_join
+from bakery.models import Ingredient, Recipe, GroceryResolver
+from bakery.units import UNIT_NAMES
+from bakery import lookups, page_cache
+from bakery.search import SEARCHES
 from datetime import datetime, date
+import warnings
 
 register = template.Library()
 
-@register.simple_tag
-def get_grocery_unit_dict():
-    '''Return a dictionary containing a list of the default units and a 
-    hash for each Grocery name
-    '''
-    groceries = Grocery.objects.all()
-    dict = {}
-    for item in groceries:
-        dict[item.name] = [item.default_units, item.hash]
-    return mark_safe(dict)
-
 @register.simple_tag
 def get_recipes():
-    '''Return a dictionary of Recipe names using their database ids as keys
+    '''Return a dictionary of Recipe names using their database ids as keys.
+    Deprecated: this embeds the whole table in every page; load 
+    {% lookup_url 'recipes' %} instead.
     '''
+    warnings.warn(
+        "get_recipes is deprecated; load {% lookup_url 'recipes' %} instead",
+        DeprecationWarning, stacklevel=2)
     recipes = Recipe.objects.all()
     dict = {}
     for item in recipes:
@@ -31,14 +30,82 @@ def get_recipes():
 def get_recipe_options(pk=None):
     '''Display an <option> for a <select> element for each Recipe where the value attribute
     is the primary key for the Recipe. The Recipe corresponding to the (optionally) given 
-    primary key will be set as the selected option
+    primary key will be set as the selected option. Deprecated: this renders 
+    every Recipe for every select element; fill them from 
+    {% lookup_url 'recipes' %} instead.
     '''
+    warnings.warn(
+        "get_recipe_options is deprecated; fill select elements from {% lookup_url 'recipes' %} instead",
+        DeprecationWarning, stacklevel=2)
     recipes = Recipe.objects.all()
     dict = {}
     for item in recipes:
         dict[item.id] = item.name
     return {'name':dict, 'pk':pk}
 
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, name, instance):
+        self.nodelist = nodelist
+        self.name = name
+        self.instance = instance
+
+    def render(self, context):
+        key = page_cache.fragment_key(self.name.resolve(context), self.instance.resolve(context))
+        content = page_cache.get_fragment(key)
+        if content is None:
+            content = self.nodelist.render(context)
+            page_cache.set_fragment(key, content)
+        return content
+
+@register.tag
+def cachedfragment(parser, token):
+    '''Render the enclosed template from the cache until the given object
+    changes, e.g. {% cachedfragment 'order-card' order %} ... {% endcachedfragment %}
+    The fragment must depend only on the object.
+    '''
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' takes a fragment name and an object")
+    nodelist = parser.parse(('endcachedfragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]))
+
+@register.filter
+def selected_choices(bound_field):
+    '''Return the objects chosen in a form's SearchChoiceField as a list,
+    loading any given as primary keys with one query
+    '''
+    field = bound_field.field
+    chosen = getattr(bound_field.form, 'cleaned_data', {}).get(bound_field.name)
+    if chosen is None:
+        chosen = bound_field.value()
+    if chosen in field.empty_values:
+        return []
+    if not field.multiple or isinstance(chosen, (str, int)):
+        chosen = [chosen]
+    pks = [item for item in chosen if not hasattr(item, 'pk')]
+    try:
+        objects = field.model.objects.in_bulk([int(pk) for pk in pks]) if pks else {}
+    except ValueError:
+        return []
+    chosen = [item if hasattr(item, 'pk') else objects.get(int(item)) for item in chosen]
+    return [item for item in chosen if item is not None and field.accepts(item)]
+
+@register.simple_tag
+def search_option(kind, item):
+    '''Return a selected <option> for an object chosen with a typeahead
+    search, with the same data attributes as one added by typeahead.js
+    '''
+    attributes = format_html_join('', ' data-{}="{}"', ((field, getattr(item, field)) for field in SEARCHES[kind][1]))
+    return format_html('<option value="{}" selected{}>{}</option>', item.pk, attributes, item.name)
+
+@register.simple_tag
+def lookup_url(name):
+    '''Return the URL of the current version of the JSON lookup table name,
+    e.g. 'recipes'. See bakery.lookups.
+    '''
+    return lookups.get_url(name)
+
 @register.filter
 def dict_to_list(dict):
     '''Convert a dictionary into a list of key-value pairs sorted by key
@@ -54,37 +121,17 @@ def get_option_tag(str):
     '''Return a string formatted for use as an option of a select element.
     The returned string is not marked safe because this tag is intended to
     produce a string that is used in a comparison and not as actual html.
-    str must be a key in the units dictionary.
+    str must be a key in bakery.units.UNIT_NAMES.
     '''
-    units = {
-        'ct': 'Count',
-        'p': 'Pinch',
-        'tsp': 'Teaspoon',
-        'tbsp': 'Tablespoon',
-        'floz': 'Fluid Ounce',
-        'C': 'Cup',
-        'pt': 'Pint',
-        'qt': 'Quart',
-    }
-    return f'<option value="{str}">{units[str]}</option>'
+    return f'<option value="{str}">{UNIT_NAMES[str]}</option>'
 
 @register.filter
 @stringfilter
 def get_option_tag_selected(str):
     '''Return a string formatted for use as an option of a select element.
-    str must be a key in the units dictionary.
+    str must be a key in bakery.units.UNIT_NAMES.
     '''
-    units = {
-        'ct': 'Count',
-        'p': 'Pinch',
-        'tsp': 'Teaspoon',
-        'tbsp': 'Tablespoon',
-        'floz': 'Fluid Ounce',
-        'C': 'Cup',
-        'pt': 'Pint',
-        'qt': 'Quart',
-    }
-    return mark_safe(f'<option value="{str}" selected>{units[str]}</option>')
+    return mark_safe(f'<option value="{str}" selected>{UNIT_NAMES[str]}</option>')
 
 @register.filter
 @stringfilter
@@ -105,11 +152,15 @@ def is_addedRecipe(str):
 
 @register.filter
 @stringfilter
-def get_grocery_name(custom_amount_hash):
+def get_grocery_name(custom_amount_hash, resolver=None):
     '''Return the name attribute of the Grocery object corresponding 
-    to the given hash value
+    to the given hash value. Pass the form's GroceryResolver as the 
+    argument to avoid a query for each field, e.g. 
+    {{ field.html_name|get_grocery_name:form.resolver }}
     '''
-    return Grocery.objects.get(hash=revert_name(custom_amount_hash)).name
+    if resolver is None:
+        resolver = GroceryResolver()
+    return resolver.get(revert_name(custom_amount_hash)).name
 
 @register.filter
 @stringfilter
@@ -141,8 +192,12 @@ def get_date():
 @register.simple_tag
 def get_ingredient(grocery, component):
     '''Return the Ingredient object corresponding to the given Grocery 
-    and Component objects
+    and Component objects. Deprecated: this runs a query for every call; 
+    use the 'ingredients' list provided by ComponentDetailView instead.
     '''
+    warnings.warn(
+        "get_ingredient is deprecated; use the 'ingredients' context from ComponentDetailView",
+        DeprecationWarning, stacklevel=2)
     return Ingredient.objects.get(for_grocery=grocery, for_component=component)
 
 @register.filter
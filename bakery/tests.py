@@ -1,8 +1,30 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.apps import apps
+from django.db import connection, transaction, IntegrityError
+from django.db.models.signals import post_migrate
+from django.test.utils import CaptureQueriesContext
 
 from decimal import Decimal
+from collections import Counter
+from unittest import skipUnless, mock
+from datetime import date, timedelta
+from io import StringIO, BytesIO
+import tempfile
+import json
+import os
+from PIL import Image
+from fractions import Fraction
 
-from .models import Grocery
+from . import units, thumbnails, images, simulator, page_cache, lookups, fulltext, unit_of_work
+from .models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity, GroceryResolver, ThumbnailJob, StoredImage, recalculate_component_costs, reprice_orders, save_ingredients, save_components, RecipeGrocery, normalize_name
+from .quantities import parse_quantity, parse_quantities
+from .forms import parse_str_to_decimal, RecipeForm, GroceryForm
+from .shopping import shopping_list, FIELDS
+from .management.commands.import_prices import parse_price_line
 
 # Create your tests here.
 class GroceryModelTests(TestCase):
@@ -82,4 +104,1187 @@ class GroceryModelTests(TestCase):
         """
         a = Grocery(name='Milk', cost=Decimal('1.12'), cost_amount=Decimal('0.5'), units='qt')
         a.calculate_unit_cost()
-        self.assertEqual(Grocery.objects.get(name='Milk').unit_cost, Decimal('0.56'))
\ No newline at end of file
+        self.assertEqual(Grocery.objects.get(name='Milk').unit_cost, Decimal('0.56'))
+
+def create_bakery_fixture():
+    """
+    Create two Groceries, two Components sharing the first Grocery, a Recipe using
+    both Components and an upcoming Order for two of that Recipe
+    """
+    flour = Grocery(name='Flour', cost=Decimal('2.40'), cost_amount=Decimal(12), units='C', default_units='C')
+    flour.calculate_values()
+    eggs = Grocery(name='Eggs', cost=Decimal('1.50'), cost_amount=Decimal(12), units='ct', default_units='ct')
+    eggs.calculate_values()
+    cake = Component.objects.create(name='Cake', component_type='B')
+    Ingredient.objects.create(for_grocery=flour, for_component=cake, units='C', amount=Decimal(3))
+    Ingredient.objects.create(for_grocery=eggs, for_component=cake, units='ct', amount=Decimal(2))
+    cake.calculate_cost()
+    crumble = Component.objects.create(name='Crumble', component_type='D')
+    Ingredient.objects.create(for_grocery=flour, for_component=crumble, units='tbsp', amount=Decimal(8))
+    crumble.calculate_cost()
+    recipe = Recipe.objects.create(name='Coffee Cake', time_estimate=Decimal(1), time_actual=Decimal(1))
+    recipe.components.add(cake, crumble)
+    recipe.calculate_values()
+    order = Order.objects.create(customer='Alice', delivery_date=date.today() + timedelta(days=3))
+    OrderQuantity.objects.create(for_recipe=recipe, for_order=order, quantity=2)
+    order.calculate_prices()
+    return flour, eggs, cake, crumble, recipe, order
+
+class CostPropagationTests(TestCase):
+    def test_grocery_update_propagates(self):
+        """
+        Grocery.update() recalculates dependent Components, Recipes and Orders
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).price, 11)
+        flour.cost = Decimal('24.00')
+        flour.save()
+        flour.update()
+        self.assertEqual(Component.objects.get(pk=cake.pk).cost, Decimal('6.25'))
+        self.assertEqual(Component.objects.get(pk=crumble.pk).cost, Decimal('1.00'))
+        recipe = Recipe.objects.get(pk=recipe.pk)
+        self.assertEqual(recipe.cost, Decimal('7.25'))
+        self.assertEqual(recipe.price, 18)
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.quoted_price, 40)
+        self.assertEqual(order.deposit, 15)
+
+    def test_shared_dependents_are_written_once(self):
+        """
+        a Recipe reachable through two changed Components is recalculated in one
+        pass, with one write to each table
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        flour.cost = Decimal('24.00')
+        flour.calculate_values()
+        with CaptureQueriesContext(connection) as queries:
+            flour.update()
+        updates = Counter(query['sql'].split('"')[1] for query in queries if query['sql'].startswith('UPDATE'))
+        #updated_at is written with the costs
+        self.assertEqual(updates, {
+            'bakery_grocery': 1,
+            'bakery_component': 1,
+            'bakery_recipe': 1,
+            'bakery_order': 1,
+            'bakery_recipegrocery': 1,
+        })
+
+    def test_past_orders_are_not_repriced(self):
+        """
+        Orders delivered before today keep their quoted price
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Order.objects.filter(pk=order.pk).update(delivery_date=date.today() - timedelta(days=1))
+        flour.cost = Decimal('24.00')
+        flour.update()
+        self.assertEqual(Order.objects.get(pk=order.pk).quoted_price, 25)
+
+    def test_recalculate_all_component_costs(self):
+        """
+        recalculate_component_costs() rebuilds every Component with one query to
+        read and one query to write
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Component.objects.update(cost=0)
+        with self.assertNumQueries(2):
+            changed = recalculate_component_costs()
+        self.assertEqual(len(changed), 2)
+        self.assertEqual(Component.objects.get(pk=cake.pk).cost, Decimal('0.85'))
+        self.assertEqual(Component.objects.get(pk=crumble.pk).cost, Decimal('0.10'))
+
+class UnitConversionTests(TestCase):
+    def test_factor_is_exact(self):
+        """
+        conversion factors between volume units are exact Fractions
+        """
+        self.assertEqual(units.factor('tsp', 'tbsp'), Fraction(1, 3))
+        self.assertEqual(units.convert(Decimal('1.5'), 'C', 'tsp'), 72)
+        self.assertEqual(units.convert_many([1, 2, 3], 'tbsp', 'tsp'), [3, 6, 9])
+        with self.assertRaises(ValueError):
+            units.factor('ct', 'C')
+
+    def test_ingredient_cost_matches_database(self):
+        """
+        Component.calculate_cost() agrees with Ingredient.get_cost() when every
+        stored value is a whole number
+        """
+        sugar = Grocery(name='Sugar', cost=Decimal(6), cost_amount=Decimal(3), units='C', default_units='tsp')
+        sugar.calculate_values()
+        frosting = Component.objects.create(name='Frosting', component_type='I')
+        ingredient = Ingredient.objects.create(for_grocery=sugar, for_component=frosting, units='tsp', amount=Decimal(3))
+        frosting.calculate_cost()
+        self.assertEqual(ingredient.get_cost(), Decimal('0.125'))
+        self.assertEqual(Component.objects.get(pk=frosting.pk).cost, Decimal('0.12'))
+
+class QuantityParserTests(TestCase):
+    def test_valid_quantities(self):
+        """
+        whole numbers, mixed numbers, fractions and decimals parse to exact Fractions
+        """
+        self.assertEqual(parse_quantity('2'), (True, Fraction(2)))
+        self.assertEqual(parse_quantity(' 2  1/4 '), (True, Fraction(9, 4)))
+        self.assertEqual(parse_quantity('1/3'), (True, Fraction(1, 3)))
+        self.assertEqual(parse_quantity('.5'), (True, Fraction(1, 2)))
+        self.assertEqual(parse_str_to_decimal('2 1/4'), (True, Decimal('2.25')))
+
+    def test_error_messages(self):
+        """
+        invalid quantities report the same messages as before
+        """
+        self.assertEqual(parse_quantity('2a')[1], '\"%(str)s\" contains invalid characters. Use only the character \"/\" or \".\" and numbers.')
+        self.assertEqual(parse_quantity('.')[1], '\"%(str)s\" contains no numbers.')
+        self.assertEqual(parse_quantity('1.2.3')[1], '\"%(str)s\" contains too many decimals. Only one is allowed.')
+        self.assertEqual(parse_quantity('1 .5')[1], '\"%(str)s\" contains invalid characters. Do not combine spaces with a decimal.')
+        self.assertEqual(parse_quantity('1/2.5')[1], '\"%(str)s\" contains invalid characters. Do not combine a slash with a decimal.')
+        self.assertEqual(parse_quantity('1/2/3')[1], '\"%(str)s\" contains too many slashes. Only one is allowed.')
+        self.assertEqual(parse_quantity('1 1/0')[1], '\"%(str)s\" cannot divide by zero.')
+        self.assertFalse(parse_quantity('1 2')[0])
+        self.assertFalse(parse_quantity('1/2 3')[0])
+
+    def test_batch_parses_repeats_once(self):
+        """
+        parse_quantities() returns one result per distinct string
+        """
+        results = parse_quantities(['1/2', '1/2', 'x'])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results['1/2'], (True, Fraction(1, 2)))
+        self.assertFalse(results['x'][0])
+
+class ImportPricesTests(TestCase):
+    def import_prices(self, text, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as sheet:
+            sheet.write(text)
+            sheet.flush()
+            out = StringIO()
+            err = StringIO()
+            call_command('import_prices', sheet.name, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_parse_price_line(self):
+        """
+        price sheet lines are split into name, cost, amount and units
+        """
+        self.assertEqual(parse_price_line('Flour, AP 2.48 18C'), ('Flour, AP', Decimal('2.48'), Decimal(18), 'C'))
+        self.assertEqual(parse_price_line('baking soda 1.48 41.87tsp'), ('Baking Soda', Decimal('1.48'), Decimal('41.87'), 'tsp'))
+        self.assertEqual(parse_price_line('Cream 2 1 1/2pt'), ('Cream', Decimal(2), Decimal('1.5'), 'pt'))
+        with self.assertRaises(ValueError):
+            parse_price_line('Icing 1.59 ct')
+
+    def test_import_creates_and_propagates(self):
+        """
+        new Groceries are created, changed Groceries are updated and their
+        dependents are recalculated, and invalid lines are counted and reported
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        out, err = self.import_prices('Flour 24.00 12C\nEggs 1.50 12ct\nMilk 3.43 16C\n\n3df4b4 - green\n')
+        self.assertIn('3 entries: 1 new, 1 changed, 1 skipped', out)
+        self.assertIn('line 5 skipped: expected "Name cost amount+units": 3df4b4 - green', err)
+        self.assertEqual(self.import_prices('Milk 3.43 16C\nMilk 1.O0 1C\n', '--verbosity', '0')[1], '')
+        self.assertEqual(Grocery.objects.get(name='Milk').unit_cost, Decimal('0.214375'))
+        self.assertEqual(Grocery.objects.get(pk=flour.pk).unit_cost, Decimal(2))
+        self.assertEqual(Component.objects.get(pk=cake.pk).cost, Decimal('6.25'))
+        self.assertEqual(Order.objects.get(pk=order.pk).quoted_price, 40)
+
+    def test_dry_run(self):
+        """
+        --dry-run reports changes without saving them
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        out, err = self.import_prices('Flour 24.00 12C\nMilk 3.43 16C\n', '--dry-run')
+        self.assertIn('~ Flour: 2.40 12C -> 24.00 12C', out)
+        self.assertIn('+ Milk: 3.43 16C', out)
+        self.assertFalse(Grocery.objects.filter(name='Milk').exists())
+        self.assertEqual(Grocery.objects.get(pk=flour.pk).cost, Decimal('2.40'))
+
+class ComponentDetailViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_query_count_is_constant(self):
+        """
+        the component detail page uses the same number of queries regardless
+        of how many Ingredients the Component has
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('bakery:component-detail', args=(crumble.pk,)))
+        self.assertEqual(len(response.context['ingredients']), 1)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('bakery:component-detail', args=(cake.pk,)))
+        self.assertEqual([item.for_grocery.name for item in response.context['ingredients']], ['Eggs', 'Flour'])
+        self.assertContains(response, '($0.60)')
+
+class GroceryResolverTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_resolves_hashes_with_one_query(self):
+        """
+        GroceryResolver fetches all requested hashes together and caches them
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        with self.assertNumQueries(1):
+            resolver = GroceryResolver([flour.hash, eggs.hash, 'amissing'])
+            self.assertEqual(resolver.get(flour.hash).name, 'Flour')
+            self.assertEqual(resolver.get(eggs.hash).name, 'Eggs')
+            with self.assertRaises(Grocery.DoesNotExist):
+                resolver.get('amissing')
+
+    def test_component_form_query_count_is_flat(self):
+        """
+        submitting a component form uses the same number of queries however
+        many ingredients it has
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        query_counts = []
+        for groceries in ([flour], [flour, eggs]):
+            data = {'name': 'Muffin', 'component_type': 'B', 'groceries': [item.pk for item in groceries]}
+            for grocery in groceries:
+                #an invalid amount re-renders the form with every ingredient field
+                data['custom_amount_' + grocery.hash] = 'x'
+                data['custom_units_' + grocery.hash] = grocery.default_units
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('bakery:create-component'), data)
+            self.assertContains(response, 'contains invalid characters')
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+class SaveIngredientsTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_only_differences_are_written(self):
+        """
+        save_ingredients() keeps unchanged Ingredient rows, updates changed
+        ones in place and reports whether anything affecting cost changed
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        before = dict(Ingredient.objects.filter(for_component=cake).values_list('for_grocery', 'pk'))
+        #the savepoint, its release and one SELECT
+        with self.assertNumQueries(3):
+            self.assertFalse(save_ingredients(cake, {flour: (Decimal('3.0001'), 'C'), eggs: (2, 'ct')}))
+        self.assertTrue(save_ingredients(cake, {flour: (Decimal(4), 'C'), eggs: (2, 'ct')}))
+        after = dict(Ingredient.objects.filter(for_component=cake).values_list('for_grocery', 'pk'))
+        self.assertEqual(before, after)
+        self.assertEqual(Ingredient.objects.get(pk=after[flour.pk]).amount, 4)
+        self.assertTrue(save_ingredients(cake, {eggs: (Decimal(1) / 3, 'ct')}))
+        self.assertEqual(list(Ingredient.objects.filter(for_component=cake).values_list('pk', 'amount')),
+            [(before[eggs.pk], Decimal('0.333'))])
+
+    def test_edit_without_amount_changes_skips_propagation(self):
+        """
+        editing only a Component's notes leaves its Ingredients and costs alone
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        data = {'name': 'Cake', 'component_type': 'B', 'notes': 'moist', 'groceries': [flour.pk, eggs.pk],
+            'custom_amount_' + flour.hash: '3', 'custom_units_' + flour.hash: 'C',
+            'custom_amount_' + eggs.hash: '2', 'custom_units_' + eggs.hash: 'ct'}
+        before = list(Ingredient.objects.values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('bakery:edit-component', args=(cake.pk,)), data)
+        self.assertRedirects(response, reverse('bakery:component-detail', args=(cake.pk,)))
+        self.assertEqual(list(Ingredient.objects.values_list('pk', flat=True)), before)
+        self.assertFalse([query for query in queries if 'bakery_recipe' in query['sql']])
+        self.assertEqual(Component.objects.get(pk=cake.pk).notes, 'moist')
+        data['custom_amount_' + flour.hash] = '30'
+        self.client.post(reverse('bakery:edit-component', args=(cake.pk,)), data)
+        self.assertEqual(Component.objects.get(pk=cake.pk).cost, Decimal('6.25'))
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).cost, Decimal('6.35'))
+
+class SaveComponentsTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_only_differences_are_written(self):
+        """
+        save_components() adds and removes only the Components that differ
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        icing = Component.objects.create(name='Icing', component_type='I')
+        self.assertFalse(save_components(recipe, [crumble, cake]))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(save_components(recipe, [cake, icing]))
+        self.assertEqual(len([query for query in queries if query['sql'].startswith(('INSERT', 'DELETE'))]), 2)
+        self.assertEqual(set(recipe.components.all()), {cake, icing})
+
+    def test_edit_without_cost_changes_skips_propagation(self):
+        """
+        editing only a Recipe's notes does not reprice it or its Orders, while
+        changing its time estimate does
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        data = {'name': 'Coffee Cake', 'component_baked': [cake.pk], 'component_decoration': [crumble.pk],
+            'time_estimate': '1', 'hasBeenMadeBefore': 'yes', 'notes': 'serve warm'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('bakery:edit-recipe', args=(recipe.pk,)), data)
+        self.assertRedirects(response, reverse('bakery:recipe-detail', args=(recipe.pk,)))
+        self.assertFalse([query for query in queries if 'bakery_order' in query['sql']])
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).notes, 'serve warm')
+        data['time_estimate'] = '2'
+        self.client.post(reverse('bakery:edit-recipe', args=(recipe.pk,)), data)
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).price, 21)
+        self.assertEqual(Order.objects.get(pk=order.pk).quoted_price, 45)
+
+class BillOfMaterialsTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def materials(self, recipe):
+        return {row.grocery.name: (row.units, row.amount, row.cost)
+            for row in RecipeGrocery.objects.filter(recipe=recipe).select_related('grocery')}
+
+    def test_rows_follow_ingredient_and_component_changes(self):
+        """
+        each Grocery used by a Recipe has one row summed over its Components,
+        kept current when Ingredients, Components or prices change
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        #3 cups plus 8 tablespoons of flour
+        self.assertEqual(self.materials(recipe), {
+            'Flour': ('p', Decimal(1344), Decimal('0.70')),
+            'Eggs': ('ct', Decimal(2), Decimal('0.25')),
+        })
+        self.assertEqual(RecipeGrocery.objects.get(recipe=recipe, grocery=flour).get_default_amount(), Decimal('3.500'))
+        flour.cost = Decimal('24.00')
+        flour.save()
+        flour.update()
+        self.assertEqual(self.materials(recipe)['Flour'], ('p', Decimal(1344), Decimal('7.00')))
+        save_ingredients(cake, {flour: (Decimal(1), 'C')})
+        cake.update()
+        self.assertEqual(self.materials(recipe), {'Flour': ('p', Decimal(576), Decimal('3.00'))})
+        save_components(recipe, [crumble])
+        recipe.update()
+        self.assertEqual(self.materials(recipe), {'Flour': ('p', Decimal(192), Decimal('1.00'))})
+
+    def test_rebuild_command(self):
+        """
+        the rebuild_bill_of_materials command restores missing and stale rows
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        expected = self.materials(recipe)
+        RecipeGrocery.objects.filter(grocery=eggs).delete()
+        RecipeGrocery.objects.filter(grocery=flour).update(amount=1)
+        out = StringIO()
+        call_command('rebuild_bill_of_materials', stdout=out)
+        self.assertIn('2 rows, 2 written', out.getvalue())
+        self.assertEqual(self.materials(recipe), expected)
+        response = self.client.get(reverse('bakery:recipe-detail', args=(recipe.pk,)))
+        self.assertContains(response, '3 1/2 C')
+
+class ShoppingListTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+        flour, eggs, cake, crumble, self.recipe, order = create_bakery_fixture()
+        self.start = order.delivery_date
+        second = Order.objects.create(customer='Bob', delivery_date=self.start + timedelta(days=1))
+        OrderQuantity.objects.create(for_recipe=self.recipe, for_order=second, quantity=1)
+        later = Order.objects.create(customer='Carol', delivery_date=self.start + timedelta(days=30))
+        OrderQuantity.objects.create(for_recipe=self.recipe, for_order=later, quantity=5)
+
+    def test_totals_in_purchase_units(self):
+        """
+        amounts for every Order in the range are multiplied by quantity,
+        summed with one query and converted to the units Groceries are bought in
+        """
+        with self.assertNumQueries(1):
+            rows = list(shopping_list(self.start, self.start + timedelta(days=6)))
+        self.assertEqual(rows, [
+            {'grocery': 'Eggs', 'amount': Decimal(6), 'units': 'ct', 'packages': 1,
+                'package_amount': Decimal(12), 'estimated_cost': Decimal('0.75'), 'package_cost': Decimal('1.50')},
+            {'grocery': 'Flour', 'amount': Decimal('10.5'), 'units': 'C', 'packages': 1,
+                'package_amount': Decimal(12), 'estimated_cost': Decimal('2.10'), 'package_cost': Decimal('2.40')},
+        ])
+        self.assertEqual(list(shopping_list(self.start + timedelta(days=2), self.start + timedelta(days=6))), [])
+
+    def test_units_that_cannot_be_bought(self):
+        """
+        an amount that cannot be converted to the units a Grocery is bought in
+        is listed in its own units without packages or a package cost
+        """
+        Grocery.objects.filter(name='Eggs').update(units='C')
+        rows = list(shopping_list(self.start, self.start + timedelta(days=6)))
+        self.assertEqual(rows[0], {'grocery': 'Eggs', 'amount': Decimal(6), 'units': 'ct', 'packages': None,
+            'package_amount': None, 'estimated_cost': Decimal('0.75'), 'package_cost': None})
+        query = {'start': self.start.isoformat(), 'end': (self.start + timedelta(days=6)).isoformat()}
+        response = self.client.get(reverse('bakery:shopping-list'), dict(query, format='csv'))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[1], 'Eggs,6.000,ct,,,0.75,')
+        self.assertContains(self.client.get(reverse('bakery:shopping-list'), query),
+            '<td>&mdash;</td><td>$0.75</td><td>&mdash;</td>')
+
+    def test_csv_and_json_downloads(self):
+        """
+        the shopping list view streams CSV and JSON
+        """
+        url = reverse('bakery:shopping-list')
+        query = {'start': self.start.isoformat(), 'end': (self.start + timedelta(days=1)).isoformat()}
+        response = self.client.get(url, dict(query, format='csv'))
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(FIELDS))
+        self.assertEqual(lines[2], 'Flour,10.500,C,1,12.000,2.10,2.40')
+        response = self.client.get(url, dict(query, format='json'))
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['start'], query['start'])
+        self.assertEqual([row['grocery'] for row in data['groceries']], ['Eggs', 'Flour'])
+        self.assertContains(self.client.get(url, query), '10 1/2 C')
+        out = StringIO()
+        call_command('shopping_list', '--from', query['start'], '--to', query['end'], stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), lines)
+
+@skipUnless(simulator.numpy_available(), 'NumPy is not installed')
+class PriceSimulatorTests(TestCase):
+    def test_simulation_matches_propagation(self):
+        """
+        simulated prices for a hypothetical unit cost match the prices saved by
+        Grocery.update() for the same cost, and simulating writes nothing
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        prices = simulator.PriceSimulator()
+        with self.assertNumQueries(0):
+            baseline = prices.simulate()
+            simulation = prices.simulate(multipliers={'flour': 10})
+        self.assertEqual(baseline.recipe_changes(baseline), [])
+        self.assertEqual(list(baseline.recipe_price), [11])
+        self.assertEqual(list(baseline.order_price), [Order.objects.get(pk=order.pk).quoted_price])
+        self.assertEqual(simulation.recipe_changes(baseline), [(recipe.pk, 'Coffee Cake', 0.95, 7.25, 11, 18)])
+        self.assertEqual(simulation.order_changes(baseline), [(order.pk, 'Alice', 25, 40, 10, 15)])
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).price, 11)
+        flour.cost = Decimal('24.00')
+        flour.update()
+        self.assertEqual(list(prices.simulate(unit_costs={flour: flour.unit_cost}).order_price),
+            [Order.objects.get(pk=order.pk).quoted_price])
+
+    def test_command(self):
+        """
+        simulate_prices reports changed Recipes and Orders
+        """
+        create_bakery_fixture()
+        out = StringIO()
+        call_command('simulate_prices', 'Flour=10', 'Eggs=$0.125', stdout=out)
+        self.assertIn('Recipe Coffee Cake: cost $0.95 -> $7.25, price $11 -> $18', out.getvalue())
+        self.assertIn('quote $25 -> $40, deposit $10 -> $15', out.getvalue())
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'page-cache-tests'}})
+class PageCacheTests(TransactionTestCase):
+    def setUp(self):
+        page_cache.get_cache().clear()
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def get(self, name):
+        response = self.client.get(reverse(name))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertCached(self, name, cached):
+        self.assertEqual(self.get(name)[page_cache.HEADER], 'hit' if cached else 'miss')
+
+    def test_pages_cached_until_shown_rows_change(self):
+        """
+        list pages are served from the cache until a row they show is saved,
+        and editing a Grocery's name drops only the grocery list
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        names = ('bakery:home', 'bakery:view-groceries', 'bakery:view-components', 'bakery:view-recipes', 'bakery:view-orders')
+        for name in names:
+            self.assertCached(name, False)
+        for name in names:
+            self.assertCached(name, True)
+        self.assertContains(self.get('bakery:view-groceries'), 'Flour')
+        flour.name = 'Bread Flour'
+        flour.save()
+        response = self.get('bakery:view-groceries')
+        self.assertEqual(response[page_cache.HEADER], 'miss')
+        self.assertContains(response, 'Bread Flour')
+        for name in names[2:]:
+            self.assertCached(name, True)
+        self.assertEqual(page_cache.stats()['page_hits'], 9)
+
+    def test_pages_dropped_per_row(self):
+        """
+        editing a Grocery drops only the list page showing it, while adding a
+        Grocery or renaming one, which shifts the rows of every page, drops
+        them all
+        """
+        for number in range(25):
+            Grocery(name=f'Grocery {number:02}', cost=Decimal(1), cost_amount=Decimal(1), units='C', default_units='C').calculate_values()
+        pages = [reverse('bakery:view-groceries'), reverse('bakery:view-groceries') + '?page=2']
+        def cached():
+            return [self.client.get(url)[page_cache.HEADER] == 'hit' for url in pages]
+        self.assertEqual(cached(), [False, False])
+        self.assertEqual(cached(), [True, True])
+        grocery = Grocery.objects.get(name='Grocery 22')
+        grocery.cost = Decimal(2)
+        grocery.update()
+        self.assertEqual(cached(), [True, False])
+        self.assertContains(self.client.get(pages[1]), '$2.00')
+        grocery.name = 'Apricots'
+        grocery.save()
+        self.assertEqual(cached(), [False, False])
+        self.assertEqual(cached(), [True, True])
+        Grocery(name='Zucchini', cost=Decimal(1), cost_amount=Decimal(1), units='C', default_units='C').calculate_values()
+        self.assertEqual(cached(), [False, False])
+
+    def test_cost_change_drops_dependent_pages(self):
+        """
+        a Grocery cost change drops the pages showing the Components, Recipes
+        and Orders it reprices
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        names = ('bakery:home', 'bakery:view-components', 'bakery:view-recipes', 'bakery:view-orders')
+        for name in names:
+            self.get(name)
+        flour.cost = Decimal('24.00')
+        flour.update()
+        for name in names:
+            self.assertCached(name, False)
+        self.assertContains(self.get('bakery:view-recipes'), '<dd>$18</dd>')
+        self.assertContains(self.get('bakery:view-orders'), '<dd>$40</dd>')
+
+    def test_cards_cached_per_object(self):
+        """
+        when one Order changes, the cards of the other Orders are reused
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Order.objects.create(customer='Bob', delivery_date=date.today() + timedelta(days=5))
+        self.get('bakery:view-orders')
+        self.assertEqual(page_cache.stats()['fragment_misses'], 2)
+        order.notes = 'Extra crumble'
+        order.save()
+        self.assertContains(self.get('bakery:view-orders'), 'Extra crumble')
+        stats = page_cache.stats()
+        self.assertEqual((stats['fragment_hits'], stats['fragment_misses']), (1, 3))
+        #the home page shares the card fragments
+        self.get('bakery:home')
+        self.assertEqual(page_cache.stats()['fragment_hits'], 3)
+
+    def test_rolled_back_changes_keep_pages(self):
+        """
+        generations are bumped only when the change commits
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        self.get('bakery:view-groceries')
+        with self.assertRaises(ValueError), transaction.atomic():
+            Grocery.objects.filter(pk=flour.pk).get().delete()
+            raise ValueError
+        self.assertCached('bakery:view-groceries', True)
+        out = StringIO()
+        call_command('cache_stats', '--reset', stdout=out)
+        self.assertIn('Pages: 1 hits, 1 misses (50.0% hit rate)', out.getvalue())
+        self.assertEqual(page_cache.stats()['page_hits'], 0)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'lookup-tests'}})
+class LookupTests(TransactionTestCase):
+    def setUp(self):
+        page_cache.get_cache().clear()
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_versioned_recipe_names(self):
+        """
+        the recipe names are served with a strong ETag, cached for a year when
+        the current version is requested and revalidated after a change
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        url = lookups.get_url('recipes')
+        response = self.client.get(url)
+        self.assertEqual(response.json(), {'recipes': [[recipe.pk, 'Coffee Cake']], 'version': lookups.get_version('recipes')})
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('no-cache', self.client.get(reverse('bakery:lookup-recipes'))['Cache-Control'])
+        #only the session and user are queried once the table is cached
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Recipe.objects.create(name='Apple Pie', time_estimate=Decimal(2))
+        self.assertNotEqual(lookups.get_url('recipes'), url)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([name for pk, name in response.json()['recipes']], ['Apple Pie', 'Coffee Cake'])
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_forms_link_to_tables(self):
+        """
+        the order forms load the recipe names instead of embedding them
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        response = self.client.get(reverse('bakery:create-order'))
+        self.assertContains(response, lookups.get_url('recipes'))
+        self.assertNotContains(response, 'Coffee Cake')
+        response = self.client.get(reverse('bakery:edit-order', args=(order.pk,)))
+        self.assertContains(response, f'data-selected="{recipe.pk}"')
+        self.assertNotContains(response, 'Coffee Cake')
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_not_modified(self):
+        """
+        a detail page answers a matching If-None-Match or If-Modified-Since
+        with 304 after one lookup besides the session and user
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        for name, item in (('grocery-detail', flour), ('component-detail', cake), ('recipe-detail', recipe), ('order-detail', order)):
+            url = reverse(f'bakery:{name}', args=(item.pk,))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('no-cache', response['Cache-Control'])
+            with self.assertNumQueries(3):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(reverse('bakery:grocery-detail', args=(0,))).status_code, 404)
+
+    def test_cost_inputs_move_validators(self):
+        """
+        a Grocery price change moves the ETags of the Components, Recipes and
+        Orders using it, and renaming a Component moves its Groceries' ETags
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        urls = [reverse(f'bakery:{name}', args=(item.pk,)) for name, item in
+            (('grocery-detail', eggs), ('component-detail', cake), ('component-detail', crumble),
+            ('recipe-detail', recipe), ('order-detail', order))]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+        flour.cost = Decimal('24.00')
+        flour.update()
+        for url in urls[1:]:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 200)
+        self.assertEqual(self.client.get(urls[0], HTTP_IF_NONE_MATCH=etags[urls[0]]).status_code, 304)
+        cake.name = 'Sponge'
+        cake.save()
+        self.assertContains(self.client.get(urls[0], HTTP_IF_NONE_MATCH=etags[urls[0]]), 'Sponge')
+
+    def test_renames_and_links_move_validators(self):
+        """
+        renaming a Component or Recipe through its form moves the pages
+        listing it, and linking or unlinking objects moves the pages whose
+        delete button depends on it
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        def url(name, item):
+            return reverse(f'bakery:{name}', args=(item.pk,))
+        def etags():
+            return {page: self.client.get(page)['ETag'] for page in
+                (url('grocery-detail', flour), url('component-detail', crumble), url('recipe-detail', recipe), url('order-detail', order))}
+        def moved(before):
+            return {page for page, etag in before.items() if self.client.get(page, HTTP_IF_NONE_MATCH=etag).status_code == 200}
+        before = etags()
+        self.client.post(url('edit-component', cake), {'name': 'Sponge', 'component_type': 'B', 'groceries': [flour.pk, eggs.pk],
+            f'custom_amount_{flour.hash}': '3', f'custom_units_{flour.hash}': 'C',
+            f'custom_amount_{eggs.hash}': '2', f'custom_units_{eggs.hash}': 'ct'})
+        self.assertEqual(moved(before), {url('grocery-detail', flour), url('recipe-detail', recipe)})
+        self.assertContains(self.client.get(url('grocery-detail', flour)), 'Sponge')
+        recipe_data = {'name': 'Crumb Cake', 'component_baked': [cake.pk], 'component_decoration': [crumble.pk],
+            'time_estimate': '1', 'hasBeenMadeBefore': 'yes'}
+        before = etags()
+        self.client.post(url('edit-recipe', recipe), recipe_data)
+        self.assertEqual(moved(before), {url('grocery-detail', flour), url('order-detail', order), url('recipe-detail', recipe)})
+        self.assertContains(self.client.get(url('order-detail', order)), 'Crumb Cake')
+        before = etags()
+        del recipe_data['component_decoration']
+        self.client.post(url('edit-recipe', recipe), recipe_data)
+        self.assertIn(url('component-detail', crumble), moved(before))
+        self.assertContains(self.client.get(url('component-detail', crumble)), 'data-target="#deleteModal"')
+        before = etags()
+        del before[url('order-detail', order)]
+        self.client.post(reverse('bakery:delete-order'), {'pk': order.pk})
+        self.assertIn(url('recipe-detail', recipe), moved(before))
+
+    def test_past_orders_move_validators(self):
+        """
+        a cost change moves the ETag of past Orders using the changed Recipe,
+        whose pages show its current cost although they are not repriced
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Order.objects.filter(pk=order.pk).update(delivery_date=date.today() - timedelta(days=1))
+        url = reverse('bakery:order-detail', args=(order.pk,))
+        etag = self.client.get(url)['ETag']
+        flour.cost = Decimal('24.00')
+        flour.update()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '14.50')
+        etag = response['ETag']
+        recipe.time_estimate = Decimal(2)
+        recipe.update()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_prefix_and_substring_pages(self):
+        """
+        prefix matches are case insensitive and paginated, and substring
+        matches find names containing the query
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        for name in ('Brown Sugar', 'Sugar', 'Superfine Sugar', 'Salt'):
+            Grocery(name=name, cost=Decimal(1), cost_amount=Decimal(1), units='C', default_units='C').calculate_values()
+        url = reverse('bakery:search', args=('groceries',))
+        data = self.client.get(url, {'q': 'su', 'limit': 1}).json()
+        self.assertEqual(data['results'], [{'id': Grocery.objects.get(name='Sugar').pk, 'name': 'Sugar',
+            'default_units': 'C', 'hash': Grocery.objects.get(name='Sugar').hash}])
+        self.assertTrue(data['has_next'])
+        data = self.client.get(url, {'q': 'su', 'limit': 1, 'page': 2}).json()
+        self.assertEqual([match['name'] for match in data['results']], ['Superfine Sugar'])
+        self.assertFalse(data['has_next'])
+        data = self.client.get(url, {'q': 'sugar', 'match': 'contains'}).json()
+        self.assertEqual([match['name'] for match in data['results']], ['Brown Sugar', 'Sugar', 'Superfine Sugar'])
+        url = reverse('bakery:search', args=('components',))
+        data = self.client.get(url, {'q': 'c', 'component_type': 'D'}).json()
+        self.assertEqual([match['name'] for match in data['results']], ['Crumble'])
+
+    def test_forms_render_only_chosen_objects(self):
+        """
+        the component and recipe forms list only the chosen objects, and all
+        submitted ids are checked with one query per model
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Grocery(name='Salt', cost=Decimal(1), cost_amount=Decimal(1), units='C', default_units='C').calculate_values()
+        response = self.client.get(reverse('bakery:edit-component', args=(cake.pk,)))
+        self.assertContains(response, f'data-hash="{flour.hash}"')
+        self.assertNotContains(response, 'Salt')
+        self.assertNotContains(self.client.get(reverse('bakery:create-recipe')), 'Crumble')
+        data = {'name': 'Coffee Cake', 'component_baked': [cake.pk, crumble.pk], 'time_estimate': '1'}
+        with CaptureQueriesContext(connection) as queries:
+            form = RecipeForm(data, edit='Coffee Cake')
+            self.assertFalse(form.is_valid())
+        self.assertEqual(len([query for query in queries if 'FROM "bakery_component"' in query['sql']]), 1)
+        self.assertIn('Select a valid choice. That choice is not one of the available choices.', form.errors['component_baked'])
+        data['component_baked'] = [cake.pk]
+        data['component_decoration'] = [crumble.pk]
+        form = RecipeForm(data, edit='Coffee Cake')
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['component_decoration'], [crumble])
+
+class NormalizedNameTests(TestCase):
+    def grocery_form(self, name, **kwargs):
+        return GroceryForm({'name': name, 'cost': '1', 'cost_amount': '1', 'units': 'C', 'default_units': 'C'}, **kwargs)
+
+    def test_normalized_name_is_unique(self):
+        """
+        names differing only in case or whitespace have the same normalized
+        name, which the database keeps unique
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        self.assertEqual(Grocery.objects.get(pk=flour.pk).normalized_name, 'flour')
+        cake.name = 'Pound  CAKE'
+        cake.save()
+        self.assertEqual(Component.objects.get(pk=cake.pk).normalized_name, 'pound cake')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Component.objects.create(name='pound cake', component_type='B')
+
+    def test_forms_check_normalized_name(self):
+        """
+        the forms reject names already used in another case with one indexed
+        lookup, allow an object to keep its name in another case, and save
+        names capitalized
+        """
+        create_bakery_fixture()
+        with CaptureQueriesContext(connection) as queries:
+            form = self.grocery_form(' FLOUR ')
+            self.assertFalse(form.is_valid())
+        self.assertIn('"normalized_name" =', queries[0]['sql'])
+        self.assertEqual(form.errors['name'], ['An ingredient named "FLOUR" already exists.'])
+        form = self.grocery_form('flour', edit='Flour')
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['name'], 'Flour')
+        form = self.grocery_form('brown  sugar')
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['name'], 'Brown Sugar')
+
+    def test_normalized_name_fits(self):
+        """
+        a name of the longest allowed length still fits in normalized_name
+        after casefold() lengthens each of its characters
+        """
+        for model in (Grocery, Component, Recipe):
+            name = '\u0390' * model._meta.get_field('name').max_length
+            self.assertLessEqual(len(normalize_name(name)), model._meta.get_field('normalized_name').max_length)
+
+class FullTextSearchTests(TestCase):
+    def create_documents(self):
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        recipe.notes = 'Chocolate glaze on top'
+        recipe.save()
+        order.notes = 'Write "Happy Birthday" in chocolate <script>'
+        order.save()
+        return flour, eggs, cake, crumble, recipe, order
+
+    def test_index_follows_changes(self):
+        """
+        saved, deleted and bulk created objects are indexed, and names rank
+        above notes
+        """
+        if not fulltext.is_indexed():
+            self.skipTest('SQLite was built without FTS5')
+        flour, eggs, cake, crumble, recipe, order = self.create_documents()
+        Component.objects.create(name='Chocolate Ganache', component_type='I')
+        results, has_next = fulltext.search('choc')
+        self.assertEqual([(result['kind'], result['title']) for result in results][0],
+            ('components', '<mark>Chocolate</mark> Ganache'))
+        self.assertEqual({result['id'] for result in results[1:]}, {recipe.pk, order.pk})
+        snippet = [result['snippet'] for result in results if result['kind'] == 'orders'][0]
+        self.assertIn('&quot;Happy Birthday&quot; in <mark>chocolate</mark> &lt;script&gt;', snippet)
+        self.assertEqual(fulltext.search('choc', kinds=['orders'])[0][0]['url'], reverse('bakery:order-detail', args=(order.pk,)))
+        order.notes = ''
+        order.save()
+        recipe.delete()
+        self.assertEqual(len(fulltext.search('choc')[0]), 1)
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as sheet:
+            sheet.write('Cocoa Powder 8.00 2C\n')
+            sheet.flush()
+            call_command('import_prices', sheet.name, stdout=StringIO())
+        self.assertEqual([result['title'] for result in fulltext.search('cocoa')[0]], ['<mark>Cocoa</mark> Powder'])
+
+    def test_rebuild(self):
+        """
+        rebuild_search_index refills the index from the tables
+        """
+        if not fulltext.is_indexed():
+            self.skipTest('SQLite was built without FTS5')
+        self.create_documents()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {fulltext.TABLE}')
+        self.assertEqual(fulltext.search('coffee'), ([], False))
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 6 documents', out.getvalue())
+        self.assertEqual([result['title'] for result in fulltext.search('coffee')[0]], ['<mark>Coffee</mark> Cake'])
+
+    def test_created_after_migrate(self):
+        """
+        post_migrate creates the index, and fills it only if every indexed
+        model's table exists
+        """
+        if not fulltext.is_indexed():
+            self.skipTest('SQLite was built without FTS5')
+        self.addCleanup(fulltext._indexed.clear)
+        self.create_documents()
+        app_config = apps.get_app_config('bakery')
+        def migrate(tables):
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {fulltext.TABLE}')
+            fulltext._indexed.clear()
+            with mock.patch.object(connection.introspection, 'table_names', return_value=tables):
+                post_migrate.send(sender=app_config, app_config=app_config, verbosity=0, interactive=False,
+                    using=connection.alias, apps=apps, plan=[])
+            fulltext._indexed.clear()
+            self.assertTrue(fulltext.is_indexed())
+        tables = [table for table in connection.introspection.table_names() if table != fulltext.TABLE]
+        migrate([table for table in tables if table != Grocery._meta.db_table])
+        self.assertEqual(fulltext.search('coffee'), ([], False))
+        migrate(tables)
+        self.assertEqual([result['title'] for result in fulltext.search('coffee')[0]], ['<mark>Coffee</mark> Cake'])
+
+    def test_like_fallback(self):
+        """
+        without the index, every word must appear in the name or notes and
+        name matches come first
+        """
+        flour, eggs, cake, crumble, recipe, order = self.create_documents()
+        with mock.patch.object(fulltext, 'is_indexed', return_value=False):
+            results, has_next = fulltext.search('chocolate', limit=1)
+            self.assertEqual([result['id'] for result in results], [recipe.pk])
+            self.assertTrue(has_next)
+            results, has_next = fulltext.search('CHOCOLATE birthday')
+            self.assertEqual([result['kind'] for result in results], ['orders'])
+            self.assertIn('<mark>Birthday</mark>&quot; in <mark>chocolate</mark> &lt;script&gt;', results[0]['snippet'])
+            self.assertEqual(fulltext.search('cake', kinds=['components'])[0][0]['title'], '<mark>Cake</mark>')
+
+    def test_view(self):
+        """
+        the search page lists highlighted results with links to the next page
+        """
+        self.create_documents()
+        self.client.force_login(User.objects.create_user('baker'))
+        with self.settings(BAKERY_FULLTEXT_LIMIT=1):
+            response = self.client.get(reverse('bakery:full-text-search'), {'q': 'chocolate'})
+        self.assertContains(response, '<mark>')
+        self.assertContains(response, '?q=chocolate&amp;kind=&amp;page=2')
+        self.assertNotContains(response, '<script>')
+        response = self.client.get(reverse('bakery:full-text-search'), {'q': 'chocolate', 'kind': 'groceries'})
+        self.assertContains(response, 'Nothing matches')
+
+class UnitOfWorkTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def grocery_writes(self, queries):
+        return [query['sql'].split(' ', 1)[0] for query in queries if '"bakery_grocery"' in query['sql'] and
+            not query['sql'].startswith('SELECT')]
+
+    def test_each_object_is_written_once(self):
+        """
+        saving and recalculating an object in one request writes it once,
+        and each recalculation runs once
+        """
+        work = unit_of_work.UnitOfWork()
+        grocery = Grocery(name='Salt', cost=Decimal(1), cost_amount=Decimal(2), units='C', default_units='C')
+        work.save(grocery)
+        work.recalculate(grocery, 'calculate_values')
+        work.recalculate(grocery, 'calculate_values')
+        with CaptureQueriesContext(connection) as queries:
+            work.flush()
+        self.assertEqual(self.grocery_writes(queries), ['INSERT'])
+        self.assertEqual(Grocery.objects.get(name='Salt').unit_cost, Decimal('0.5'))
+        data = {'name': 'Flour', 'cost': '2.40', 'cost_amount': '12', 'units': 'C', 'default_units': 'C'}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('bakery:create-grocery'), data)
+        self.assertEqual(self.grocery_writes(queries), ['INSERT'])
+        flour = Grocery.objects.get(name='Flour')
+        data['cost'] = '4.80'
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('bakery:edit-grocery', args=(flour.pk,)), data)
+        self.assertEqual(self.grocery_writes(queries), ['UPDATE'])
+        self.assertEqual(Grocery.objects.get(pk=flour.pk).unit_cost, Decimal('0.4'))
+
+    def test_order_views(self):
+        """
+        an Order and its OrderQuantities are written and priced in one request
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        data = {'customer': 'Bob', 'recipes': recipe.pk, 'addedRecipe1': recipe.pk,
+            'delivery_date': (date.today() + timedelta(days=1)).isoformat(), 'recipe_counter': 2}
+        self.client.post(reverse('bakery:create-order'), data)
+        created = Order.objects.get(customer='Bob')
+        self.assertEqual(created.orderquantity_set.get().quantity, 2)
+        self.assertEqual(created.quoted_price, order.quoted_price)
+        del data['addedRecipe1']
+        data['customer'] = 'Carol'
+        self.client.post(reverse('bakery:edit-order', args=(created.pk,)), data)
+        created = Order.objects.get(pk=created.pk)
+        self.assertEqual((created.customer, created.orderquantity_set.get().quantity), ('Carol', 1))
+        self.assertEqual(created.quoted_price, 15)
+
+    def test_failed_recalculation_rolls_back(self):
+        """
+        an error while recalculating leaves nothing from the request saved
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        data = {'name': 'Bread Flour', 'cost': '24.00', 'cost_amount': '12', 'units': 'C', 'default_units': 'C'}
+        with mock.patch('bakery.models.propagate_costs', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('bakery:edit-grocery', args=(flour.pk,)), data)
+        flour = Grocery.objects.get(pk=flour.pk)
+        self.assertEqual((flour.name, flour.cost), ('Flour', Decimal('2.40')))
+
+class OrderDetailViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('baker'))
+
+    def test_line_items_and_cost(self):
+        """
+        the order detail page shows per-line cost, price and margin and the
+        total cost using a fixed number of queries
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('bakery:order-detail', args=(order.pk,)))
+        line = response.context['recipes'][0]
+        self.assertEqual(line.line_cost, Decimal('1.90'))
+        self.assertEqual(line.line_price, 22)
+        self.assertEqual(line.margin, Decimal('20.10'))
+        self.assertEqual(response.context['cost'], Decimal('1.90'))
+        self.assertContains(response, '<dd>$1.90</dd>')
+
+class RepriceOrdersTests(TestCase):
+    def test_reprice_orders_matches_calculate_prices(self):
+        """
+        reprice_orders() applies the same rounding, deposit and delivery rules
+        as Order.calculate_prices() and leaves a paid deposit alone
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        paid = Order.objects.create(customer='Bob', delivery_date=date.today(), requires_delivery=True,
+            deposit=5, deposit_paid=True)
+        OrderQuantity.objects.create(for_recipe=recipe, for_order=paid, quantity=3)
+        Recipe.objects.filter(pk=recipe.pk).update(price=13, cost=Decimal('8.00'))
+        with self.assertNumQueries(3):
+            changed = reprice_orders(Order.objects.all())
+        self.assertEqual(len(changed), 2)
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual((order.quoted_price, order.deposit), (30, 20))
+        paid = Order.objects.get(pk=paid.pk)
+        self.assertEqual((paid.quoted_price, paid.deposit), (55, 5))
+        paid.calculate_prices()
+        self.assertEqual((paid.quoted_price, paid.deposit), (55, 5))
+
+    def test_command_skips_earlier_orders(self):
+        """
+        reprice_orders --from only reprices Orders delivered on or after the date
+        """
+        flour, eggs, cake, crumble, recipe, order = create_bakery_fixture()
+        Recipe.objects.filter(pk=recipe.pk).update(price=13)
+        out = StringIO()
+        call_command('reprice_orders', '--from', (date.today() + timedelta(days=4)).isoformat(), stdout=out)
+        self.assertIn('0 changed', out.getvalue())
+        call_command('reprice_orders', stdout=out)
+        self.assertEqual(Order.objects.get(pk=order.pk).quoted_price, 30)
+
+class ThumbnailJobTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        os.makedirs(os.path.join(self.media.name, 'originals'))
+        os.makedirs(os.path.join(self.media.name, 'thumbnails'))
+        Image.new('RGB', (1600, 1200), 'orange').save(os.path.join(self.media.name, 'originals', 'cake.jpg'))
+        self.recipe = Recipe.objects.create(name='Carrot Cake', time_estimate=Decimal(1),
+            image='originals/cake.jpg', user_uploaded_image=True)
+
+    def test_process_creates_thumbnail(self):
+        """
+        a processed job writes a thumbnail that fits within 500x500 and points
+        the Recipe at it
+        """
+        with override_settings(MEDIA_ROOT=self.media.name + '/', MEDIA_URL='/media/'):
+            job = thumbnails.enqueue(self.recipe)
+            self.assertEqual(thumbnails.queue_depth(), 1)
+            self.assertTrue(thumbnails.process(job.pk))
+            self.assertFalse(thumbnails.process(job.pk))
+        job = ThumbnailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ThumbnailJob.DONE)
+        self.assertIsNotNone(job.get_latency())
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).image_thumb, '/media/thumbnails/cake.jpg')
+        with Image.open(os.path.join(self.media.name, 'thumbnails', 'cake.jpg')) as img:
+            self.assertEqual(img.size, (500, 375))
+
+    def test_pixel_limit(self):
+        """
+        images larger than BAKERY_THUMBNAIL_MAX_PIXELS fail without changing the Recipe
+        """
+        with override_settings(MEDIA_ROOT=self.media.name + '/', BAKERY_THUMBNAIL_MAX_PIXELS=1000):
+            job = thumbnails.enqueue(self.recipe)
+            thumbnails.process(job.pk)
+        job = ThumbnailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ThumbnailJob.FAILED)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).image_thumb, self.recipe.image_thumb)
+
+    def test_replaced_image_is_skipped(self):
+        """
+        a job whose image was replaced while it was queued finishes without
+        writing a thumbnail or changing the Recipe
+        """
+        with override_settings(MEDIA_ROOT=self.media.name + '/', MEDIA_URL='/media/'):
+            job = thumbnails.enqueue(self.recipe)
+            Recipe.objects.filter(pk=self.recipe.pk).update(image='images/0123456789abcdef/original.jpg')
+            self.assertTrue(thumbnails.process(job.pk))
+        job = ThumbnailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ThumbnailJob.DONE)
+        self.assertIn('Skipped', job.error)
+        self.assertEqual(os.listdir(os.path.join(self.media.name, 'thumbnails')), [])
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).image_thumb, self.recipe.image_thumb)
+
+class ImageStoreTests(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings = override_settings(MEDIA_ROOT=self.media.name + '/', MEDIA_URL='/media/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 800), 'purple').save(buffer, 'JPEG')
+        self.photo = buffer.getvalue()
+
+    def upload(self, name):
+        return SimpleUploadedFile(name, self.photo, content_type='image/jpeg')
+
+    def test_identical_uploads_are_stored_once(self):
+        """
+        uploading the same content twice reuses one StoredImage and its files
+        are removed only when the last reference is released
+        """
+        first = images.store(self.upload('cake.jpg'))
+        second = images.store(self.upload('same cake.jpg'))
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(second.reference_count, 2)
+        original = os.path.join(self.media.name, first.get_original_name())
+        self.assertTrue(os.path.exists(original))
+        images.release(first)
+        self.assertTrue(os.path.exists(original))
+        images.release(first)
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(os.path.exists(original))
+
+    def test_derivatives_and_srcset(self):
+        """
+        resized WebP and original-format copies are generated for every size
+        and listed in the Recipe's srcset values
+        """
+        stored = images.store(self.upload('cake.jpg'))
+        recipe = Recipe.objects.create(name='Cake', time_estimate=Decimal(1), stored_image=stored,
+            image=stored.get_original_name(), user_uploaded_image=True)
+        self.assertEqual(recipe.get_srcset(), '')
+        images.generate_derivatives(stored)
+        recipe = Recipe.objects.get(pk=recipe.pk)
+        with Image.open(os.path.join(self.media.name, stored.get_derivative_name(500, 'webp'))) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (500, 333)))
+        self.assertEqual(recipe.get_srcset(), ', '.join(
+            f'/media/{stored.get_derivative_name(size)} {width}w' for size, width in ((250, 250), (500, 500), (1000, 1000))))
+        self.assertIn('.webp 1000w', recipe.get_webp_srcset())
+        self.assertEqual(images.get_thumbnail_url(stored), f'/media/{stored.get_derivative_name(500)}')
+
+    def test_failed_request_removes_stored_files(self):
+        """
+        an image uploaded by a request that fails is removed along with its
+        rolled back StoredImage, and one still stored by another record is kept
+        """
+        self.client.force_login(User.objects.create_user('baker'))
+        cake = Component.objects.create(name='Cake', component_type='B')
+        data = {'name': 'Carrot Cake', 'time_estimate': '1', 'hasBeenMadeBefore': 'no', 'component_baked': [cake.pk]}
+        def files():
+            return [name for path, directories, names in os.walk(self.media.name) for name in names]
+        with mock.patch('bakery.models.refresh_bill_of_materials', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('bakery:create-recipe'), dict(data, file=self.upload('cake.jpg')))
+        self.assertFalse(Recipe.objects.exists())
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertEqual(files(), [])
+        stored = images.store(self.upload('cake.jpg'))
+        stored_files = files()
+        with mock.patch('bakery.models.refresh_bill_of_materials', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('bakery:create-recipe'), dict(data, file=self.upload('same cake.jpg')))
+        self.assertEqual(StoredImage.objects.get().reference_count, stored.reference_count)
+        self.assertEqual(files(), stored_files)
+
+    def test_rejects_non_images(self):
+        """
+        storing a file that is not an image raises ValueError
+        """
+        with self.assertRaises(ValueError):
+            images.store(SimpleUploadedFile('notes.txt', b'not an image'))
+
+class RegenerateImagesTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings = override_settings(MEDIA_ROOT=self.media.name + '/', MEDIA_URL='/media/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_regenerates_missing_copies_once(self):
+        """
+        the command writes missing copies, updates image_thumb and marks the
+        StoredImage ready, then skips everything on a second run
+        """
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 800), 'orange').save(buffer, 'PNG')
+        stored = images.store(SimpleUploadedFile('cake.png', buffer.getvalue()))
+        for name in ('Cake', 'Same Cake'):
+            Recipe.objects.create(name=name, time_estimate=Decimal(1), stored_image=stored,
+                image=stored.get_original_name(), user_uploaded_image=True)
+        Recipe.objects.create(name='Default', time_estimate=Decimal(1))
+        out = StringIO()
+        call_command('regenerate_images', workers=1, stdout=out)
+        self.assertIn('Processed 1 images with 1 workers', out.getvalue())
+        self.assertIn('6 files written, 0 failed, 2 thumbnails updated', out.getvalue())
+        self.assertTrue(StoredImage.objects.get().derivatives_ready)
+        self.assertEqual(set(Recipe.objects.filter(user_uploaded_image=True).values_list('image_thumb', flat=True)),
+            {f'/media/{stored.get_derivative_name(500)}'})
+        out = StringIO()
+        call_command('regenerate_images', workers=1, stdout=out)
+        self.assertIn('0 files written, 0 failed, 0 thumbnails updated', out.getvalue())
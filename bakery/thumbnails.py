@@ -0,0 +1,155 @@
+'''Recipe thumbnail generation outside of the request/response cycle.
+
+Views call enqueue() after saving an uploaded image. A ThumbnailJob row is
+created and, once the surrounding transaction commits, the job is handed to a
+thread pool. The Recipe keeps its default thumbnail until the job finishes.
+Jobs left pending or running when the process stops are picked up again by
+resume(), which runs the first time the pool is started in a process and can
+also be run with the process_thumbnails management command.
+
+Settings:
+    BAKERY_THUMBNAIL_WORKERS     threads in the pool (default 2)
+    BAKERY_THUMBNAIL_MAX_PIXELS  largest image, in pixels, that will be
+                                 decoded (default 40 million); see
+                                 bakery.images.open_image()
+'''
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction, close_old_connections, connection
+from django.utils import timezone
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Lock
+from time import perf_counter
+import logging
+
+from bakery.models import Recipe, ThumbnailJob
+from bakery.signals import bulk_saved
+from bakery import images
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (500, 500)
+#a running job older than this is assumed to belong to a stopped process
+STALE_AFTER = timedelta(minutes=10)
+
+_executor = None
+_executor_lock = Lock()
+_in_flight = 0
+
+def make_thumbnail(source, destination, size=THUMBNAIL_SIZE):
+    '''Save a copy of the image at the path source, reduced to fit within size,
+    to the path destination
+    '''
+    with images.open_image(source, size) as img:
+        img.thumbnail(size, reducing_gap=2.0)
+        img.save(destination)
+
+def thumbnail_name(image_name):
+    '''Return the path relative to MEDIA_ROOT of the thumbnail for an image'''
+    return 'thumbnails/' + image_name.rsplit('/', 1)[1]
+
+def queue_depth():
+    '''Return the number of thumbnail jobs that have not finished'''
+    return ThumbnailJob.objects.filter(status__in=(ThumbnailJob.PENDING, ThumbnailJob.RUNNING)).count()
+
+def in_flight():
+    '''Return the number of jobs submitted to this process's pool that have not finished'''
+    return _in_flight
+
+def process(job_pk):
+    '''Create the thumbnail for a ThumbnailJob. Returns False if the job no
+    longer exists or was already claimed by another worker.
+    '''
+    claimed = ThumbnailJob.objects.filter(pk=job_pk, status=ThumbnailJob.PENDING).update(
+        status=ThumbnailJob.RUNNING, started_date=timezone.now())
+    if not claimed:
+        return False
+    job = ThumbnailJob.objects.select_related('recipe__stored_image').get(pk=job_pk)
+    if job.recipe.image.name != job.source:
+        #the image was replaced while this job was queued, and the job for the
+        #new image makes its thumbnail
+        job.status = ThumbnailJob.DONE
+        job.error = 'Skipped: the Recipe no longer uses this image'
+        job.finished_date = timezone.now()
+        job.save()
+        logger.info('Thumbnail job %s skipped: %s was replaced', job.pk, job.source)
+        return True
+    stored_image = job.recipe.stored_image
+    start = perf_counter()
+    try:
+        if stored_image is not None:
+            images.generate_derivatives(stored_image)
+            thumb_url = images.get_thumbnail_url(stored_image)
+        else:
+            name = thumbnail_name(job.source)
+            make_thumbnail(default_storage.path(job.source), default_storage.path(name))
+            thumb_url = default_storage.url(name)
+    except Exception as error:
+        job.status = ThumbnailJob.FAILED
+        job.error = str(error)
+        logger.warning('Thumbnail job %s for %s failed: %s', job.pk, job.source, error)
+    else:
+        #skip the Recipe if its image was replaced while this job was running
+        if Recipe.objects.filter(pk=job.recipe_id, image=job.source).update(image_thumb=thumb_url, updated_at=timezone.now()):
+            bulk_saved.send(sender=Recipe, objects=[job.recipe])
+        job.status = ThumbnailJob.DONE
+    job.finished_date = timezone.now()
+    job.save()
+    logger.info('Thumbnail job %s finished in %.3fs (%.3fs after it was queued)',
+        job.pk, perf_counter() - start, job.get_latency())
+    return True
+
+def _work(job_pk):
+    global _in_flight
+    close_old_connections()
+    try:
+        process(job_pk)
+    except Exception:
+        logger.exception('Thumbnail job %s could not be processed', job_pk)
+    finally:
+        with _executor_lock:
+            _in_flight -= 1
+        connection.close()
+
+def _submit(job_pk):
+    global _executor, _in_flight
+    with _executor_lock:
+        start_pool = _executor is None
+        if start_pool:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'BAKERY_THUMBNAIL_WORKERS', 2),
+                thread_name_prefix='thumbnail')
+        _in_flight += 1
+    _executor.submit(_work, job_pk)
+    if start_pool:
+        resume()
+
+def enqueue(recipe):
+    '''Create a ThumbnailJob for recipe's current image, to be run once the
+    current transaction commits. Returns the job.
+    '''
+    job = ThumbnailJob.objects.create(recipe=recipe, source=recipe.image.name)
+    transaction.on_commit(lambda: _submit(job.pk))
+    logger.info('Thumbnail job %s queued for %s', job.pk, job.source)
+    return job
+
+def reset_stale_jobs():
+    '''Mark jobs that have been running for longer than STALE_AFTER as pending
+    so they are retried. Returns the number of jobs reset.
+    '''
+    return ThumbnailJob.objects.filter(
+        status=ThumbnailJob.RUNNING, started_date__lt=timezone.now() - STALE_AFTER,
+    ).update(status=ThumbnailJob.PENDING)
+
+def resume():
+    '''Submit every unfinished ThumbnailJob to the pool, including stale jobs
+    interrupted when a previous process stopped. Returns the number of jobs
+    submitted.
+    '''
+    reset_stale_jobs()
+    pending = list(ThumbnailJob.objects.filter(status=ThumbnailJob.PENDING).values_list('pk', flat=True))
+    for job_pk in pending:
+        _submit(job_pk)
+    return len(pending)
@@ -0,0 +1,99 @@
+'''A request-scoped unit of work for the views that change data.
+
+atomic_request() runs a view in one transaction with a UnitOfWork as
+request.unit_of_work. Instead of saving an object and then recalculating it,
+which saves it again and may cascade to its dependents, the view marks the
+object as changed with save() and names its recalculations with
+recalculate(). When the view returns, flush() saves each changed object once
+and runs each recalculation once, and the transaction commits. Because the
+recalculations run before the commit rather than in transaction.on_commit,
+a failure in one rolls back the whole request instead of leaving stale
+costs.
+
+Objects needing a primary key before the view can link other rows to them,
+such as a new Component before its Ingredients, must still be saved by the
+view. Work outside the database done before the commit, such as writing an
+uploaded image, is undone by the functions given to on_rollback() if the
+request fails.
+'''
+from django.db import transaction
+
+from functools import wraps
+
+class UnitOfWork:
+    '''Collects changed objects, recalculations and other deferred work until
+    flush(). Every recalculation method saves its object, so an object with a
+    recalculation pending is not saved separately.
+    '''
+    def __init__(self):
+        #keyed by _key() so that each object is saved once
+        self.changed = {}
+        #keyed by (_key(), method name) so that each recalculation runs once
+        self.recalculations = {}
+        self.deferred = []
+        self.rollbacks = []
+
+    def _key(self, instance):
+        return (type(instance), instance.pk) if instance.pk is not None else (type(instance), id(instance))
+
+    def save(self, instance):
+        '''Save instance when the unit of work is flushed'''
+        self.changed[self._key(instance)] = instance
+
+    def recalculate(self, instance, method):
+        '''Call the named method of instance, e.g. 'update', when the unit of
+        work is flushed. The method must save instance.
+        '''
+        self.changed[self._key(instance)] = instance
+        self.recalculations[(self._key(instance), method)] = (instance, method)
+
+    def defer(self, function):
+        '''Call function after the objects are saved and recalculated, e.g.
+        to release an image the saved objects no longer use
+        '''
+        self.deferred.append(function)
+
+    def on_rollback(self, function):
+        '''Call function if the transaction is rolled back, e.g. to remove
+        files written for rows that were not kept
+        '''
+        self.rollbacks.append(function)
+
+    def rolled_back(self):
+        '''Call the functions given to on_rollback() and forget the pending work'''
+        for function in self.rollbacks:
+            function()
+        self.changed, self.recalculations, self.deferred, self.rollbacks = {}, {}, [], []
+
+    def flush(self):
+        '''Save each changed object once, then run each recalculation and
+        deferred function once, in the order they were added
+        '''
+        recalculated = {key for key, method in self.recalculations}
+        for key, instance in self.changed.items():
+            if key not in recalculated:
+                instance.save()
+        for instance, method in self.recalculations.values():
+            getattr(instance, method)()
+        for function in self.deferred:
+            function()
+        self.changed, self.recalculations, self.deferred = {}, {}, []
+
+def atomic_request(view):
+    '''Run a view in one transaction with a UnitOfWork as
+    request.unit_of_work, flushed before the transaction commits. If the
+    view, the flush or the commit raises, the unit of work's on_rollback()
+    functions are called.
+    '''
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.unit_of_work = UnitOfWork()
+        try:
+            with transaction.atomic():
+                response = view(request, *args, **kwargs)
+                request.unit_of_work.flush()
+        except Exception:
+            request.unit_of_work.rolled_back()
+            raise
+        return response
+    return wrapper
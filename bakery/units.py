@@ -0,0 +1,69 @@
+'''Exact conversions between the units used by Groceries and Ingredients.
+
+Every volume unit is stored as a whole number of pinches, so a conversion
+between two volume units is an exact Fraction and results never depend on
+the order in which repeating decimals such as 1/3 or 1/384 were rounded.
+Count ('ct') cannot be converted to or from a volume unit.
+'''
+from decimal import Decimal
+from fractions import Fraction
+
+UNIT_TYPES = (
+    ('ct', 'Count'),
+    ('p', 'Pinch'),
+    ('tsp', 'Teaspoon'),
+    ('tbsp', 'Tablespoon'),
+    ('floz', 'Fluid Ounce'),
+    ('C', 'Cup'),
+    ('pt', 'Pint'),
+    ('qt', 'Quart'),
+)
+UNIT_NAMES = dict(UNIT_TYPES)
+
+COUNT = 'ct'
+#number of pinches in one of each volume unit
+PINCHES = {
+    'p': 1,
+    'tsp': 8,
+    'tbsp': 24,
+    'floz': 48,
+    'C': 384,
+    'pt': 768,
+    'qt': 1536,
+}
+
+def factor(from_units, to_units):
+    '''Return the Fraction that an amount in from_units is multiplied by to
+    express it in to_units
+    '''
+    if from_units == to_units:
+        return Fraction(1)
+    try:
+        return Fraction(PINCHES[from_units], PINCHES[to_units])
+    except KeyError:
+        raise ValueError(f"Cannot convert '{from_units}' to '{to_units}'")
+
+def convert(amount, from_units, to_units):
+    '''Return amount (an int, Decimal, Fraction or numeric string) converted
+    from from_units to to_units as an exact Fraction
+    '''
+    return Fraction(amount) * factor(from_units, to_units)
+
+def convert_many(amounts, from_units, to_units):
+    '''Return a list of amounts converted from from_units to to_units as exact
+    Fractions. The conversion factor is looked up once for the whole batch.
+    '''
+    multiplier = factor(from_units, to_units)
+    return [Fraction(amount) * multiplier for amount in amounts]
+
+def to_pinches(amount, units):
+    '''Return amount in units as an exact number of pinches. Counts are
+    returned unchanged.
+    '''
+    if units == COUNT:
+        return Fraction(amount)
+    return Fraction(amount) * PINCHES[units]
+
+def to_decimal(fraction):
+    '''Return a Fraction as a Decimal, rounding only once'''
+    return Decimal(fraction.numerator) / Decimal(fraction.denominator)
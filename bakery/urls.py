@@ -28,4 +28,8 @@ urlpatterns = [
     url(r'^components/detail/(?P<pk>[0-9]+)/$', views.ComponentDetailView.as_view(), name='component-detail'),
     url(r'^recipes/detail/(?P<pk>[0-9]+)/$', views.RecipeDetailView.as_view(), name='recipe-detail'),
     url(r'^orders/detail/(?P<pk>[0-9]+)/$', views.OrderDetailView.as_view(), name='order-detail'),
+    url(r'^shopping/$', views.shopping_list, name='shopping-list'),
+    url(r'^lookups/recipes\.json$', views.lookup_recipes, name='lookup-recipes'),
+    url(r'^search/(?P<kind>groceries|components|recipes)/$', views.search_names, name='search'),
+    url(r'^search/$', views.full_text_search, name='full-text-search'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
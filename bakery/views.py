@@ -1,87 +1,145 @@
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse, JsonResponse, HttpResponseBadRequest
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag, urlencode
 from django.urls import reverse
 from django.views import generic
-from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db.models import F, Sum, Value, ExpressionWrapper, DecimalField, IntegerField
+from django.db.models.functions import Coalesce
 
 from decimal import Decimal
 from datetime import date
 from collections import Counter
-from PIL import Image
-from os import remove
 
-from bakery.models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity
-from .forms import GroceryForm, ComponentForm, RecipeForm, OrderForm, parse_str_to_decimal
+from bakery.models import Grocery, Ingredient, Component, Recipe, Order, OrderQuantity, RecipeGrocery, GroceryResolver, save_ingredients, save_components, AMOUNT_PLACES
+from bakery.signals import bulk_saved
+from . import fulltext, images, lookups, page_cache, search, shopping, thumbnails, unit_of_work
+from .forms import GroceryForm, ComponentForm, RecipeForm, OrderForm, ShoppingListForm, FullTextSearchForm
 
-class HomeView(LoginRequiredMixin, generic.ListView):
+class ConditionalDetailMixin:
+    '''Answer If-None-Match and If-Modified-Since for a DetailView from the
+    object's updated_at, so that an unchanged page costs only the primary key
+    lookup of its object
+    '''
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        updated_at = self.object.updated_at
+        etag = quote_etag(f'{self.model._meta.model_name}-{self.object.pk}-{updated_at.timestamp():.6f}')
+        last_modified = int(updated_at.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self.render_to_response(self.get_context_data(object=self.object))
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        #always revalidate, since the page changes without its URL changing
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+class HomeView(LoginRequiredMixin, page_cache.CachedPageMixin, generic.ListView):
     model = Order
     template_name = 'bakery/home.html'
     context_object_name = 'orders'
+
+    def get_cache_vary(self):
+        #upcoming Orders change with the date
+        return (date.today(),)
     
     def get_queryset(self):
-        return reversed(Order.objects.filter(delivery_date__gte=date.today()))
+        return Order.objects.filter(delivery_date__gte=date.today()).reverse()
 
-class GroceryListView(LoginRequiredMixin, generic.ListView):
+class GroceryListView(LoginRequiredMixin, page_cache.CachedPageMixin, generic.ListView):
     model = Grocery
     template_name = 'bakery/grocery_list.html'
     context_object_name = 'grocery_list'
     paginate_by = 20
 
-class GroceryDetailView(LoginRequiredMixin, generic.DetailView):
+class GroceryDetailView(LoginRequiredMixin, ConditionalDetailMixin, generic.DetailView):
     model = Grocery
     template_name = 'bakery/grocery_detail.html'
     context_object_name = 'grocery_info'
 
-class ComponentListView(LoginRequiredMixin, generic.ListView):
+    def get_context_data(self, **kwargs):
+        context = super(GroceryDetailView, self).get_context_data(**kwargs)
+        grocery = context['grocery_info']
+        context['components'] = Component.objects.filter(groceries=grocery).distinct()
+        context['recipes'] = Recipe.objects.filter(components__groceries=grocery).distinct()
+        return context
+
+class ComponentListView(LoginRequiredMixin, page_cache.CachedPageMixin, generic.ListView):
     model = Component
     template_name = 'bakery/component_list.html'
     context_object_name = 'component_list'
     paginate_by = 10
 
-class ComponentDetailView(LoginRequiredMixin, generic.DetailView):
+class ComponentDetailView(LoginRequiredMixin, ConditionalDetailMixin, generic.DetailView):
     model = Component
     template_name = 'bakery/component_detail.html'
     context_object_name = 'component_info'
 
-class RecipeListView(LoginRequiredMixin, generic.ListView):
+    def get_context_data(self, **kwargs):
+        context = super(ComponentDetailView, self).get_context_data(**kwargs)
+        #add each Ingredient with its Grocery and cost using a single query
+        ingredients = Ingredient.objects.filter(for_component=context['component_info']).select_related('for_grocery').order_by('for_grocery__name')
+        ingredient_list = []
+        for ingredient in ingredients:
+            ingredient.cost = ingredient.get_cost()
+            ingredient_list.append(ingredient)
+        context['ingredients'] = ingredient_list
+        return context
+
+class RecipeListView(LoginRequiredMixin, page_cache.CachedPageMixin, generic.ListView):
     model = Recipe
     template_name = 'bakery/recipe_list.html'
     context_object_name = 'recipe_list'
     paginate_by = 6
+    queryset = Recipe.objects.select_related('stored_image')
         
-class RecipeDetailView(LoginRequiredMixin, generic.DetailView):
+class RecipeDetailView(LoginRequiredMixin, ConditionalDetailMixin, generic.DetailView):
     model = Recipe
+    queryset = Recipe.objects.select_related('stored_image')
     template_name = 'bakery/recipe_detail.html'
     context_object_name = 'recipe_info'
 
-class OrderListView(LoginRequiredMixin, generic.ListView):
+    def get_context_data(self, **kwargs):
+        context = super(RecipeDetailView, self).get_context_data(**kwargs)
+        #total amount and cost of each Grocery from the bill of materials
+        context['groceries'] = RecipeGrocery.objects.filter(recipe=context['recipe_info']).select_related('grocery').order_by('grocery__name')
+        return context
+
+class OrderListView(LoginRequiredMixin, page_cache.CachedPageMixin, generic.ListView):
     model = Order
     template_name = 'bakery/order_list.html'
     context_object_name = 'order_list'
     paginate_by = 6
 
-class OrderDetailView(LoginRequiredMixin, generic.DetailView):
+class OrderDetailView(LoginRequiredMixin, ConditionalDetailMixin, generic.DetailView):
     model = Order
     template_name = 'bakery/order_detail.html'
     context_object_name = 'order_info'
     
     def get_context_data(self, **kwargs):
         context = super(OrderDetailView, self).get_context_data(**kwargs)
-        #add recipe info to context using OrderQuantity
-        cost = 0
-        recipe_list = []
-        for order_quantity in OrderQuantity.objects.filter(for_order=context['order_info']):
-            recipe_list.append(order_quantity)
-            cost += order_quantity.for_recipe.cost * order_quantity.get_quantity()
-        context['recipes'] = recipe_list
-        context['cost'] = cost
+        #add recipe info to context using OrderQuantity; each line and the
+        #cost total are calculated by the database
+        money = DecimalField(max_digits=9, decimal_places=2)
+        line_cost = ExpressionWrapper(F('for_recipe__cost') * F('quantity'), output_field=money)
+        line_price = ExpressionWrapper(F('for_recipe__price') * F('quantity'), output_field=IntegerField())
+        order_quantities = OrderQuantity.objects.filter(for_order=context['order_info']).select_related('for_recipe').annotate(
+            line_cost=line_cost,
+            line_price=line_price,
+        ).annotate(
+            margin=ExpressionWrapper(F('line_price') - F('line_cost'), output_field=money),
+        ).order_by('for_recipe__name')
+        context['recipes'] = list(order_quantities)
+        context['cost'] = order_quantities.aggregate(cost=Coalesce(Sum(line_cost), Value(0), output_field=money))['cost']
         return context
 
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def create_grocery(request):
     if request.method == 'POST':
         form = GroceryForm(request.POST)
@@ -93,8 +151,8 @@ def create_grocery(request):
                     units = form.cleaned_data['units'],
                     default_units = form.cleaned_data['units'] if form.cleaned_data['units'] == 'ct' else form.cleaned_data['default_units']
                     )
-            item.save()
-            item.calculate_values()
+            #saved by calculate_values()
+            request.unit_of_work.recalculate(item, 'calculate_values')
             return HttpResponseRedirect(reverse('bakery:view-groceries'))
     else:
         form = GroceryForm()
@@ -102,6 +160,7 @@ def create_grocery(request):
 
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def edit_grocery(request, pk):
     grocery = get_object_or_404(Grocery, pk=pk)
     if request.method == 'POST':
@@ -112,8 +171,8 @@ def edit_grocery(request, pk):
             grocery.cost_amount = form.cleaned_data['cost_amount']
             grocery.units = form.cleaned_data['units']
             grocery.default_units = form.cleaned_data['units'] if form.cleaned_data['units'] == 'ct' else form.cleaned_data['default_units']
-            grocery.save()
-            grocery.update()
+            #saved by update(), which also recalculates its dependents
+            request.unit_of_work.recalculate(grocery, 'update')
             return HttpResponseRedirect(reverse('bakery:grocery-detail', args=(pk,)))
     else:
         form_info = {
@@ -128,6 +187,7 @@ def edit_grocery(request, pk):
 
 @require_http_methods(["POST"])
 @login_required
+@unit_of_work.atomic_request
 def delete_grocery(request):
     pk=request.POST['pk']
     grocery = get_object_or_404(Grocery, pk=pk)
@@ -147,31 +207,46 @@ def revert_name(str):
             str = str.replace('units_', '')
     return str
 
-def component_sort_post_to_dict(post):
+def component_sort_post_to_dict(post, resolver):
     '''Given a QueryDict.dict() object, return a dictionary of list pairs where each
     pair is a property belonging to a related Grocery and in the order: amount, units
     e.g. {Grocery.name:[['custom_amount_foo', 2], ['custom_units_foo', 'tsp']]}
+    The Groceries are looked up together using the given GroceryResolver.
     '''
     dict = {}
-    for entry in sorted(post):
-        if entry.startswith('custom_'):
-            name = Grocery.objects.get(hash=revert_name(entry)).name
-            try:
-                #units
-                dict[name].append([entry, post[entry]])
-            except KeyError:
-                #amount
-                dict[name] = [[entry, post[entry]]]
+    entries = [entry for entry in sorted(post) if entry.startswith('custom_')]
+    resolver.load(revert_name(entry) for entry in entries)
+    for entry in entries:
+        name = resolver.get(revert_name(entry)).name
+        try:
+            #units
+            dict[name].append([entry, post[entry]])
+        except KeyError:
+            #amount
+            dict[name] = [[entry, post[entry]]]
     return dict
 
+def component_ingredients(form, added_fields_context, resolver):
+    '''Return a dictionary mapping each Grocery in a valid ComponentForm to
+    its (amount, units), for save_ingredients()
+    '''
+    ingredients = {}
+    for entry in added_fields_context:
+        amount_field, units_field = added_fields_context[entry][0][0], added_fields_context[entry][1][0]
+        grocery = resolver.get(revert_name(amount_field))
+        ingredients[grocery] = (form.amounts[amount_field], form.cleaned_data[units_field])
+    return ingredients
+
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def create_component(request):
     added_fields_context = {}
+    resolver = GroceryResolver()
     if request.method == 'POST':
         #manage dynamically-added fields
-        added_fields_context = component_sort_post_to_dict(request.POST.dict())
-        form = ComponentForm(request.POST, extra=added_fields_context)
+        added_fields_context = component_sort_post_to_dict(request.POST.dict(), resolver)
+        form = ComponentForm(request.POST, extra=added_fields_context, resolver=resolver)
         if form.is_valid():
             #create new Component
             item = Component(
@@ -179,20 +254,11 @@ def create_component(request):
                     component_type = form.cleaned_data['component_type'],
                     notes = form.cleaned_data['notes']
                     )
+            #the Ingredients need the Component's primary key
             item.save()
             #link new Component with each Grocery through an Ingredient
-            for entry in added_fields_context:
-                grocery = Grocery.objects.get(name=entry)
-                success, number = parse_str_to_decimal(form.cleaned_data[added_fields_context[entry][0][0]])
-                if success:
-                    ingredient = Ingredient(
-                        for_grocery = grocery,
-                        for_component = item,
-                        units = form.cleaned_data[added_fields_context[entry][1][0]],
-                        amount = number
-                    )
-                    ingredient.save()
-            item.calculate_cost()
+            save_ingredients(item, component_ingredients(form, added_fields_context, resolver))
+            request.unit_of_work.recalculate(item, 'calculate_cost')
             return HttpResponseRedirect(reverse('bakery:view-components'))
     else:
         form = ComponentForm()
@@ -200,37 +266,28 @@ def create_component(request):
     
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def edit_component(request, pk):
     component = get_object_or_404(Component, pk=pk)
     added_fields_context = {}
+    resolver = GroceryResolver()
     if request.method == 'POST':
         #manage dynamically-added fields
-        added_fields_context = component_sort_post_to_dict(request.POST.dict())
-        form = ComponentForm(request.POST, extra=added_fields_context, edit=component.name)
+        added_fields_context = component_sort_post_to_dict(request.POST.dict(), resolver)
+        form = ComponentForm(request.POST, extra=added_fields_context, edit=component.name, resolver=resolver)
         if form.is_valid():
-            #clear existing Ingredient relations
-            Ingredient.objects.filter(for_component=component).delete()
             #update Component
             component.name = form.cleaned_data['name']
             component.component_type = form.cleaned_data['component_type']
             component.notes = form.cleaned_data['notes']
-            component.save()
-            #link Component with each Grocery through an Ingredient
-            for entry in added_fields_context:
-                grocery = Grocery.objects.get(name=entry)
-                success, number = parse_str_to_decimal(form.cleaned_data[added_fields_context[entry][0][0]])
-                if success:
-                    ingredient = Ingredient(
-                        for_grocery = grocery,
-                        for_component = component,
-                        units = form.cleaned_data[added_fields_context[entry][1][0]],
-                        amount = number
-                    )
-                    ingredient.save()
-            component.update()
+            request.unit_of_work.save(component)
+            #add, change and remove only the Ingredients that differ, and
+            #recalculate costs only if one of them did
+            if save_ingredients(component, component_ingredients(form, added_fields_context, resolver)):
+                request.unit_of_work.recalculate(component, 'update')
             return HttpResponseRedirect(reverse('bakery:component-detail', args=(pk,)))
     else:
-        ingredients = Ingredient.objects.filter(for_component=component)
+        ingredients = Ingredient.objects.filter(for_component=component).select_related('for_grocery')
         form_info = {
                 'name':component.name,
                 'component_type':component.component_type,
@@ -240,17 +297,19 @@ def edit_component(request, pk):
         for ingredient in ingredients:
             grocery = ingredient.for_grocery
             grocery_list.append(grocery)
+            resolver.add([grocery])
             amount = 'custom_amount_' + grocery.hash
             units = 'custom_units_' + grocery.hash
             added_fields_context[grocery.name] = [[amount, ingredient.amount], [units, ingredient.units]]
             form_info[amount] = ingredient.amount
             form_info[units] = ingredient.units
         form_info['groceries'] = grocery_list
-        form = ComponentForm(form_info, extra=added_fields_context, edit=component.name)
+        form = ComponentForm(form_info, extra=added_fields_context, edit=component.name, resolver=resolver)
     return render(request, 'bakery/addcomponent.html', {'form': form, 'extra': added_fields_context})
 
 @require_http_methods(["POST"])
 @login_required
+@unit_of_work.atomic_request
 def delete_component(request):
     pk=request.POST['pk']
     component = get_object_or_404(Component, pk=pk)
@@ -259,11 +318,28 @@ def delete_component(request):
         return HttpResponseRedirect(reverse('bakery:view-components'))
     return HttpResponseRedirect(reverse('bakery:component-detail', args=(pk,)))
 
+def recipe_components(form):
+    '''Return every Component selected in a valid RecipeForm'''
+    components = []
+    for field in ('component_baked', 'component_icing', 'component_decoration', 'component_other'):
+        components.extend(form.cleaned_data.get(field))
+    return components
+
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def create_recipe(request):
     if request.method == 'POST':
         form = RecipeForm(request.POST, request.FILES)
+        stored_image = None
+        if form.is_valid() and request.FILES:
+            try:
+                stored_image = images.store(request.FILES['file'])
+            except ValueError as error:
+                form.add_error('image', str(error))
+            else:
+                #the file is written now, so remove it if the request fails
+                request.unit_of_work.on_rollback(lambda: images.discard(stored_image))
         if form.is_valid():
             #create new Recipe
             item = Recipe(
@@ -272,28 +348,18 @@ def create_recipe(request):
                     time_actual = form.cleaned_data['time_estimate'] if request.POST['hasBeenMadeBefore'] == 'yes' else 0,
                     notes = form.cleaned_data['notes']
                     )
-            if request.FILES:
-                item.image = request.FILES['file']
+            if stored_image:
+                item.stored_image = stored_image
+                item.image = stored_image.get_original_name()
                 item.user_uploaded_image = True
+            #the Components and thumbnail job need the Recipe's primary key
             item.save()
-            #create image thumbnail
-            if request.FILES:
-                file = item.image.name.rsplit('/', 1)[1]
-                img = Image.open(settings.MEDIA_ROOT + item.image.name)
-                img.thumbnail((500,500))
-                img.save(settings.MEDIA_ROOT + 'thumbnails/' + file)
-                item.image_thumb = settings.MEDIA_URL + 'thumbnails/' + file
-                item.save()
+            #create resized images in the background
+            if stored_image:
+                thumbnails.enqueue(item)
             #link Recipe to Components
-            for component in form.cleaned_data.get('component_baked'):
-                item.components.add(component)
-            for component in form.cleaned_data.get('component_icing'):
-                item.components.add(component)
-            for component in form.cleaned_data.get('component_decoration'):
-                item.components.add(component)
-            for component in form.cleaned_data.get('component_other'):
-                item.components.add(component)
-            item.calculate_values()
+            item.components.add(*recipe_components(form))
+            request.unit_of_work.recalculate(item, 'calculate_values')
             return HttpResponseRedirect(reverse('bakery:view-recipes'))
     else:
         form = RecipeForm()
@@ -301,52 +367,51 @@ def create_recipe(request):
     
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def edit_recipe(request, pk):
     recipe = get_object_or_404(Recipe, pk=pk)
     context = {}
     context['made_before'] = True if recipe.time_actual else False
     if request.method == 'POST':
         form = RecipeForm(request.POST, request.FILES, edit=recipe.name)
+        stored_image = None
+        if form.is_valid() and request.FILES:
+            try:
+                stored_image = images.store(request.FILES['file'])
+            except ValueError as error:
+                form.add_error('image', str(error))
+            else:
+                #the file is written now, so remove it if the request fails
+                request.unit_of_work.on_rollback(lambda: images.discard(stored_image))
         if form.is_valid():
             #update Recipe
+            times = (recipe.time_estimate, recipe.time_actual)
             recipe.name = form.cleaned_data['name']
-            recipe.time_estimate = form.cleaned_data['time_estimate']
-            recipe.time_actual = form.cleaned_data['time_estimate'] if request.POST['hasBeenMadeBefore'] == 'yes' else 0
+            recipe.time_estimate = form.cleaned_data['time_estimate'].quantize(AMOUNT_PLACES)
+            recipe.time_actual = recipe.time_estimate if request.POST['hasBeenMadeBefore'] == 'yes' else 0
             recipe.notes = form.cleaned_data['notes']
-            if request.FILES:
+            previous_image = None
+            if stored_image:
                 if recipe.user_uploaded_image:
-                    #delete old images
-                    try:
-                        remove(recipe.image.path)
-                    except FileNotFoundError:
-                        pass
-                    try:
-                        remove(settings.MEDIA_ROOT.rsplit('/', 2)[0]+recipe.image_thumb)
-                    except FileNotFoundError:
-                        pass
-                recipe.image = request.FILES['file']
+                    previous_image = (recipe.stored_image, recipe.image.name)
+                recipe.stored_image = stored_image
+                recipe.image = stored_image.get_original_name()
                 recipe.user_uploaded_image = True
-            recipe.save()
-            #create image thumbnail
-            if request.FILES:
-                file = recipe.image.name.rsplit('/', 1)[1]
-                img = Image.open(settings.MEDIA_ROOT + recipe.image.name)
-                img.thumbnail((500,500))
-                img.save(settings.MEDIA_ROOT + 'thumbnails/' + file)
-                recipe.image_thumb = settings.MEDIA_URL + 'thumbnails/' + file
-                recipe.save()
-            #remove old Components
-            recipe.components.clear()
-            #link Recipe to new Components
-            for component in form.cleaned_data.get('component_baked'):
-                recipe.components.add(component)
-            for component in form.cleaned_data.get('component_icing'):
-                recipe.components.add(component)
-            for component in form.cleaned_data.get('component_decoration'):
-                recipe.components.add(component)
-            for component in form.cleaned_data.get('component_other'):
-                recipe.components.add(component)
-            recipe.update()
+                #show the default thumbnail until the new one is ready
+                recipe.image_thumb = Recipe._meta.get_field('image_thumb').default
+            request.unit_of_work.save(recipe)
+            if previous_image:
+                #delete old images once no Recipe uses them, i.e. after the
+                #Recipe is saved
+                request.unit_of_work.defer(lambda: images.release_image(*previous_image))
+            #create resized images in the background
+            if stored_image:
+                thumbnails.enqueue(recipe)
+            #add and remove only the Components that differ, and recalculate
+            #costs and prices only if the Components or times changed
+            components_changed = save_components(recipe, recipe_components(form))
+            if components_changed or times != (recipe.time_estimate, recipe.time_actual):
+                request.unit_of_work.recalculate(recipe, 'update')
             return HttpResponseRedirect(reverse('bakery:recipe-detail', args=(pk,)))
     else:
         form_info = {
@@ -364,21 +429,17 @@ def edit_recipe(request, pk):
 
 @require_http_methods(["POST"])
 @login_required
+@unit_of_work.atomic_request
 def delete_recipe(request):
     pk=request.POST['pk']
     recipe = get_object_or_404(Recipe, pk=pk)
     if recipe.can_be_deleted():
-        if recipe.user_uploaded_image:
-            #delete related images
-            try:
-                remove(recipe.image.path)
-            except FileNotFoundError:
-                pass
-            try:
-                remove(settings.MEDIA_ROOT.rsplit('/', 2)[0]+recipe.image_thumb)
-            except FileNotFoundError:
-                pass
+        previous_image = (recipe.stored_image, recipe.image.name)
         recipe.delete()
+        if recipe.user_uploaded_image:
+            #delete related images once no Recipe uses them, i.e. after the
+            #Recipe is deleted
+            request.unit_of_work.defer(lambda: images.release_image(*previous_image))
         return HttpResponseRedirect(reverse('bakery:view-recipes'))
     return HttpResponseRedirect(reverse('bakery:recipe-detail', args=(pk,)))
 
@@ -393,6 +454,7 @@ def order_sort_post_to_dict(post):
 
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def create_order(request):
     added_fields_context = {}
     if request.method == 'POST':
@@ -406,6 +468,7 @@ def create_order(request):
                     requires_delivery = form.cleaned_data['requires_delivery'],
                     notes = form.cleaned_data['notes']
                     )
+            #the OrderQuantities need the Order's primary key
             order.save()
             #use a dictionary to count number of occurences of each recipe
             recipeDict = Counter()
@@ -414,13 +477,12 @@ def create_order(request):
                 if key.startswith('addedRecipe'):
                     recipeDict[form.cleaned_data[key]] += 1
             #use count info to link new Order to each Recipe through an OrderQuantity
-            for recipe in recipeDict:
-                order_quantity = OrderQuantity(for_recipe = recipe,
-                        for_order = order,
-                        quantity = recipeDict[recipe]
-                        )
-                order_quantity.save()
-            order.calculate_prices()
+            order_quantities = [
+                OrderQuantity(for_recipe=recipe, for_order=order, quantity=recipeDict[recipe]) for recipe in recipeDict
+            ]
+            OrderQuantity.objects.bulk_create(order_quantities)
+            bulk_saved.send(sender=OrderQuantity, objects=order_quantities)
+            request.unit_of_work.recalculate(order, 'calculate_prices')
             return HttpResponseRedirect(reverse('bakery:view-orders'))
     else:
         form = OrderForm()
@@ -428,6 +490,7 @@ def create_order(request):
 
 @require_http_methods(["GET", "POST"])
 @login_required
+@unit_of_work.atomic_request
 def edit_order(request, pk):
     order = get_object_or_404(Order, pk=pk)
     added_fields_context = {}
@@ -444,7 +507,6 @@ def edit_order(request, pk):
             order.requires_delivery = form.cleaned_data['requires_delivery']
             order.deposit_paid = form.cleaned_data['deposit_paid']
             order.notes = form.cleaned_data['notes']
-            order.save()
             #use a dictionary to count number of occurences of each recipe
             recipeDict = Counter()
             recipeDict[form.cleaned_data['recipes']] += 1
@@ -452,14 +514,13 @@ def edit_order(request, pk):
                 if key.startswith('addedRecipe'):
                     recipeDict[form.cleaned_data[key]] += 1
             #use count info to link Order to each Recipe through an OrderQuantity
-            for recipe in recipeDict:
-                order_quantity = OrderQuantity(
-                        for_recipe = recipe,
-                        for_order = order,
-                        quantity = recipeDict[recipe]
-                        )
-                order_quantity.save()
-            order.calculate_prices()
+            order_quantities = [
+                OrderQuantity(for_recipe=recipe, for_order=order, quantity=recipeDict[recipe]) for recipe in recipeDict
+            ]
+            OrderQuantity.objects.bulk_create(order_quantities)
+            bulk_saved.send(sender=OrderQuantity, objects=order_quantities)
+            #saved by calculate_prices()
+            request.unit_of_work.recalculate(order, 'calculate_prices')
             return HttpResponseRedirect(reverse('bakery:order-detail', args=(pk,))) 
     else:
         oqs = OrderQuantity.objects.filter(for_order=order)
@@ -493,7 +554,68 @@ def edit_order(request, pk):
     
 @require_http_methods(["POST"])
 @login_required
+@unit_of_work.atomic_request
 def delete_order(request):
     order = get_object_or_404(Order, pk=request.POST['pk'])
     order.delete()
     return HttpResponseRedirect(reverse('bakery:home'))
+
+@require_http_methods(["GET"])
+@login_required
+def shopping_list(request):
+    form = ShoppingListForm(request.GET)
+    context = {'form': form}
+    if form.is_valid():
+        start, end = form.cleaned_data['start'], form.cleaned_data['end']
+        rows = shopping.shopping_list(start, end)
+        filename = f'shopping-{start.isoformat()}-{end.isoformat()}'
+        if form.cleaned_data['format'] == 'csv':
+            response = StreamingHttpResponse(shopping.csv_lines(rows), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+            return response
+        if form.cleaned_data['format'] == 'json':
+            return StreamingHttpResponse(shopping.json_chunks(rows, start, end), content_type='application/json')
+        context.update({'start': start, 'end': end, 'groceries': rows})
+    return render(request, 'bakery/shopping_list.html', context)
+
+@require_http_methods(["GET", "HEAD"])
+@login_required
+def lookup_recipes(request):
+    return lookups.response(request, 'recipes')
+
+@require_http_methods(["GET"])
+@login_required
+def search_names(request, kind):
+    '''Return one page of the objects of a bakery.search kind matching the
+    q parameter as JSON. match is 'prefix' (default) or 'contains'; page
+    and limit select the page, and any filter fields of the kind restrict
+    the matches.
+    '''
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        limit = max(int(request.GET.get('limit', search.get_limit())), 1)
+    except ValueError:
+        return HttpResponseBadRequest('page and limit must be whole numbers')
+    filters = {field: request.GET[field] for field in search.SEARCHES[kind][2] if field in request.GET}
+    matches, has_next = search.search(kind, request.GET.get('q', ''), request.GET.get('match', search.PREFIX),
+        page, limit, filters)
+    return JsonResponse({'results': matches, 'page': page, 'has_next': has_next})
+
+@require_http_methods(["GET"])
+@login_required
+def full_text_search(request):
+    form = FullTextSearchForm(request.GET)
+    context = {'form': form}
+    if form.is_valid() and form.cleaned_data['q']:
+        query, kind, page = form.cleaned_data['q'], form.cleaned_data['kind'], form.cleaned_data['page']
+        results, has_next = fulltext.search(query, [kind] if kind else None, page)
+        def page_url(number):
+            return '?' + urlencode({'q': query, 'kind': kind, 'page': number})
+        context.update({
+            'query': query,
+            'results': results,
+            'page': page,
+            'previous_url': page_url(page - 1) if page > 1 else None,
+            'next_url': page_url(page + 1) if has_next else None,
+        })
+    return render(request, 'bakery/search_results.html', context)
@@ -0,0 +1,119 @@
+'''Micro-benchmark comparing bakery.quantities.parse_quantity() with the
+previous multi-pass parse_str_to_decimal() implementation.
+
+Run from the repository root: python benchmarks/parse_quantity.py
+'''
+import os
+import re
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bakery.quantities import parse_quantity, parse_quantities
+from bakery.units import to_decimal
+
+SAMPLES = ['2', '2 1/4', '9/4', '2.25', '.5', '1  3/8', '12', '0.125', '1/0', '2..5', 'abc', '1 2']
+
+def legacy_parse_str_to_decimal(str):
+    '''Converts a string containing a whole number, mixed number, fraction, or decimal to a Decimal.
+    Returns (False, "error message") if the given string is in an invalid format.
+    Returns (True, Decimal) otherwise.    
+    '''
+    message = '\"%(str)s\" is not formatted properly. Use a whole number, mixed number, fraction, or decimal (e.g. 2 1/4 or 2.25)'
+    str = str.strip()
+    number = Decimal(0)
+    #match not "/. 0123456789"
+    pattern = re.compile(r"[^\/\. \d]")
+    if pattern.search(str) is not None:
+        message = '\"%(str)s\" contains invalid characters. Use only the character \"/\" or \".\" and numbers.'
+        return(False, message)
+    #match "0123456789"
+    pattern = re.compile(r"[\d]")
+    if pattern.search(str) is None:
+        message = '\"%(str)s\" contains no numbers.'
+        return(False, message)
+    #match "."
+    pattern = re.compile(r"[\.]")
+    if pattern.search(str) is not None:
+        #check for excess "."
+        if str.count('.') > 1:
+            message = '\"%(str)s\" contains too many decimals. Only one is allowed.'
+            return(False, message)
+        #match " "
+        pattern = re.compile(r"[ ]")
+        if pattern.search(str) is not None:
+            message = '\"%(str)s\" contains invalid characters. Do not combine spaces with a decimal.'
+            return(False, message)
+        #match "/"
+        pattern = re.compile(r"[\/]")
+        if pattern.search(str) is not None:
+            message = '\"%(str)s\" contains invalid characters. Do not combine a slash with a decimal.'
+            return(False, message)
+        #check validity as decimal
+        try:
+            number = Decimal(str)
+        except Exception:
+            return(False, message)
+    else:
+        #match "/"
+        pattern = re.compile(r"[\/]")
+        if pattern.search(str) is not None:
+            #check for excess "/"
+            if str.count('/') > 1:
+                message = '\"%(str)s\" contains too many slashes. Only one is allowed.'
+                return(False, message)
+            #match " "
+            pattern = re.compile(r"[ ]")
+            if pattern.search(str) is not None:
+                #check for valid mixed number
+                #multiple spaces between the whole number and fraction are permitted
+                numbers = str.split(' ')
+                for char in numbers[1:-1]:
+                    if char != '':
+                        return(False, message)
+                try:
+                    whole_num = Decimal(numbers[0])
+                except Exception:
+                    return(False, message)
+                fraction = numbers[-1]
+            else:
+                whole_num = number #Decimal(0)
+                fraction = str
+            #check for valid fraction
+            numbers = fraction.split('/')
+            try:
+                numerator = Decimal(numbers[0])
+                denominator = Decimal(numbers[1])
+            except Exception:
+                return(False, message)
+            if denominator == 0:
+                message = '\"%(str)s\" cannot divide by zero.'
+                return(False, message)
+            number = whole_num + (numerator / denominator)
+        else:
+            #check valid whole number
+            try:
+                number = Decimal(str)
+            except Exception:
+                return(False, message)
+    return (True, number)
+
+def main(number=20000):
+    for sample in SAMPLES:
+        legacy = legacy_parse_str_to_decimal(sample)
+        current = parse_quantity(sample)
+        if current[0]:
+            current = (True, to_decimal(current[1]))
+        assert legacy == current, sample
+    legacy = timeit.timeit(lambda: [legacy_parse_str_to_decimal(sample) for sample in SAMPLES], number=number)
+    current = timeit.timeit(lambda: [parse_quantity(sample) for sample in SAMPLES], number=number)
+    #a form that submits every amount three times, parsed in one batch
+    batch = timeit.timeit(lambda: parse_quantities(SAMPLES * 3), number=number)
+    calls = number * len(SAMPLES)
+    print(f'legacy parse_str_to_decimal  {legacy / calls * 1e6:8.2f} us/call')
+    print(f'parse_quantity               {current / calls * 1e6:8.2f} us/call ({legacy / current:.1f}x)')
+    print(f'parse_quantities             {batch / (calls * 3) * 1e6:8.2f} us/field ({legacy / batch * 3:.1f}x)')
+
+if __name__ == '__main__':
+    main()